@@ -5,14 +5,22 @@ Jennic ZigBee SDK Support
 from os.path import join, isdir, exists
 import os, shutil, stat
 
-from SCons.Script import Import, SConscript, Builder, AlwaysBuild, Action
+from SCons.Script import Import, SConscript, Builder, AlwaysBuild
 from SCons.Script import DefaultEnvironment
+from SCons.Node.FS import find_file as FindFile
+from SCons.Scanner import FindPathDirs, Scanner
+from SCons.Tool import SourceFileScanner
 
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
 
+from jn51xx import envmemo, generators, hdrindex, trace
+from jn51xx.archive import ArchiveError, SymbolIndex
+from jn51xx.cache import ArtifactCache, file_id, hash_file, make_key
+from jn51xx.elf import ElfError
+
 #Import("env")
 
 env = DefaultEnvironment()
@@ -54,10 +62,19 @@ assert (PDM_BUILD_TYPE in ['EEPROM','EXTERNAL_FLASH','NONE'])
 
 # If true, the debug lib is linked in
 DBG_ENABLE = bool(env.GetProjectOption("jennic_debug_enable", False))
-HARDWARE_DEBUG_ENABLED = False
 
-#OPTIONAL_STACK_FEATURES = $(shell $(ZPSCONFIG) -n $(TARGET) -f $(APP_COMMON_SRC_DIR)/$(APP_ZPSCFG) -y )
-#OPTIONAL_STACK_FEATURES = 1 # TODO
+# If true, DBG_vPrintf sends tokens instead of format strings (see jn51xx/dbglog.py)
+DBG_TOKENIZE = str(env.GetProjectOption("jennic_debug_tokenize", "no")).lower() in ("1", "yes", "true")
+
+# If true, every C function's entry and exit is recorded (see jn51xx/profiler.py)
+PROFILE_ENABLE = str(env.GetProjectOption("jennic_profile", "no")).lower() in ("1", "yes", "true")
+
+# Firmware sources and headers of the platform's own (tokenized logging, profiler)
+PLATFORM_SUPPORT_DIR = join(platform.get_dir(), "builder", "frameworks", "jennic")
+
+# If true, the application is built as an OTA upgrade client (see the `ota` target)
+OTA_ENABLE = str(env.GetProjectOption("jennic_ota", "no")).lower() in ("1", "yes", "true")
+HARDWARE_DEBUG_ENABLED = False
 
 
 SDK_STACK_DIR       = join(FRAMEWORK_DIR, "Stack")
@@ -66,6 +83,40 @@ SDK_PLATFORM_DIR    = join(FRAMEWORK_DIR, "Platform")
 SDK_CHIP_DIR        = join(FRAMEWORK_DIR, "Chip", JENNIC_CHIP)
 SDK_TOOL_DIR        = join(FRAMEWORK_DIR, "Tools")
 
+JENNIC_CACHE_DIR = env.subst("$JENNIC_CACHE_DIR")
+
+# Build step timing, if enabled (see `jennic_build_trace`)
+TRACE = trace.active()
+
+# The environment resolved below (include and library paths, defines, SDK
+# libraries, linker script) only depends on these inputs, so it's memoized
+# and replayed on later runs instead of being worked out again.
+CONFIG_MEMO = ArtifactCache(join(JENNIC_CACHE_DIR, "config"))
+CONFIG_KEY = make_key(
+    "framework-config", envmemo.MEMO_VERSION,
+    # This script and the host tools it uses (jn51xx) decide what's resolved
+    envmemo.tree_id(join(platform.get_dir(), "builder")),
+    envmemo.stat_id(join(FRAMEWORK_DIR, "package.json")),
+    envmemo.stat_id(join(TOOLCHAIN_DIR, "package.json")),
+    JENNIC_CHIP, JENNIC_STACK, JENNIC_MAC, ZBPRO_DEVICE_TYPE, PDM_BUILD_TYPE,
+    env.GetProjectOption("zllha_features", None), DBG_ENABLE, DBG_TOKENIZE, PROFILE_ENABLE,
+    OTA_ENABLE,
+    env.GetProjectOption("jennic_ota_manufacturer", "0x1037"),
+    env.GetProjectOption("conf_target", None),
+    env.GetProjectOption("jennic_stack_size", 6000),
+    env.GetProjectOption("jennic_min_heap_size", 2000),
+    envmemo.fingerprint(env))
+RESOLVED = envmemo.load(CONFIG_MEMO, CONFIG_KEY)
+if RESOLVED:
+    envmemo.apply(env, RESOLVED)
+else:
+    ENV_BEFORE = envmemo.snapshot(env)
+
+env.Replace(JENNIC_CHIP=JENNIC_CHIP, JENNIC_DEBUG_TOKENIZE=DBG_TOKENIZE)
+
+# Key of the generated ZPS/PDUM/OS config sources, if the stack needs them
+GEN_KEY = None
+
 STACK_SIZE = None
 MINIMUM_HEAP_SIZE = None
 
@@ -88,194 +139,212 @@ if JENNIC_STACK == "ZLLHA":
     APP_CLUSTER_ZLL_SRC             = ('ZLL' in ZLLHA_FEATURES)
     APP_CLUSTERS_GREENPOWER_SRC     = ('GREENPOWER' in ZLLHA_FEATURES)
     APP_CLUSTERS_MEASUREMENT_AND_SENSING = ('MEASUREMENT_AND_SENSING' in ZLLHA_FEATURES)
+    APP_CLUSTERS_OTA_SRC            = OTA_ENABLE
     GP_SUPPORT = APP_CLUSTERS_GREENPOWER_SRC 
 
     if APP_CLUSTER_HA_LIGHTING_SRC and APP_CLUSTER_ZLL_SRC:
         # NOTE: There is a duplicate dimmable_light.h file (one in ZLL, one in HA profile)
         raise Exception("ZLL & HA_LIGHTING features are incompatible")
 
-env.Append(
-    ASFLAGS=["-x", "assembler-with-cpp"],
+if RESOLVED is None:
+    env.Append(
+        ASFLAGS=["-x", "assembler-with-cpp"],
+
+        CCFLAGS=[
+            "-Wall",
+            "-Wunreachable-code",
+        ],
 
-    CCFLAGS=[
-        "-Wall",
-        "-Wunreachable-code",
-    ],
+        # NOTE: C++ probably not supported.
+        CXXFLAGS=[
+            "-fno-rtti",
+            "-fno-exceptions",
+            "-std=c++11"
+        ],
 
-    # NOTE: C++ probably not supported.
-    CXXFLAGS=[
-        "-fno-rtti",
-        "-fno-exceptions",
-        "-std=c++11"
-    ],
+        LINKFLAGS=[
+            "-Wl,--gc-sections",
+            "-Wl,-u_AppColdStart",
+            "-Wl,-u_AppWarmStart",
 
-    LINKFLAGS=[
-        "-Wl,--gc-sections",
-        "-Wl,-u_AppColdStart",
-        "-Wl,-u_AppWarmStart",
+            # Chip/JNxxxx/Build/config_JNxxxx.mk
+            #"-nostartfiles",
+            #"-nostdlib",
+        ],
 
-        # Chip/JNxxxx/Build/config_JNxxxx.mk
-        #"-nostartfiles",
-        #"-nostdlib",
-    ],
+        CPPDEFINES=[
+            #("F_CPU", "$BOARD_F_CPU"),
+            "EMBEDDED",
+            "RTOS", # Always tell any actual drivers they're running under an RTOS in this usage
 
-    JENNIC_CHIP=JENNIC_CHIP,
+            # This can be used to override the default discovery channel. If not specified, it will be available on all channels
+            #("MK_CHANNEL", "0"), 
 
-    CPPDEFINES=[
-        #("F_CPU", "$BOARD_F_CPU"),
-        "EMBEDDED",
-        "RTOS", # Always tell any actual drivers they're running under an RTOS in this usage
+            "USER_VSR_HANDLER",
 
-        # This can be used to override the default discovery channel. If not specified, it will be available on all channels
-        #("MK_CHANNEL", "0"), 
+            # Chip/Common/Build/config.mk
+            ("JENNIC_CHIP", JENNIC_CHIP),
+            "JENNIC_CHIP_"+JENNIC_CHIP,
+            ("JENNIC_CHIP_FAMILY", JENNIC_CHIP_FAMILY),
+            "JENNIC_CHIP_FAMILY_"+JENNIC_CHIP_FAMILY,
 
-        # OTA Support
-        #"BUILD_OTA",
-        #("CLD_OTA_MANF_ID_VALUE", "0x1037"),
-        #"OTA_ENCRYPTED",
+            "JENNIC_STACK_"+JENNIC_STACK,
+            "JENNIC_MAC_"+JENNIC_MAC,
 
-        "USER_VSR_HANDLER",
+            # Chip/JNxxxx/Build/config_JNxxxx.mk
+            (JENNIC_CHIP_FAMILY,JENNIC_CHIP_FAMILY_ID),
+            (JENNIC_CHIP,JENNIC_CHIP_ID),
+            ("JENNIC_CHIP_NAME", "_"+JENNIC_CHIP),
+            ("JENNIC_CHIP_FAMILY_NAME", "_"+JENNIC_CHIP_FAMILY),
 
-        # Chip/Common/Build/config.mk
-        ("JENNIC_CHIP", JENNIC_CHIP),
-        "JENNIC_CHIP_"+JENNIC_CHIP,
-        ("JENNIC_CHIP_FAMILY", JENNIC_CHIP_FAMILY),
-        "JENNIC_CHIP_FAMILY_"+JENNIC_CHIP_FAMILY,
+            "WATCHDOG_ENABLED",
+        
+            # Featureset
+            ("JENNIC_HW_BBC_RXINCCA","1"),
+            ("JENNIC_HW_BBC_DMA","1"),
+            ("JENNIC_HW_BBC_ISA","0"),
+            ("JENNIC_SW_EXTERNAL_FLASH","0"),
+            ("JN516X_DMA_UART_BACKWARDS_COMPATIBLE_API","1"),
+            ("UART_BACKWARDS_COMPATIBLE_API","1"),
+            #("PDM_DESCRIPTOR_BASED_API","1"),
+
+            # Platform/Common/Build/config.mk
+            ("JENNIC_PCB","DEVKIT4"),
+            "JENNIC_PCB_DEVKIT4",
+        ],
 
-        "JENNIC_STACK_"+JENNIC_STACK,
-        "JENNIC_MAC_"+JENNIC_MAC,
+        CPPPATH=[
+            # Hardware Development Platforms
+            join(SDK_PLATFORM_DIR, "Common", "Include"),
+            join(SDK_PLATFORM_DIR, "DK4", "Include"),
+
+            # Common Stack
+            join(SDK_COMPONENTS_DIR, "Common", "Include"),
+            join(SDK_COMPONENTS_DIR, "HardwareApi", "Include"),
+            join(SDK_COMPONENTS_DIR, "Aes", "Include"),
+            join(SDK_COMPONENTS_DIR, "DBG", "Include"),
+        ],
 
-        # Chip/JNxxxx/Build/config_JNxxxx.mk
-        (JENNIC_CHIP_FAMILY,JENNIC_CHIP_FAMILY_ID),
-        (JENNIC_CHIP,JENNIC_CHIP_ID),
-        ("JENNIC_CHIP_NAME", "_"+JENNIC_CHIP),
-        ("JENNIC_CHIP_FAMILY_NAME", "_"+JENNIC_CHIP_FAMILY),
+        # LIBSOURCE_DIRS=[
+        #     join(FRAMEWORK_DIR, "libraries")
+        # ],
 
-        "WATCHDOG_ENABLED",
-        
-        # Featureset
-        ("JENNIC_HW_BBC_RXINCCA","1"),
-        ("JENNIC_HW_BBC_DMA","1"),
-        ("JENNIC_HW_BBC_ISA","0"),
-        ("JENNIC_SW_EXTERNAL_FLASH","0"),
-        ("JN516X_DMA_UART_BACKWARDS_COMPATIBLE_API","1"),
-        ("UART_BACKWARDS_COMPATIBLE_API","1"),
-        #("PDM_DESCRIPTOR_BASED_API","1"),
-
-        # Platform/Common/Build/config.mk
-        ("JENNIC_PCB","DEVKIT4"),
-        "JENNIC_PCB_DEVKIT4",
-    ],
-
-    CPPPATH=[
-        # Hardware Development Platforms
-        join(SDK_PLATFORM_DIR, "Common", "Include"),
-        join(SDK_PLATFORM_DIR, "DK4", "Include"),
-
-        # Common Stack
-        join(SDK_COMPONENTS_DIR, "Common", "Include"),
-        join(SDK_COMPONENTS_DIR, "HardwareApi", "Include"),
-        join(SDK_COMPONENTS_DIR, "Aes", "Include"),
-        join(SDK_COMPONENTS_DIR, "DBG", "Include"),
-    ],
-
-    # LIBSOURCE_DIRS=[
-    #     join(FRAMEWORK_DIR, "libraries")
-    # ],
-
-    LIBPATH=[
-        join(SDK_COMPONENTS_DIR, "Library"),
-        join(SDK_CHIP_DIR, "Build"),
-        join(SDK_PLATFORM_DIR, "DK4", "Library"),
-    ],
-
-    JNLIBS=[
-        "Aes",
-        "HardwareApi",
-        "MicroSpecific",
-        "Boot",
-
-        "Recal",
-        # Platform-specific board library
-        "BoardLib"
-    ],
-    LIBS=[
-        'm' # Add math library
-    ]
-)
+        LIBPATH=[
+            join(SDK_COMPONENTS_DIR, "Library"),
+            join(SDK_CHIP_DIR, "Build"),
+            join(SDK_PLATFORM_DIR, "DK4", "Library"),
+        ],
 
-if DBG_ENABLE:
-    env.Append(
-        CPPDEFINES=[
-            "DBG_ENABLE"
+        JNLIBS=[
+            "Aes",
+            "HardwareApi",
+            "MicroSpecific",
+            "Boot",
+
+            "Recal",
+            # Platform-specific board library
+            "BoardLib"
         ],
-        JNLIBS=["DBG"]
+        LIBS=[
+            'm' # Add math library
+        ]
     )
 
-if GP_SUPPORT:
-    env.Append(CPPDEFINES=["CLD_GREENPOWER"])
+    if DBG_ENABLE:
+        env.Append(
+            CPPDEFINES=[
+                "DBG_ENABLE"
+            ],
+            JNLIBS=["DBG"]
+        )
 
-#
-# Stack Support
-#
+    if DBG_TOKENIZE:
+        # C only: the header would break the assembler sources (os_irq*.S)
+        env.Append(
+            CPPPATH=[join(PLATFORM_SUPPORT_DIR, "include")],
+            CFLAGS=["-include", "dbg_tokenized.h"],
+            LINKFLAGS=[join(PLATFORM_SUPPORT_DIR, "dbg_tokenized.ld")]
+        )
+
+    if PROFILE_ENABLE:
+        # C only, the OS interrupt entry points (os_irq*.S) are covered by their C handlers
+        env.Append(
+            CPPDEFINES=["JENNIC_PROFILE"],
+            CPPPATH=[join(PLATFORM_SUPPORT_DIR, "include")],
+            CFLAGS=["-finstrument-functions"]
+        )
+
+    if GP_SUPPORT:
+        env.Append(CPPDEFINES=["CLD_GREENPOWER"])
+
+    if OTA_ENABLE:
+        env.Append(CPPDEFINES=[
+            "BUILD_OTA",
+            ("CLD_OTA_MANF_ID_VALUE", env.GetProjectOption("jennic_ota_manufacturer", "0x1037")),
+        ])
+
+    #
+    # Stack Support
+    #
+
+    if JENNIC_MAC == "MAC":
+        REDUCED_MAC_LIB_SUFFIX = ''
+        if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
+            REDUCED_MAC_LIB_SUFFIX = '_ZIGBEE'
+            env.Append(CPPDEFINES=["REDUCED_ZIGBEE_MAC_BUILD"])
 
-if JENNIC_MAC == "MAC":
-    REDUCED_MAC_LIB_SUFFIX = ''
-    if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
-        REDUCED_MAC_LIB_SUFFIX = '_ZIGBEE'
-        env.Append(CPPDEFINES=["REDUCED_ZIGBEE_MAC_BUILD"])
-
-    env.Append(JNLIBS=[
-        "AppApi"+REDUCED_MAC_LIB_SUFFIX,
-        "MAC"+REDUCED_MAC_LIB_SUFFIX,
-        "TimerServer",
-        "TOF",
-        "Xcv",
-    ])
-else:
-    if JENNIC_MAC in ["MiniMac","MiniMacShim"]:
         env.Append(JNLIBS=[
-            "MiniMac", 
-            "MiniMacShim"
+            "AppApi"+REDUCED_MAC_LIB_SUFFIX,
+            "MAC"+REDUCED_MAC_LIB_SUFFIX,
+            "TimerServer",
+            "TOF",
+            "Xcv",
         ])
-    env.Append(JNLIBS=["MMAC"])
-
-if JENNIC_MAC in ['MiniMacShim','MAC']:
-    env.Append(CPPPATH=[
-        join(SDK_COMPONENTS_DIR, "AppApi","Include"),
-        join(SDK_COMPONENTS_DIR, "MAC", "Include"),
-    ])
-if JENNIC_MAC in ['MiniMac','MiniMacShim']:
-    env.Append(CPPPATH=[
-        join(SDK_COMPONENTS_DIR, "MiniMac", "Include"),
-    ])
-if JENNIC_MAC in ['MiniMac','MiniMacShim', 'MMAC']:
-    env.Append(CPPPATH=[
-        join(SDK_COMPONENTS_DIR, "MMAC", "Include"),
-    ])
-
-#if JENNIC_STACK == "MAC"
-if JENNIC_STACK == "JIP":
-    env.Append(
-        JNLIBS=[
-            "PDM_%s" % (PDM_BUILD_TYPE)
-        ],
-        LINKFLAGS=[
-            "-Wl,-ueSecurityTxPrepare",
-            "-Wl,-ueSecurityTxEncrypt",
-            "-Wl,-ubSecurityRxProcess"
+    else:
+        if JENNIC_MAC in ["MiniMac","MiniMacShim"]:
+            env.Append(JNLIBS=[
+                "MiniMac", 
+                "MiniMacShim"
+            ])
+        env.Append(JNLIBS=["MMAC"])
+
+    if JENNIC_MAC in ['MiniMacShim','MAC']:
+        env.Append(CPPPATH=[
+            join(SDK_COMPONENTS_DIR, "AppApi","Include"),
+            join(SDK_COMPONENTS_DIR, "MAC", "Include"),
+        ])
+    if JENNIC_MAC in ['MiniMac','MiniMacShim']:
+        env.Append(CPPPATH=[
+            join(SDK_COMPONENTS_DIR, "MiniMac", "Include"),
+        ])
+    if JENNIC_MAC in ['MiniMac','MiniMacShim', 'MMAC']:
+        env.Append(CPPPATH=[
+            join(SDK_COMPONENTS_DIR, "MMAC", "Include"),
         ])
-    LINKER_FILE = 'AppBuildJip'
-else:
-    LINKER_FILE = 'AppBuildMac'
+
+    #if JENNIC_STACK == "MAC"
+    if JENNIC_STACK == "JIP":
+        env.Append(
+            JNLIBS=[
+                "PDM_%s" % (PDM_BUILD_TYPE)
+            ],
+            LINKFLAGS=[
+                "-Wl,-ueSecurityTxPrepare",
+                "-Wl,-ueSecurityTxEncrypt",
+                "-Wl,-ubSecurityRxProcess"
+            ])
+        LINKER_FILE = 'AppBuildJip'
+    else:
+        LINKER_FILE = 'AppBuildMac'
 
 if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
     OSCONFIG_EXE    = join(SDK_TOOL_DIR, "OSConfig",   "bin", "OSConfig.exe")
     PDUMCONFIG_EXE  = join(SDK_TOOL_DIR, "PDUMConfig", "bin", "PDUMConfig.exe")
     ZPSCONFIG_EXE   = join(SDK_TOOL_DIR, "ZPSConfig",  "bin", "ZPSConfig.exe")
-    assert (exists(OSCONFIG_EXE))
-    assert (exists(PDUMCONFIG_EXE))
-    assert (exists(ZPSCONFIG_EXE))
+    if RESOLVED is None:
+        assert (exists(OSCONFIG_EXE))
+        assert (exists(PDUMCONFIG_EXE))
+        assert (exists(ZPSCONFIG_EXE))
 
     PROJ_TARGET = env.GetProjectOption("conf_target", None)
     ZPSCFG_PATH = join('$PROJECT_SRC_DIR', env.GetProjectOption('conf_zps', None)) # app.zpscfg
@@ -285,26 +354,29 @@ if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
     print("Conf ZPS:    %s" % ZPSCFG_PATH)
     print("Conf OS:     %s" % OSCFG_PATH)
 
-    STACK_SIZE = 6000
-    MINIMUM_HEAP_SIZE = 2000
-
-    env.Append(
-        CPPDEFINES=[
-            "PDM_"+PDM_BUILD_TYPE
-        ],
-        CPPPATH=[
-            join(SDK_COMPONENTS_DIR, "MAC", "Include"),
-            join(SDK_COMPONENTS_DIR, "MicroSpecific", "Include"),
-            join(SDK_COMPONENTS_DIR, "MiniMAC", "Include"),
-            join(SDK_COMPONENTS_DIR, "MMAC", "Include"),
-            join(SDK_COMPONENTS_DIR, "TimerServer", "Include"),
-            join(SDK_COMPONENTS_DIR, "PDM", "Include"),
-
-            join(SDK_COMPONENTS_DIR, "ZPSMAC", "Include"),
-            join(SDK_COMPONENTS_DIR, "ZPSNWK", "Include"),
-        ],
-        JNLIBS=["ZPSAPL"]
-    )
+    # See `pio run -t stack` for how much of these the application needs
+    STACK_SIZE = int(env.GetProjectOption("jennic_stack_size", 6000))
+    MINIMUM_HEAP_SIZE = int(env.GetProjectOption("jennic_min_heap_size", 2000))
+    env.Replace(JENNIC_STACK_SIZE=STACK_SIZE, JENNIC_MIN_HEAP_SIZE=MINIMUM_HEAP_SIZE)
+
+    if RESOLVED is None:
+        env.Append(
+            CPPDEFINES=[
+                "PDM_"+PDM_BUILD_TYPE
+            ],
+            CPPPATH=[
+                join(SDK_COMPONENTS_DIR, "MAC", "Include"),
+                join(SDK_COMPONENTS_DIR, "MicroSpecific", "Include"),
+                join(SDK_COMPONENTS_DIR, "MiniMAC", "Include"),
+                join(SDK_COMPONENTS_DIR, "MMAC", "Include"),
+                join(SDK_COMPONENTS_DIR, "TimerServer", "Include"),
+                join(SDK_COMPONENTS_DIR, "PDM", "Include"),
+
+                join(SDK_COMPONENTS_DIR, "ZPSMAC", "Include"),
+                join(SDK_COMPONENTS_DIR, "ZPSNWK", "Include"),
+            ],
+            JNLIBS=["ZPSAPL"]
+        )
 
     ZPS_APL_LIB = 'ZPSAPL'
 
@@ -317,14 +389,14 @@ if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
     if PDM_BUILD_TYPE == 'EEPROM':
         APPLIBS.append('PDM_EEPROM')
 
-    # TODO: Select libraries based on OPTIONAL_STACK_FEATURES
-    # For now let's just link in all libraries, even if not needed
     if ZBPRO_DEVICE_TYPE == 'ZCR':
-        APPLIBS += ["ZPSNWK", "ZPSZLL", "ZPSGP"]
+        APPLIBS += ["ZPSNWK"]
         ZPS_NWK_LIB = 'ZPSNWK'
+        ZPS_OPTIONAL_LIBS = ["ZPSGP", "ZPSZLL"]
     elif ZBPRO_DEVICE_TYPE == 'ZED':
-        APPLIBS += ["ZPSNWK_ZED", "ZPSZLL_ZED", "ZPSGP_ZED"]
+        APPLIBS += ["ZPSNWK_ZED"]
         ZPS_NWK_LIB = 'ZPSNWK_ZED'
+        ZPS_OPTIONAL_LIBS = ["ZPSGP_ZED", "ZPSZLL_ZED"]
 
     if JENNIC_MAC == 'MAC':
         APPLIBS.append("ZPSMAC")
@@ -332,21 +404,84 @@ if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
         JENNIC_MAC = 'MiniMacShim' # TODO: This should happen before anything else needs it
         APPLIBS.append("ZPSMAC_Mini")
 
-    if JENNIC_CHIP_FAMILY != 'JN514x':
+    if JENNIC_CHIP_FAMILY != 'JN514x' and RESOLVED is None:
         env.Append(CPPDEFINES=['PDM_USER_SUPPLIED_ID'])
 
-    env.Append(
-        CPPPATH=[join(SDK_COMPONENTS_DIR, appname, "Include") for appname in APPLIBS],
-        JNLIBS=APPLIBS
-    )
+    def get_zpslib_path(name):
+        return join(SDK_COMPONENTS_DIR, "Library", "lib%s_%s.a"%(name, JENNIC_CHIP_FAMILY))
+
+    # The generated sources only depend on the config files, target and tool
+    # versions, so they're cached for reuse by any project or environment.
+    GEN_CACHE = ArtifactCache(join(JENNIC_CACHE_DIR, "gen"))
+
+    # Runs the generator .exe's (under wine on non-Windows hosts)
+    TOOLS = generators.ToolLauncher(env.GetProjectOption("jennic_wine", None))
+
+    # Config files are hashed once per build, however many keys they go into
+    CONFIG_DIGESTS = {}
+
+    def HashConfig(path):
+        ident = file_id(path)
+        if ident not in CONFIG_DIGESTS:
+            CONFIG_DIGESTS[ident] = hash_file(path)
+        return CONFIG_DIGESTS[ident]
+
+    if RESOLVED is None:
+        env.Append(
+            CPPPATH=[join(SDK_COMPONENTS_DIR, appname, "Include")
+                     for appname in APPLIBS + ZPS_OPTIONAL_LIBS],
+            JNLIBS=APPLIBS
+        )
+
+    # The optional stack libraries (Green Power, inter-PAN) only reach the
+    # linker if something in the link references them: the objects (zps_gen.c,
+    # generated from the .zpscfg, among them), the other libraries or each
+    # other. That's worked out when the link runs, from the symbol tables of
+    # its inputs (LTO ones included) and a cached index of the SDK archives.
+    SYMBOL_INDEX = SymbolIndex(ArtifactCache(join(JENNIC_CACHE_DIR, "symbols")), [FRAMEWORK_DIR])
+
+    def FindLibrary(lib, env):
+        if hasattr(lib, "get_abspath"):
+            return lib.get_abspath()
+        for libdir in env.get("LIBPATH", []):
+            path = join(env.subst(str(libdir)), "lib%s.a" % lib)
+            if exists(path):
+                return path
+        return None  # eg. libm, from the toolchain
+
+    # Worked out once per link, however many times its command is expanded
+    OPTIONAL_LIBS_LINKED = {}
+
+    def OptionalStackLibFlags(target, source, env, for_signature):
+        if for_signature:
+            # Which are needed only changes with the link's inputs, which are
+            # dependencies of the link anyway
+            return ZPS_OPTIONAL_LIBS
+        linked = [FindLibrary(lib, env) for lib in env.get("LIBS", [])] + [s.get_abspath() for s in source]
+        linked = tuple(path for path in linked if path)
+        if linked not in OPTIONAL_LIBS_LINKED:
+            optional = [get_zpslib_path(lib) for lib in ZPS_OPTIONAL_LIBS if exists(get_zpslib_path(lib))]
+            undefined = [flag[len("-Wl,-u"):] for flag in env.get("LINKFLAGS", [])
+                         if isinstance(flag, str) and flag.startswith("-Wl,-u")]
+            try:
+                needed = SYMBOL_INDEX.required(linked, optional, undefined)
+            except (IOError, OSError, ArchiveError, ElfError) as e:
+                print("Warning: Linking all optional stack libraries (%s)" % e)
+                needed = optional
+            selected = [lib for lib in ZPS_OPTIONAL_LIBS if get_zpslib_path(lib) in needed]
+            print("Optional stack libraries: %s" % ", ".join(
+                "%s %s" % (lib, "linked" if lib in selected else "not referenced") for lib in ZPS_OPTIONAL_LIBS))
+            OPTIONAL_LIBS_LINKED[linked] = selected
+        return ["-l%s_%s" % (lib, JENNIC_CHIP_FAMILY) for lib in OPTIONAL_LIBS_LINKED[linked]]
+
+    # Inside the --start-group PlatformIO wraps around LIBS
+    env.Replace(_JENNIC_OPTIONAL_LIBFLAGS=OptionalStackLibFlags)
+    env.Append(_LIBFLAGS=" $_JENNIC_OPTIONAL_LIBFLAGS")
 
     #
     # Custom build targets
     #
 
-    def get_zpslib_path(name):
-        return join(SDK_COMPONENTS_DIR, "Library", "lib%s_%s.a"%(name, JENNIC_CHIP_FAMILY))
-    
     BUILDGEN_DIR = '$BUILD_DIR/gen'
 
     def ClearReadOnlyAttribute(path):
@@ -356,66 +491,23 @@ if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
         except:
             pass
 
-    def GeneratePdumAction(target, source, env):
-        action = Action(' '.join([
-            '"'+PDUMCONFIG_EXE+'"',
-            '-z',PROJ_TARGET,
-            '-f','$SOURCES',
-            '-o',BUILDGEN_DIR
-        ]))
-        action(target, source, env)
-
-        for f in target:
-            ClearReadOnlyAttribute(f)
-
-    def GenerateOsConfigAction(target, source, env):
-        action = Action(' '.join([
-            '"'+OSCONFIG_EXE+'"',
-            '-f','$SOURCES',
-            '-o',BUILDGEN_DIR,
-            '-v',JENNIC_CHIP
-        ]))
-        action(target, source, env)
-
-        for f in target:
-            ClearReadOnlyAttribute(f)
-
-    def GenerateZigbeeStackAction(target, source, env):
-        action = Action(' '.join([
-            '"'+ZPSCONFIG_EXE+'"',
-            '-n',PROJ_TARGET,
-            '-t',JENNIC_CHIP,
-            '-l',get_zpslib_path(ZPS_NWK_LIB),
-            '-a',get_zpslib_path(ZPS_APL_LIB),
-            '-c',TOOLCHAIN_DIR,
-            '-f','$SOURCES',
-            '-o',BUILDGEN_DIR
-        ]))
-        action(target, source, env)
-
-        for f in target:
-            ClearReadOnlyAttribute(f)
+    def PdumCacheKey(zpscfg):
+        return make_key("PDUMConfig", file_id(PDUMCONFIG_EXE), HashConfig(zpscfg), PROJ_TARGET)
 
-    env.Append(BUILDERS=dict(
-        GeneratePdum=Builder(
-            action=env.VerboseAction(GeneratePdumAction, "Generating PDUM Config...")
-        ),
-        GenerateOsConfig=Builder(
-            action=env.VerboseAction(GenerateOsConfigAction, "Generating OS Config...")
-        ),
-        GenerateZigbeeStack=Builder(
-            action=env.VerboseAction(GenerateZigbeeStackAction, "Configuring Zigbee Protocol Stack...")
-        )
-    ))
+    def OsConfigCacheKey(oscfg):
+        return make_key("OSConfig", file_id(OSCONFIG_EXE), HashConfig(oscfg), JENNIC_CHIP)
 
-    # Generate source/headers from project config
-    # These will only be re-generated if the source/dest files change.
-    env.GeneratePdum([join(BUILDGEN_DIR, f) for f in [
+    def ZigbeeStackCacheKey(zpscfg):
+        return make_key("ZPSConfig", file_id(ZPSCONFIG_EXE), HashConfig(zpscfg),
+            PROJ_TARGET, JENNIC_CHIP, TOOLCHAIN_DIR,
+            file_id(get_zpslib_path(ZPS_NWK_LIB)), file_id(get_zpslib_path(ZPS_APL_LIB)))
+
+    PDUM_GEN_FILES = [
         'pdum_gen.h',
         'pdum_gen.c',
         'pdum_apdu.S',
-    ]], ZPSCFG_PATH)
-    env.GenerateOsConfig([join(BUILDGEN_DIR, f) for f in [
+    ]
+    OS_GEN_FILES = [
         'os_gen.h',
         'os_gen.c',
         'os_irq.S',
@@ -424,39 +516,104 @@ if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
         'os_irq_illegalinstruction.S',
         'os_irq_stackoverflowexception.S',
         'os_irq_unimplementedmodule.S',
-    ]], OSCFG_PATH)
-    env.GenerateZigbeeStack([join(BUILDGEN_DIR, f) for f in [
+    ]
+    ZPS_GEN_FILES = [
         'zps_gen.h',
         'zps_gen.c',
-    ]], ZPSCFG_PATH)
+    ]
+
+    def GenerateConfigAction(target, source, env):
+        """Run PDUMConfig, OSConfig and ZPSConfig as one step
+
+        Outputs are restored from the cache where possible, and the tools
+        that do have to run are launched concurrently.
+        """
+        zpscfg, oscfg = source[0].get_abspath(), source[1].get_abspath()
+        outdir = env.subst(BUILDGEN_DIR)
+        by_name = dict((t.name, t) for t in target)
+
+        jobs = [
+            ("PDUMConfig", PdumCacheKey(zpscfg), PDUM_GEN_FILES, TOOLS.command(
+                PDUMCONFIG_EXE, '-z', PROJ_TARGET, '-f', zpscfg, '-o', outdir)),
+            ("OSConfig", OsConfigCacheKey(oscfg), OS_GEN_FILES, TOOLS.command(
+                OSCONFIG_EXE, '-f', oscfg, '-o', outdir, '-v', JENNIC_CHIP)),
+            ("ZPSConfig", ZigbeeStackCacheKey(zpscfg), ZPS_GEN_FILES, TOOLS.command(
+                ZPSCONFIG_EXE, '-n', PROJ_TARGET, '-t', JENNIC_CHIP,
+                '-l', get_zpslib_path(ZPS_NWK_LIB), '-a', get_zpslib_path(ZPS_APL_LIB),
+                '-c', TOOLCHAIN_DIR, '-f', zpscfg, '-o', outdir)),
+        ]
+
+        runs = []
+        outputs = {}
+        for name, key, files, argv in jobs:
+            nodes = [by_name[f] for f in files]
+            if GEN_CACHE.get(key, nodes):
+                print("Restored %s from cache" % ", ".join(files))
+                continue
+            run = generators.ToolRun(name, argv)
+            outputs[name] = (key, nodes)
+            runs.append(run)
+        if not runs:
+            return 0
+
+        if not isdir(outdir):
+            os.makedirs(outdir)
+
+        def on_start(run):
+            if TRACE:
+                TRACE.begin(run, run.name, "generate")
+
+        def on_finish(run):
+            if TRACE:
+                TRACE.end(run)
+
+        elapsed = generators.run_parallel(runs, on_start, on_finish)
+
+        status = 0
+        for run in runs:
+            output = run.output.decode("utf-8", "replace").strip()
+            if output:
+                print(output)
+            if run.returncode:
+                print("Error: %s failed with exit code %d" % (run.name, run.returncode))
+                status = run.returncode
+                continue
+            key, nodes = outputs[run.name]
+            for f in nodes:
+                ClearReadOnlyAttribute(f)
+            GEN_CACHE.put(key, nodes)
+
+        print("Generated config in %.2fs (%s)" % (elapsed, ", ".join(
+            "%s %.2fs" % (run.name, run.elapsed) for run in runs)))
+        return status
+
+    env.Append(BUILDERS=dict(
+        GenerateConfig=Builder(
+            action=env.VerboseAction(GenerateConfigAction, "Generating PDUM/OS/ZPS config...")
+        )
+    ))
+
+    # Generate source/headers from project config
+    # These will only be re-generated if the source/dest files change.
+    env.GenerateConfig(
+        [join(BUILDGEN_DIR, f) for f in PDUM_GEN_FILES + OS_GEN_FILES + ZPS_GEN_FILES],
+        [ZPSCFG_PATH, OSCFG_PATH])
+
+    if exists(env.subst(ZPSCFG_PATH)) and exists(env.subst(OSCFG_PATH)):
+        GEN_KEY = make_key(
+            PdumCacheKey(env.subst(ZPSCFG_PATH)),
+            OsConfigCacheKey(env.subst(OSCFG_PATH)),
+            ZigbeeStackCacheKey(env.subst(ZPSCFG_PATH)))
 
-    # Compile the generated sources
-    genlib = env.StaticLibrary(
-        join('$BUILD_DIR', 'Gen'), # output
-        [env.File(join(BUILDGEN_DIR,f)) for f in [
-            'pdum_gen.c',
-            'pdum_apdu.S',
-            'os_gen.c',
-            'os_irq.S',
-            'os_irq_alignment.S',
-            'os_irq_buserror.S',
-            'os_irq_illegalinstruction.S',
-            'os_irq_stackoverflowexception.S',
-            'os_irq_unimplementedmodule.S',
-            'zps_gen.c'
-        ]]
-    )
     #includes = env.MatchSourceFiles(env.subst('$PROJECT_INCLUDE_DIR'), ['+<**/os_msg_types.h>'])
     #print("Found os_msg_types.h: %s" % includes)
-    env.Prepend(
-        CPPPATH=[BUILDGEN_DIR],
-        LIBS=[genlib]
-    )
+    if RESOLVED is None:
+        env.Prepend(CPPPATH=[BUILDGEN_DIR])
 
     # TODO: We're supposed to feed the above targets in as a pre-action, but I couldn't get this to work...
     #env.AddPreAction('buildprog', target_pdum)
 
-if JENNIC_STACK == 'ZLLHA':
+if JENNIC_STACK == 'ZLLHA' and RESOLVED is None:
     SDK_ZCL_DIR = join(SDK_COMPONENTS_DIR, "ZCL")
     SDK_ZCL_SRC = join(SDK_ZCL_DIR, "Source")
     SDK_ZCL_CLUSTERS = join(SDK_ZCL_DIR, "Clusters")
@@ -511,57 +668,58 @@ if JENNIC_STACK == 'ZLLHA':
         ])
 
 
-# Hardware debug support (NOTE: JN516x doesn't need separate library as JTag initialised in bootloader)
-if HARDWARE_DEBUG_ENABLED:
-    env.Append(LINKFLAGS=[
-        "-Wl,--defsym,g_bSWConf_Debug=1",
-        #"-Wl,-defsym,g_bSWConf_AltDebugPort=1", # Alt port UART1, else UART0
-    ])
-
-
-# Stack/Common/Build/config.mk
-if STACK_SIZE is not None:
-    env.Append(LINKFLAGS=["-Wl,--defsym=__stack_size=%d" % STACK_SIZE])
-if MINIMUM_HEAP_SIZE is not None:
-    env.Append(LINKFLAGS=["-Wl,--defsym,__minimum_heap_size=%d" % MINIMUM_HEAP_SIZE])
-
-# Custom components
-# TODO: Automatically populate with all components
-env.Append(
-    CPPPATH=[
-        join(SDK_COMPONENTS_DIR, "Utilities", "Include"),
-        join(SDK_COMPONENTS_DIR, "ZCL", "Include"),
-        join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "LightLink", "Include"),
-        join(SDK_COMPONENTS_DIR, "Xcv", "Include"),
-        join(SDK_COMPONENTS_DIR, "Recal", "Include"),
-        join(SDK_COMPONENTS_DIR, "OVLY", "Include"),
-        join(SDK_COMPONENTS_DIR, "MicroSpecific", "Include"),
-    ]
-)
+if RESOLVED is None:
+    # Hardware debug support (NOTE: JN516x doesn't need separate library as JTag initialised in bootloader)
+    if HARDWARE_DEBUG_ENABLED:
+        env.Append(LINKFLAGS=[
+            "-Wl,--defsym,g_bSWConf_Debug=1",
+            #"-Wl,-defsym,g_bSWConf_AltDebugPort=1", # Alt port UART1, else UART0
+        ])
 
-# copy CCFLAGS to ASFLAGS (-x assembler-with-cpp mode)
-env.Append(ASFLAGS=env.get("CCFLAGS", [])[:])
 
-# Find the appropriate lib for the JNLIBS collection (usually suffixed with the chip family, eg. 'Random_JN516x')
-def get_jnlib_fullname(name):
-    # These are all the libs with a xxx9 variant:
-    if (JENNIC_CHIP == 'JN5169') and (name in ['AppApi', 'HardwareApi', 'MAC', 'MiniMac', 'MMAC', 'Xcv']):
-        return '%s_%s' % (name, JENNIC_CHIP)
-    if (name in ['JPT']):
-        return '%s_%s' % (name, JENNIC_CHIP)
-    return '%s_%s' % (name, JENNIC_CHIP_FAMILY)
-env.Append(LIBS=[get_jnlib_fullname(lib) for lib in env['JNLIBS']])
+    # Stack/Common/Build/config.mk
+    if STACK_SIZE is not None:
+        env.Append(LINKFLAGS=["-Wl,--defsym=__stack_size=%d" % STACK_SIZE])
+    if MINIMUM_HEAP_SIZE is not None:
+        env.Append(LINKFLAGS=["-Wl,--defsym,__minimum_heap_size=%d" % MINIMUM_HEAP_SIZE])
 
+    # Custom components
+    # TODO: Automatically populate with all components
+    env.Append(
+        CPPPATH=[
+            join(SDK_COMPONENTS_DIR, "Utilities", "Include"),
+            join(SDK_COMPONENTS_DIR, "ZCL", "Include"),
+            join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "LightLink", "Include"),
+            join(SDK_COMPONENTS_DIR, "Xcv", "Include"),
+            join(SDK_COMPONENTS_DIR, "Recal", "Include"),
+            join(SDK_COMPONENTS_DIR, "OVLY", "Include"),
+            join(SDK_COMPONENTS_DIR, "MicroSpecific", "Include"),
+        ]
+    )
 
-# Select correct linker script
-if JENNIC_STACK == 'ZLLHA':
-    LINKER_FILE = join(SDK_STACK_DIR, "ZLLHA", "Build", "AppBuildZLLHA_"+JENNIC_CHIP)+".ld"
-else:
-    LINKER_FILE = join(SDK_CHIP_DIR, "Build", "AppBuild%s.ld" % JENNIC_STACK)
-if not exists(LINKER_FILE):
-    raise RuntimeError('Could not find linker script for stack: %s' % JENNIC_STACK)
+    # copy CCFLAGS to ASFLAGS (-x assembler-with-cpp mode)
+    env.Append(ASFLAGS=env.get("CCFLAGS", [])[:])
 
-env.Replace(LDSCRIPT_PATH=[LINKER_FILE])
+    # Find the appropriate lib for the JNLIBS collection (usually suffixed with the chip family, eg. 'Random_JN516x')
+    def get_jnlib_fullname(name):
+        # These are all the libs with a xxx9 variant:
+        if (JENNIC_CHIP == 'JN5169') and (name in ['AppApi', 'HardwareApi', 'MAC', 'MiniMac', 'MMAC', 'Xcv']):
+            return '%s_%s' % (name, JENNIC_CHIP)
+        if (name in ['JPT']):
+            return '%s_%s' % (name, JENNIC_CHIP)
+        return '%s_%s' % (name, JENNIC_CHIP_FAMILY)
+    env.Append(LIBS=[get_jnlib_fullname(lib) for lib in env['JNLIBS']])
+
+
+    # Select correct linker script
+    if JENNIC_STACK == 'ZLLHA':
+        LINKER_FILE = join(SDK_STACK_DIR, "ZLLHA", "Build", "AppBuildZLLHA_"+JENNIC_CHIP)+".ld"
+    else:
+        LINKER_FILE = join(SDK_CHIP_DIR, "Build", "AppBuild%s.ld" % JENNIC_STACK)
+    if not exists(LINKER_FILE):
+        raise RuntimeError('Could not find linker script for stack: %s' % JENNIC_STACK)
+
+    env.Replace(LDSCRIPT_PATH=[LINKER_FILE])
 
 print("JENNIC_STACK: %s" % JENNIC_STACK)
 print("JENNIC_MAC:   %s" % JENNIC_MAC)
@@ -584,6 +742,144 @@ print("LIBS:    %s" % env['JNLIBS'])
 # Target: Build Driver Library
 #
 
+# Compiled libraries are cached by everything that affects how their sources
+# compile, so a clean build can link a prebuilt archive instead.
+PREBUILT_CACHE = ArtifactCache(join(JENNIC_CACHE_DIR, "lib"))
+
+def GetCompileKey(build_env):
+    parts = [build_env.subst("$CC $CFLAGS $CCFLAGS $ASFLAGS $_CPPDEFFLAGS")]
+    for inc in build_env.get("CPPPATH", []):
+        path = env.subst(str(inc))
+        if path.startswith(FRAMEWORK_DIR):
+            # The SDK is read-only and versioned by its path
+            parts.append(path)
+        elif JENNIC_STACK in ['ZLLHA', 'ZBPro'] and path == env.subst(BUILDGEN_DIR):
+            # Generated headers are determined by the generator inputs
+            parts.append(GEN_KEY)
+        elif isdir(path):
+            # Project include dirs (eg. zcl_options.h) by header contents
+            parts += [f + hash_file(join(path, f)) for f in sorted(os.listdir(path))
+                      if f.endswith(".h")]
+    return make_key(*parts)
+
+PREBUILT_MISSES = []
+
+def BuildCachedLibrary(name, key, build):
+    cached = PREBUILT_CACHE.lookup(key, env.subst("${LIBPREFIX}%s${LIBSUFFIX}" % name))
+    if cached:
+        return env.File(cached)
+    PREBUILT_MISSES.append(name)
+
+    def StoreCachedLibrary(target, source, env):
+        PREBUILT_CACHE.put(key, [target[0].get_abspath()])
+
+    lib = build()
+    env.AddPostAction(lib, env.VerboseAction(StoreCachedLibrary, "Caching $TARGET"))
+    if TRACE:
+        TRACE.instrument_library(env, lib, name)
+    return lib
+
+if RESOLVED:
+    SDK_VERSION = RESOLVED["values"]["sdk_version"]
+    TOOLCHAIN_VERSION = RESOLVED["values"]["toolchain_version"]
+else:
+    SDK_VERSION = platform.get_package_version("framework-jennic")
+    TOOLCHAIN_VERSION = platform.get_package_version("toolchain-nxp-beyondstudio")
+    envmemo.save(CONFIG_MEMO, CONFIG_KEY, ENV_BEFORE, env, dict(
+        sdk_version=SDK_VERSION, toolchain_version=TOOLCHAIN_VERSION))
+
+#
+# SDK header index
+#
+
+# What each SDK header includes, transitively, is fixed by the SDK version and
+# the SDK include dirs, so it's indexed once and dependency scanning looks SDK
+# headers up instead of searching CPPPATH for each of their includes.
+HEADER_INDEX_ENABLE = str(env.GetProjectOption("jennic_header_index", "yes")).lower() in ("1", "yes", "true")
+
+def LoadHeaderIndex():
+    sdk_dirs = [p for p in (env.subst(str(d)) for d in env.get("CPPPATH", []))
+                if p.startswith(FRAMEWORK_DIR)]
+    cache = ArtifactCache(join(JENNIC_CACHE_DIR, "headers"))
+    key = make_key("sdk-headers", hdrindex.INDEX_VERSION, SDK_VERSION, FRAMEWORK_DIR, *sdk_dirs)
+    data = cache.read(key, "index.json")
+    index = hdrindex.HeaderIndex.from_json(data.decode()) if data else None
+    if index is None:
+        index = hdrindex.HeaderIndex.build(sdk_dirs)
+        cache.write(key, "index.json", index.to_json().encode())
+    return index
+
+def ScanIncludes(node, env, path):
+    if not node.exists():
+        return []
+    own_dirs = tuple(d.get_abspath() for d in path if not d.get_abspath().startswith(FRAMEWORK_DIR))
+    shadowed = HEADER_INDEX.shadowed(own_dirs)
+    deps = []
+    for quote, name in hdrindex.parse_includes(node.get_text_contents()):
+        found = None
+        if quote == '"':
+            local = node.dir.File(name)
+            if local.exists():
+                found = HEADER_INDEX.closure(local.get_abspath(), shadowed) or local
+        if found is None:
+            found = HEADER_INDEX.lookup(name, shadowed)
+        if found is None:
+            search = (node.dir,) + tuple(path) if quote == '"' else tuple(path) + (node.dir,)
+            found = FindFile(name, search)
+        if isinstance(found, tuple):
+            paths, external = found
+            deps += [env.File(p) for p in paths]
+            deps += [f for f in (FindFile(n, tuple(path)) for n in external) if f]
+        elif found:
+            deps.append(found)
+    return deps
+
+def ScanRecursively(nodes):
+    # Indexed SDK headers come with their own includes already
+    return [n for n in nodes if n.get_abspath() not in HEADER_INDEX.deps]
+
+if HEADER_INDEX_ENABLE:
+    HEADER_INDEX = LoadHeaderIndex()
+    if HEADER_INDEX.duplicates:
+        # eg. ZLL's and HA's dimmable_light.h: the first in CPPPATH is used
+        print("Warning: SDK headers found in more than one include dir (the first is used):")
+        for line in HEADER_INDEX.format_duplicates(FRAMEWORK_DIR):
+            print("  " + line)
+    # The Object builders scan their sources with SourceFileScanner, which
+    # picks a scanner by suffix (CScanner for these) and ignores $SCANNERS, so
+    # it's registered there in place of CScanner
+    HEADER_SCANNER = Scanner(
+        ScanIncludes,
+        name="JennicHeaderScanner",
+        path_function=FindPathDirs("CPPPATH"),
+        recursive=ScanRecursively)
+    for suffix in [".c", ".cpp", ".cc", ".cxx", ".h", ".hpp", ".S"]:
+        SourceFileScanner.add_scanner(suffix, HEADER_SCANNER)
+
+# In the dev build profile the SDK libraries are compiled without LTO, so a
+# link only has to re-optimise the application's own code
+LIB_ENV = env
+if env.subst("$JENNIC_BUILD_PROFILE") == "dev":
+    LIB_ENV = env.Clone()
+    for flags in ["CCFLAGS", "ASFLAGS"]:
+        LIB_ENV.Replace(**{flags: [f for f in LIB_ENV.get(flags, []) if not str(f).startswith("-flto")]})
+
+COMPILE_KEY = GetCompileKey(LIB_ENV)
+
+def BuildSdkLibrary(name, src_dir, *extra_key):
+    key = make_key(name, src_dir, SDK_VERSION, TOOLCHAIN_VERSION, JENNIC_CHIP,
+                   ",".join(sorted(ZLLHA_FEATURES)) if JENNIC_STACK == 'ZLLHA' else "",
+                   COMPILE_KEY, *extra_key)
+    return BuildCachedLibrary(name, key, lambda: LIB_ENV.BuildLibrary(join("$BUILD_DIR", name), src_dir))
+
+def BuildSupportLibrary(name):
+    # Not part of the SDK, so not covered by SDK_VERSION
+    return BuildSdkLibrary(
+        name,
+        join(PLATFORM_SUPPORT_DIR, "src", name),
+        envmemo.stat_id(join(PLATFORM_SUPPORT_DIR, "src", name, name + ".c")),
+        envmemo.stat_id(join(PLATFORM_SUPPORT_DIR, "include", name + ".h")))
+
 
 libs = []
 
@@ -591,34 +887,34 @@ if JENNIC_STACK == 'ZLLHA':
     # See: Stack\ZLLHA\Build\config_ZLLHA.mk
 
     # ZCL Source
-    libs.append(env.BuildLibrary(
-        join("$BUILD_DIR", "ZCL"),
+    libs.append(BuildSdkLibrary(
+        "ZCL",
         join(SDK_COMPONENTS_DIR, "ZCL", "Source")
     ))
-    libs.append(env.BuildLibrary(
-        join("$BUILD_DIR", "ZCL_General"),
+    libs.append(BuildSdkLibrary(
+        "ZCL_General",
         join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "General", "Source")
     ))
 
     # OTA
-    # if APP_CLUSTERS_OTA_SRC:
-    #     libs.append(env.BuildLibrary(
-    #         join("$BUILD_DIR", "ZCL_OTA"),
-    #         join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "OTA", "Source")
-    #     ))
+    if APP_CLUSTERS_OTA_SRC:
+        libs.append(BuildSdkLibrary(
+            "ZCL_OTA",
+            join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "OTA", "Source")
+        ))
 
     # Zigbee LightLink (ZLL) Stack
     if APP_CLUSTER_ZLL_SRC:
-        libs.append(env.BuildLibrary(
-            join("$BUILD_DIR", "ZLL"),
+        libs.append(BuildSdkLibrary(
+            "ZLL",
             join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "ZLL", "Source")
         ))
-        libs.append(env.BuildLibrary(
-            join("$BUILD_DIR", "ZLL_Lighting"),
+        libs.append(BuildSdkLibrary(
+            "ZLL_Lighting",
             join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "Lighting", "Source")
         ))
-        libs.append(env.BuildLibrary(
-            join("$BUILD_DIR", "ZLL_LightLink"),
+        libs.append(BuildSdkLibrary(
+            "ZLL_LightLink",
             join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "LightLink", "Source")
         ))
 
@@ -633,83 +929,119 @@ if JENNIC_STACK == 'ZLLHA':
     else:
                 
         # HA Common
-        libs.append(env.BuildLibrary(
-            join("$BUILD_DIR", "HA_Common"),
+        libs.append(BuildSdkLibrary(
+            "HA_Common",
             join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "HA", "Common", "Source")
         ))
 
         # HA Lighting
         if APP_CLUSTER_HA_LIGHTING_SRC:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_Lighting_Profile"),
+            libs.append(BuildSdkLibrary(
+                "HA_Lighting_Profile",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "HA", "Lighting", "Source")
             ))
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_Lighting_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "HA_Lighting_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "Lighting", "Source")
             ))
 
         # Energy At Home
         if APP_CLUSTERS_ENERGY_AT_HOME_SRC:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_EnergyAtHome_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "HA_EnergyAtHome_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "EnergyAtHome", "Source")
             ))
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_EnergyAtHome_Profile"),
+            libs.append(BuildSdkLibrary(
+                "HA_EnergyAtHome_Profile",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "HA", "EnergyAtHome", "Source")
             ))
 
         # GreenPower Source
         if APP_CLUSTERS_GREENPOWER_SRC:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_GreenPower_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "HA_GreenPower_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "GreenPower", "Source")
             ))
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_GreenPower_Profile"),
+            libs.append(BuildSdkLibrary(
+                "HA_GreenPower_Profile",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "GP", "Source")
             ))
 
         # HVAC
         if APP_CLUSTERS_HVAC_SRC:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_HVAC_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "HA_HVAC_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "HVAC", "Source")
             ))
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_HVAC_Profile"),
+            libs.append(BuildSdkLibrary(
+                "HA_HVAC_Profile",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "HA", "HVAC", "Source")
             ))
 
         # IAS
         if APP_CLUSTERS_IAS_SRC:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_IAS_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "HA_IAS_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "IAS", "Source")
             ))
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "HA_IAS_Profile"),
+            libs.append(BuildSdkLibrary(
+                "HA_IAS_Profile",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Profiles", "HA", "IAS", "Source")
             ))
 
         if APP_CLUSTERS_MEASUREMENT_AND_SENSING:
-            libs.append(env.BuildLibrary(
-                join("$BUILD_DIR", "ZCL_MeasurementAndSensing_Cluster"),
+            libs.append(BuildSdkLibrary(
+                "ZCL_MeasurementAndSensing_Cluster",
                 join(SDK_COMPONENTS_DIR, "ZCL", "Clusters", "MeasurementAndSensing", "Source")
             ))
 
 # SDK Source
-libs.append(env.BuildLibrary(
-    join("$BUILD_DIR", "JNUtilities"),
+libs.append(BuildSdkLibrary(
+    "JNUtilities",
     join(SDK_COMPONENTS_DIR, "Utilities", "Source")
 ))
 
+if DBG_TOKENIZE:
+    libs.append(BuildSupportLibrary("dbg_tokenized"))
+
+if PROFILE_ENABLE:
+    libs.append(BuildSupportLibrary("profiler"))
+
 if JENNIC_MAC in ['MiniMacShim'] and JENNIC_CHIP == 'JN5169':
-    libs.append(env.BuildLibrary(
-        join("$BUILD_DIR", "JNMiniMacShim"),
+    libs.append(BuildSdkLibrary(
+        "JNMiniMacShim",
         join(SDK_COMPONENTS_DIR, "MiniMAC", "Source")
     ))
 
+if JENNIC_STACK in ['ZLLHA', 'ZBPro']:
+    # Compile the generated sources
+    def BuildGenLibrary():
+        return LIB_ENV.StaticLibrary(
+            join('$BUILD_DIR', 'Gen'), # output
+            [env.File(join(BUILDGEN_DIR,f)) for f in [
+                'pdum_gen.c',
+                'pdum_apdu.S',
+                'os_gen.c',
+                'os_irq.S',
+                'os_irq_alignment.S',
+                'os_irq_buserror.S',
+                'os_irq_illegalinstruction.S',
+                'os_irq_stackoverflowexception.S',
+                'os_irq_unimplementedmodule.S',
+                'zps_gen.c'
+            ]]
+        )
+    if GEN_KEY:
+        libs.append(BuildCachedLibrary('Gen', make_key('Gen', GEN_KEY, COMPILE_KEY), BuildGenLibrary))
+    else:
+        gen_lib = BuildGenLibrary()
+        if TRACE:
+            TRACE.instrument_library(env, gen_lib, 'Gen')
+        libs.append(gen_lib)
+
+print("Library cache: %d prebuilt, %d to build%s" % (
+    PREBUILT_CACHE.hits, PREBUILT_CACHE.misses,
+    (" (%s)" % ", ".join(PREBUILT_MISSES)) if PREBUILT_MISSES else ""))
+
 env.Prepend(LIBS=libs)
 
@@ -0,0 +1,72 @@
+/*
+ * Tokenized DBG_vPrintf (see `jennic_debug_tokenize`)
+ *
+ * Force-included into every C file when tokenized logging is enabled. Each
+ * DBG_vPrintf call keeps its format string in the .dbg_fmt section, which
+ * dbg_tokenized.ld links as a non-loaded (INFO) section at address 0, so the
+ * string never reaches flash and its address is a unique token for it.
+ * Only the token and the arguments are sent over the UART, and the host
+ * decoder (python -m jn51xx.dbglog) looks the format up in firmware.tokens.json.
+ *
+ * Arguments are sent as 32-bit values, except char pointers and arrays (%s),
+ * which are sent as the string itself. At most 8 arguments are supported.
+ */
+
+#ifndef DBG_TOKENIZED_H
+#define DBG_TOKENIZED_H
+
+#include <jendefs.h>
+#include <dbg.h>
+
+#ifdef DBG_ENABLE
+
+/* UART the frames are written to; it must already be initialised (DBG_vUartInit) */
+#ifndef DBG_TOKENIZED_UART
+#define DBG_TOKENIZED_UART      E_AHI_UART_0
+#endif
+
+/* Frame: DBG_TOKENIZED_SYNC, payload length, token (varint), arguments */
+#define DBG_TOKENIZED_SYNC      0xFE
+#define DBG_TOKENIZED_MAX_ARGS  8
+
+#define DBG_TOK_CAT(a, b)       DBG_TOK_CAT_(a, b)
+#define DBG_TOK_CAT_(a, b)      a##b
+
+/* Number of arguments, 0 to 8 */
+#define DBG_TOK_NARGS(...)      DBG_TOK_NARGS_(0, ##__VA_ARGS__, 8, 7, 6, 5, 4, 3, 2, 1, 0)
+#define DBG_TOK_NARGS_(_0, _1, _2, _3, _4, _5, _6, _7, _8, N, ...) N
+
+#define DBG_TOK_IS_STR(x) \
+    (__builtin_types_compatible_p(__typeof__(x), char *) || \
+     __builtin_types_compatible_p(__typeof__(x), const char *) || \
+     __builtin_types_compatible_p(__typeof__(x), char[]) || \
+     __builtin_types_compatible_p(__typeof__(x), const char[]))
+
+/* Bit n set if argument n is a string */
+#define DBG_TOK_MASK(...) \
+    DBG_TOK_CAT(DBG_TOK_MASK_, DBG_TOK_NARGS(__VA_ARGS__))(0, ##__VA_ARGS__)
+#define DBG_TOK_MASK_0(i, ...)      0
+#define DBG_TOK_MASK_1(i, a, ...)   (DBG_TOK_IS_STR(a) << (i))
+#define DBG_TOK_MASK_2(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_1((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_3(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_2((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_4(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_3((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_5(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_4((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_6(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_5((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_7(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_6((i) + 1, __VA_ARGS__)
+#define DBG_TOK_MASK_8(i, a, ...)   (DBG_TOK_IS_STR(a) << (i)) | DBG_TOK_MASK_7((i) + 1, __VA_ARGS__)
+
+PUBLIC void dbg_vTokenized(uint32 u32Token, uint32 u32StringArgs, uint8 u8NumArgs, ...);
+
+#undef DBG_vPrintf
+#define DBG_vPrintf(STREAM, FORMAT, ...) \
+    do { \
+        if (STREAM) { \
+            static const char _dbg_acFormat[] __attribute__((section(".dbg_fmt"), used)) = FORMAT; \
+            dbg_vTokenized((uint32)_dbg_acFormat, DBG_TOK_MASK(__VA_ARGS__), \
+                           DBG_TOK_NARGS(__VA_ARGS__), ##__VA_ARGS__); \
+        } \
+    } while (0)
+
+#endif /* DBG_ENABLE */
+
+#endif /* DBG_TOKENIZED_H */
@@ -0,0 +1,36 @@
+/*
+ * Function-level profiler (see `jennic_profile`)
+ *
+ * Every C function built with -finstrument-functions records its entry and
+ * exit, with a timestamp, in a ring buffer in RAM. PROFILER_vFlush() sends
+ * the buffered records over the UART; call it from the application's idle
+ * loop, and collect them with python -m jn51xx.profiler.
+ *
+ * Record (9 bytes, big-endian):
+ *     u8 type (PROFILER_ENTER, PROFILER_EXIT or PROFILER_DROPPED)
+ *     u32 function address (or number of records dropped)
+ *     u32 timestamp (PROFILER_TIMESTAMP(), the tick timer by default)
+ *
+ * When the buffer fills up, its last record marks where dropping started:
+ * the DROPPED record is sent in sequence, with the time of the first record
+ * dropped and the number dropped until the next flush made room.
+ *
+ * The tick timer must be left free-running (E_AHI_TICK_TIMER_CONT), or
+ * PROFILER_TIMESTAMP defined to another 32-bit counter.
+ */
+
+#ifndef PROFILER_H
+#define PROFILER_H
+
+#include <jendefs.h>
+
+#define PROFILER_ENTER          0xE0
+#define PROFILER_EXIT           0xE1
+#define PROFILER_DROPPED        0xE2
+
+#define PROFILER_NO_INSTRUMENT  __attribute__((no_instrument_function))
+
+PUBLIC void PROFILER_vEnable(bool_t bEnable) PROFILER_NO_INSTRUMENT;
+PUBLIC void PROFILER_vFlush(void) PROFILER_NO_INSTRUMENT;
+
+#endif /* PROFILER_H */
@@ -0,0 +1,80 @@
+/*
+ * Tokenized DBG_vPrintf: frame encoder (see dbg_tokenized.h)
+ */
+
+#include <jendefs.h>
+#include <stdarg.h>
+#include <AppHardwareApi.h>
+#include "dbg_tokenized.h"
+
+#ifdef DBG_ENABLE
+
+#define DBG_TOKENIZED_MAX_FRAME 128
+/* Longest varint encoding of a uint32 */
+#define DBG_TOKENIZED_MAX_VARINT 5
+
+PRIVATE uint8 *pu8PutVarint(uint8 *pu8Buf, uint32 u32Value)
+{
+    while (u32Value >= 0x80)
+    {
+        *pu8Buf++ = (uint8)(u32Value | 0x80);
+        u32Value >>= 7;
+    }
+    *pu8Buf++ = (uint8)u32Value;
+    return pu8Buf;
+}
+
+PRIVATE void vWriteFrame(uint8 *pu8Data, uint16 u16Length)
+{
+    while (u16Length--)
+    {
+        while (!(u8AHI_UartReadLineStatus(DBG_TOKENIZED_UART) & E_AHI_UART_LS_THRE));
+        vAHI_UartWriteData(DBG_TOKENIZED_UART, *pu8Data++);
+    }
+}
+
+PUBLIC void dbg_vTokenized(uint32 u32Token, uint32 u32StringArgs, uint8 u8NumArgs, ...)
+{
+    uint8 au8Frame[DBG_TOKENIZED_MAX_FRAME];
+    uint8 *pu8End = &au8Frame[DBG_TOKENIZED_MAX_FRAME];
+    uint8 *pu8Pos = pu8PutVarint(&au8Frame[2], u32Token);
+    uint8 u8Arg;
+    va_list ap;
+
+    /* Arguments that don't fit are left out, and a string that doesn't fit is
+     * cut short without its terminator; either way the decoder runs out of
+     * frame and shows the line as truncated */
+    va_start(ap, u8NumArgs);
+    for (u8Arg = 0; u8Arg < u8NumArgs && u8Arg < DBG_TOKENIZED_MAX_ARGS; u8Arg++)
+    {
+        if (u32StringArgs & (1 << u8Arg))
+        {
+            const char *pcString = va_arg(ap, const char *);
+            while (pcString && *pcString && pu8Pos < pu8End)
+            {
+                *pu8Pos++ = (uint8)*pcString++;
+            }
+            if (pu8Pos >= pu8End)
+            {
+                break;
+            }
+            *pu8Pos++ = 0;
+        }
+        else
+        {
+            uint32 u32Value = va_arg(ap, uint32);
+            if (pu8End - pu8Pos < DBG_TOKENIZED_MAX_VARINT)
+            {
+                break;
+            }
+            pu8Pos = pu8PutVarint(pu8Pos, u32Value);
+        }
+    }
+    va_end(ap);
+
+    au8Frame[0] = DBG_TOKENIZED_SYNC;
+    au8Frame[1] = (uint8)(pu8Pos - &au8Frame[2]);
+    vWriteFrame(au8Frame, (uint16)(pu8Pos - au8Frame));
+}
+
+#endif /* DBG_ENABLE */
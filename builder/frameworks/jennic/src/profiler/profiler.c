@@ -0,0 +1,144 @@
+/*
+ * Function-level profiler: instrumentation hooks and ring buffer (see profiler.h)
+ */
+
+#include <jendefs.h>
+#include <AppHardwareApi.h>
+#include <MicroSpecific.h>
+#include "profiler.h"
+
+/* Records buffered between flushes, 8 bytes of RAM each */
+#ifndef PROFILER_BUFFER_SIZE
+#define PROFILER_BUFFER_SIZE    256
+#endif
+
+/* UART the records are written to; it must already be initialised */
+#ifndef PROFILER_UART
+#define PROFILER_UART           E_AHI_UART_0
+#endif
+
+#ifndef PROFILER_TIMESTAMP
+#define PROFILER_TIMESTAMP()    u32AHI_TickTimerRead()
+#endif
+
+/* Function addresses are below these, so the bits mark exits and drop
+ * markers (with the number of records dropped) in the buffer */
+#define PROFILER_EXIT_FLAG      0x80000000
+#define PROFILER_DROP_FLAG      0x40000000
+#define PROFILER_DROP_COUNT     0x3FFFFFFF
+
+typedef struct
+{
+    uint32 u32Function;
+    uint32 u32Time;
+} tsProfilerRecord;
+
+PUBLIC void __cyg_profile_func_enter(void *pvFunction, void *pvCallSite) PROFILER_NO_INSTRUMENT;
+PUBLIC void __cyg_profile_func_exit(void *pvFunction, void *pvCallSite) PROFILER_NO_INSTRUMENT;
+
+PRIVATE tsProfilerRecord asRecords[PROFILER_BUFFER_SIZE];
+PRIVATE volatile uint16 u16Head;
+PRIVATE volatile uint16 u16Tail;
+PRIVATE volatile bool_t bEnabled = TRUE;
+
+PRIVATE PROFILER_NO_INSTRUMENT void vRecord(uint32 u32Function)
+{
+    uint32 u32Store;
+    uint16 u16Next;
+
+    if (!bEnabled)
+    {
+        return;
+    }
+
+    /* Interrupt handlers are instrumented too */
+    MICRO_DISABLE_AND_SAVE_INTERRUPTS(u32Store);
+    u16Next = (u16Head + 1) % PROFILER_BUFFER_SIZE;
+    if (u16Next == u16Tail)
+    {
+        /* Full, so the last record is the drop marker: count this one in it */
+        tsProfilerRecord *psMarker;
+
+        psMarker = &asRecords[(u16Head + PROFILER_BUFFER_SIZE - 1) % PROFILER_BUFFER_SIZE];
+        if ((psMarker->u32Function & PROFILER_DROP_COUNT) != PROFILER_DROP_COUNT)
+        {
+            psMarker->u32Function++;
+        }
+    }
+    else if ((u16Next + 1) % PROFILER_BUFFER_SIZE == u16Tail)
+    {
+        /* The last free record marks where dropping starts, so the gap is
+         * sent in sequence with the records around it */
+        asRecords[u16Head].u32Function = PROFILER_DROP_FLAG | 1;
+        asRecords[u16Head].u32Time = PROFILER_TIMESTAMP();
+        u16Head = u16Next;
+    }
+    else
+    {
+        asRecords[u16Head].u32Function = u32Function;
+        asRecords[u16Head].u32Time = PROFILER_TIMESTAMP();
+        u16Head = u16Next;
+    }
+    MICRO_RESTORE_INTERRUPTS(u32Store);
+}
+
+PUBLIC void __cyg_profile_func_enter(void *pvFunction, void *pvCallSite)
+{
+    vRecord((uint32)pvFunction);
+}
+
+PUBLIC void __cyg_profile_func_exit(void *pvFunction, void *pvCallSite)
+{
+    vRecord((uint32)pvFunction | PROFILER_EXIT_FLAG);
+}
+
+PRIVATE PROFILER_NO_INSTRUMENT void vWriteRecord(uint8 u8Type, uint32 u32Value, uint32 u32Time)
+{
+    uint8 au8Record[9];
+    uint8 u8Byte;
+
+    au8Record[0] = u8Type;
+    for (u8Byte = 0; u8Byte < 4; u8Byte++)
+    {
+        au8Record[1 + u8Byte] = (uint8)(u32Value >> (24 - 8 * u8Byte));
+        au8Record[5 + u8Byte] = (uint8)(u32Time >> (24 - 8 * u8Byte));
+    }
+    for (u8Byte = 0; u8Byte < sizeof(au8Record); u8Byte++)
+    {
+        while (!(u8AHI_UartReadLineStatus(PROFILER_UART) & E_AHI_UART_LS_THRE));
+        vAHI_UartWriteData(PROFILER_UART, au8Record[u8Byte]);
+    }
+}
+
+PUBLIC void PROFILER_vEnable(bool_t bEnable)
+{
+    bEnabled = bEnable;
+}
+
+PUBLIC void PROFILER_vFlush(void)
+{
+    uint32 u32Store;
+    tsProfilerRecord sRecord;
+
+    while (u16Tail != u16Head)
+    {
+        /* A drop marker is still counted into until it's taken out */
+        MICRO_DISABLE_AND_SAVE_INTERRUPTS(u32Store);
+        sRecord = asRecords[u16Tail];
+        u16Tail = (u16Tail + 1) % PROFILER_BUFFER_SIZE;
+        MICRO_RESTORE_INTERRUPTS(u32Store);
+
+        if (sRecord.u32Function & PROFILER_EXIT_FLAG)
+        {
+            vWriteRecord(PROFILER_EXIT, sRecord.u32Function & ~PROFILER_EXIT_FLAG, sRecord.u32Time);
+        }
+        else if (sRecord.u32Function & PROFILER_DROP_FLAG)
+        {
+            vWriteRecord(PROFILER_DROPPED, sRecord.u32Function & PROFILER_DROP_COUNT, sRecord.u32Time);
+        }
+        else
+        {
+            vWriteRecord(PROFILER_ENTER, sRecord.u32Function, sRecord.u32Time);
+        }
+    }
+}
@@ -0,0 +1,3 @@
+"""
+Host-side tooling for the NXP Jennic (JN516x) platform
+"""
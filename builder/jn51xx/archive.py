@@ -0,0 +1,145 @@
+"""
+Symbol index of objects and static libraries (GNU ar archives of ELF objects)
+
+Used to work out which of the optional SDK libraries anything in a link
+references, without running the linker. Objects compiled with -flto are read
+through their LTO symbol tables.
+
+    python -m jn51xx.archive libZPSGP_JN516x.a libZPSZLL_JN516x.a --linked .pio/build/<env>/src/*.o ...
+"""
+
+import argparse
+import json
+import sys
+
+from .cache import make_key, file_id
+from .elf import ElfError, ElfFile
+
+ARMAG = b"!<arch>\n"
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def iter_members(data):
+    """Yield (name, data) for each object in an ar archive"""
+    data = memoryview(data)
+    if data[:8].tobytes() != ARMAG:
+        raise ArchiveError("Not an ar archive")
+    longnames = b""
+    pos = 8
+    while pos + 60 <= len(data):
+        header = data[pos:pos + 60].tobytes()
+        if header[58:60] != b"`\n":
+            raise ArchiveError("Corrupt archive member header at %d" % pos)
+        name = header[:16].decode("latin-1").rstrip()
+        size = int(header[48:58].decode("ascii").strip())
+        body = data[pos + 60:pos + 60 + size]
+        pos += 60 + size + (size & 1)
+
+        if name == "//":
+            longnames = body.tobytes()
+            continue
+        if name in ("/", "/SYM64/", "__.SYMDEF", "__.SYMDEF SORTED"):
+            continue
+        if name.startswith("/") and name[1:].isdigit():
+            start = int(name[1:])
+            end = longnames.find(b"\n", start)
+            name = longnames[start:end].decode("latin-1")
+        yield name.rstrip("/"), body
+
+
+def read_symbols(path):
+    """Global symbols an archive or object defines, and those it needs from elsewhere"""
+    defined, undefined = set(), set()
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if data[:8] == ARMAG:
+        members = [body for _, body in iter_members(data)]
+    else:
+        members = [data]
+    for body in members:
+        try:
+            d, u = ElfFile(body).global_symbols()
+        except ElfError:
+            continue
+        defined |= d
+        undefined |= u
+    return dict(defined=sorted(defined), undefined=sorted(undefined - defined))
+
+
+class SymbolIndex(object):
+    """Symbol tables of archives and objects; those under `cached_dirs` (eg.
+    the read-only SDK) are kept in `cache` by file identity"""
+
+    def __init__(self, cache=None, cached_dirs=()):
+        self.cache = cache
+        self.cached_dirs = tuple(cached_dirs)
+        self.files = {}
+
+    def load(self, path):
+        if path in self.files:
+            return self.files[path]
+        cached = self.cache is not None and path.startswith(self.cached_dirs)
+        key = make_key("symbols", file_id(path))
+        data = self.cache.read(key, "symbols.json") if cached else None
+        if data is not None:
+            symbols = json.loads(data.decode("utf-8"))
+        else:
+            symbols = read_symbols(path)
+            if cached:
+                self.cache.write(key, "symbols.json", json.dumps(symbols).encode("utf-8"))
+        entry = (set(symbols["defined"]), set(symbols["undefined"]))
+        self.files[path] = entry
+        return entry
+
+    def required(self, linked, optional, undefined=()):
+        """Subset of the `optional` archives that resolve references from the
+        `linked` archives and objects, from `undefined` (eg. -u symbols) or
+        from each other, transitively. Every linked archive counts as a
+        whole, so this can keep a library the linker wouldn't take anything
+        from, but never drops one it would.
+        """
+        needed = []
+        unresolved = set(undefined)
+        defined = set()
+        for path in linked:
+            d, u = self.load(path)
+            defined |= d
+            unresolved |= u
+        remaining = list(optional)
+        changed = True
+        while changed:
+            changed = False
+            missing = unresolved - defined
+            for path in list(remaining):
+                d, u = self.load(path)
+                if d & missing:
+                    needed.append(path)
+                    remaining.remove(path)
+                    defined |= d
+                    unresolved |= u
+                    changed = True
+                    break
+        return needed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show which optional libraries a link references")
+    parser.add_argument("optional", nargs="+", help="Optional libraries (.a)")
+    parser.add_argument("--linked", nargs="+", required=True, help="Objects and libraries always linked")
+    args = parser.parse_args(argv)
+
+    try:
+        needed = SymbolIndex().required(args.linked, args.optional)
+    except (ArchiveError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    for path in args.optional:
+        print("%s %s" % ("needed  " if path in needed else "unneeded", path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
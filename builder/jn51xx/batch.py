@@ -0,0 +1,195 @@
+"""
+Parallel production flashing of many devices
+
+Each serial port is programmed by its own worker (unless `workers` limits
+them). A device that fails gets another attempt on its port as soon as the
+failure is reported (up to `retries`), while the other ports carry on, so one
+bad module never holds up the rest of the line.
+
+    python -m jn51xx.batch --ports "/dev/ttyUSB*" firmware.bin
+"""
+
+import argparse
+import glob
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import protocol as bl
+from .image import load_layout
+from .provision import ProvisionError, ProvisioningTable
+from .uploader import FlashUploader, layout_path
+
+
+def expand_ports(specs):
+    """Expand a list (or comma/whitespace separated string) of ports and globs"""
+    if isinstance(specs, str):
+        specs = [specs]
+    ports = []
+    for spec in specs:
+        for item in re.split(r"[,\s]+", spec.strip()):
+            if not item:
+                continue
+            matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+            ports.extend(p for p in matches if p not in ports)
+    return ports
+
+
+class DeviceResult(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.chip = None
+        self.mac = None
+        self.attempts = 0
+        self.passed = False
+        self.error = None
+        self.stats = None
+
+    def __str__(self):
+        ident = "%s %s" % (self.chip, bl.format_mac(self.mac)) if self.mac else "-"
+        if self.passed:
+            result = "PASS  %s" % self.stats
+        else:
+            result = "FAIL  %s" % self.error
+        return "%-16s %-30s %d  %s" % (self.port, ident, self.attempts, result)
+
+
+class BatchUploader(object):
+
+    def __init__(self, ports, retries=2, workers=None, state_dir=None, provisioning=None, log=None,
+                 **uploader_args):
+        self.ports = list(ports)
+        self.retries = retries
+        self.workers = workers or len(self.ports)
+        self.state_dir = state_dir
+        self.provisioning = provisioning
+        self.uploader_args = uploader_args
+        self.results = dict((port, DeviceResult(port)) for port in self.ports)
+        self.elapsed = 0.0
+        self._log = log or (lambda msg: None)
+        self._log_lock = threading.Lock()
+
+    def log(self, msg):
+        with self._log_lock:
+            self._log(msg)
+
+    def _program(self, port, image, layout=None):
+        result = self.results[port]
+        result.attempts += 1
+        reported = [0]
+
+        def progress(written):
+            # Report each device at 25% steps to keep the log readable
+            step = int(4 * written / max(1, len(image)))
+            if step > reported[0]:
+                reported[0] = step
+                self.log("[%s] %d%%" % (port, min(100, step * 25)))
+
+        uploader = FlashUploader(port, progress=progress, **self.uploader_args)
+        try:
+            uploader.connect()
+            result.chip, result.mac = uploader.chip, uploader.mac
+            eeprom = None
+            if self.provisioning is not None:
+                eeprom = uploader.provisioning_image(self.provisioning)
+            if self.state_dir:
+                result.stats = uploader.program_incremental(image, self.state_dir, layout)
+            else:
+                result.stats = uploader.program(image, layout=layout)
+            if eeprom is not None:
+                uploader.write_eeprom(*eeprom)
+            uploader.reset()
+        finally:
+            uploader.close()
+        result.passed = True
+        result.error = None
+        return result
+
+    def run(self, image, layout=None):
+        started = time.time()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = dict((pool.submit(self._program, port, image, layout), port) for port in self.ports)
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    port = pending.pop(future)
+                    result = self.results[port]
+                    error = future.exception()
+                    if error is None:
+                        self.log("[%s] PASS %s" % (port, result.stats))
+                        continue
+                    result.error = error
+                    # Another attempt won't find the device in the provisioning table either
+                    if result.attempts <= self.retries and not isinstance(error, ProvisionError):
+                        self.log("[%s] attempt %d failed (%s), retrying" % (
+                            port, result.attempts, error))
+                        pending[pool.submit(self._program, port, image, layout)] = port
+                    else:
+                        self.log("[%s] FAIL %s" % (port, error))
+        finally:
+            pool.shutdown()
+        self.elapsed = time.time() - started
+        return [self.results[port] for port in self.ports]
+
+    @property
+    def passed(self):
+        return [r for r in self.results.values() if r.passed]
+
+    @property
+    def failed(self):
+        return [r for r in self.results.values() if not r.passed]
+
+    def summary(self):
+        written = sum(r.stats.image_size for r in self.passed)
+        lines = ["%-16s %-30s %s  %s" % ("Port", "Device", "#", "Result")]
+        lines += [str(self.results[port]) for port in self.ports]
+        lines.append("%d passed, %d failed in %.2fs (%.1f KB/s aggregate)" % (
+            len(self.passed), len(self.failed), self.elapsed,
+            written / 1024.0 / self.elapsed if self.elapsed else 0.0))
+        return "\n".join(lines)
+
+
+def upload_batch(ports, path, log=None, **kwargs):
+    with open(path, "rb") as fp:
+        image = fp.read()
+    batch = BatchUploader(expand_ports(ports), log=log, **kwargs)
+    if not batch.ports:
+        raise bl.BootloaderError("No upload ports matched %s" % (ports,))
+    batch.run(image, load_layout(layout_path(path), image))
+    if log:
+        log(batch.summary())
+    return batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Program many JN516x devices in parallel")
+    parser.add_argument("--ports", required=True, action="append",
+                        help="Serial ports or globs (may be repeated)")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--min-speed", type=int, default=bl.BOOTLOADER_BAUD)
+    parser.add_argument("--max-speed", type=int, default=bl.MAX_BAUD)
+    parser.add_argument("--state-dir")
+    parser.add_argument("--provision", metavar="TABLE",
+                        help="Also write each device's EEPROM provisioning image from this table")
+    parser.add_argument("image")
+    args = parser.parse_args(argv)
+
+    speeds = [r for r in bl.BAUD_RATES if args.min_speed <= r <= args.max_speed]
+    try:
+        provisioning = ProvisioningTable.load(args.provision) if args.provision else None
+        batch = upload_batch(args.ports, args.image, log=print, retries=args.retries,
+                             workers=args.workers, state_dir=args.state_dir, speeds=speeds,
+                             provisioning=provisioning)
+    except (bl.BootloaderError, ProvisionError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 1 if batch.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
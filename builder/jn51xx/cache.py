@@ -0,0 +1,155 @@
+"""
+Content-addressed store for build artifacts shared between projects
+
+Each entry is a directory named after a key (a hash of everything that went
+into producing the artifacts) holding one or more files. Entries are written
+to a temporary directory and renamed into place, so concurrent builds never
+see a partially written entry.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from os.path import basename, exists, getmtime, isdir, join
+
+
+def make_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode("utf-8")
+        h.update(str(len(part)).encode("ascii") + b":")
+        h.update(part)
+    return h.hexdigest()
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_id(path):
+    """Cheap identity of a file that isn't expected to change (tools, SDK libraries)"""
+    st = os.stat(path)
+    return "%s:%d:%d" % (path, st.st_size, int(st.st_mtime))
+
+
+class ArtifactCache(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, key):
+        return join(self.root, key[:2], key)
+
+    def lookup(self, key, name):
+        """Path of `name` in the entry for `key`, or None"""
+        path = join(self.entry(key), name)
+        if not exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(self.entry(key))
+        return path
+
+    def get(self, key, targets):
+        """Copy the cached files for `key` over `targets`, matched by file name"""
+        entry = self.entry(key)
+        sources = [join(entry, basename(str(t))) for t in targets]
+        if not all(exists(s) for s in sources):
+            self.misses += 1
+            return False
+        for src, dst in zip(sources, targets):
+            dst = str(dst)
+            if not isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copyfile(src, dst)
+        self.hits += 1
+        self._touch(entry)
+        return True
+
+    def put(self, key, files):
+        entry = self.entry(key)
+        if exists(entry):
+            return entry
+        parent = os.path.dirname(entry)
+        if not isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            for f in files:
+                shutil.copyfile(str(f), join(tmp, basename(str(f))))
+            os.rename(tmp, entry)
+        except OSError:
+            # Another build stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry
+
+    def read(self, key, name):
+        """Contents of a small cached blob, or None"""
+        path = self.lookup(key, name)
+        if path is None:
+            return None
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def write(self, key, name, data):
+        if not isdir(self.root):
+            os.makedirs(self.root)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            with open(join(tmp, name), "wb") as fp:
+                fp.write(data)
+            self.put(key, [join(tmp, name)])
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def size(self):
+        total = 0
+        for entry in self._entries():
+            for name in os.listdir(entry):
+                total += os.path.getsize(join(entry, name))
+        return total
+
+    def prune(self, max_size):
+        """Remove least recently used entries until the cache fits in `max_size` bytes"""
+        entries = []
+        total = 0
+        for entry in self._entries():
+            try:
+                size = sum(os.path.getsize(join(entry, name)) for name in os.listdir(entry))
+                entries.append((getmtime(entry), size, entry))
+            except OSError:
+                # Removed by another build pruning at the same time
+                continue
+            total += size
+        removed = 0
+        for _, size, entry in sorted(entries):
+            if total <= max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def _entries(self):
+        if not isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            if len(prefix) != 2 or not isdir(join(self.root, prefix)):
+                continue
+            for key in os.listdir(join(self.root, prefix)):
+                if not key.startswith("."):
+                    yield join(self.root, prefix, key)
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
@@ -0,0 +1,249 @@
+"""
+Tokenized debug log: token dictionary and decoder
+
+With `jennic_debug_tokenize = yes` DBG_vPrintf sends a token and its packed
+arguments instead of the formatted line (see
+frameworks/jennic/include/dbg_tokenized.h). The format strings stay in the
+ELF, in the non-loaded .dbg_fmt section, at the address used as their token;
+the build extracts them to firmware.tokens.json, and this rebuilds the log:
+
+    0xFE, payload length, token (varint), then per argument:
+        a varint (unsigned 32-bit value), or a NUL-terminated string for %s
+
+Bytes outside frames (eg. output of plain vAHI_UartWriteData) are passed through.
+
+    python -m jn51xx.dbglog firmware.tokens.json --port /dev/ttyUSB0
+"""
+
+import argparse
+import json
+import re
+import sys
+
+from . import elf
+
+SECTION = ".dbg_fmt"
+SYMBOL_PREFIX = "_dbg_acFormat"
+SYNC = 0xFE
+DICT_VERSION = 1
+DEFAULT_BAUD = 115200
+
+# printf conversions supported by the DBG library
+FORMAT_RE = re.compile(r"%([-+ #0]*)(\d+|\*)?(?:\.(\d+))?(hh|h|ll|l|z)?([diouxXcsp%])")
+
+
+class DbgLogError(Exception):
+    pass
+
+
+def extract(elf_path):
+    """{token: format} from the .dbg_fmt section of an ELF"""
+    try:
+        image = elf.ElfFile.open(elf_path)
+    except (IOError, elf.ElfError) as e:
+        raise DbgLogError("%s: %s" % (elf_path, e))
+    sec = image.section(SECTION)
+    if sec is None:
+        raise DbgLogError("%s has no %s section (built without jennic_debug_tokenize?)" % (
+            elf_path, SECTION))
+    data = image.section_data(sec).tobytes()
+
+    def string_at(addr):
+        start = addr - sec.addr
+        end = data.find(b"\0", start)
+        return data[start:end if end >= 0 else len(data)].decode("latin-1")
+
+    tokens = {}
+    for sym in image.symbols():
+        if sym.shndx == sec.index and sym.name.startswith(SYMBOL_PREFIX):
+            tokens[sym.value] = string_at(sym.value)
+    if not tokens:
+        # Stripped: every string in the section, skipping alignment padding
+        pos = 0
+        while pos < len(data):
+            if data[pos:pos + 1] == b"\0":
+                pos += 1
+                continue
+            tokens[sec.addr + pos] = string_at(sec.addr + pos)
+            pos += len(tokens[sec.addr + pos]) + 1
+    return tokens
+
+
+def save(tokens, path):
+    with open(path, "w") as fp:
+        json.dump(dict(version=DICT_VERSION, tokens=dict(
+            ("0x%x" % token, fmt) for token, fmt in sorted(tokens.items()))), fp, indent=1)
+
+
+def load(path):
+    """Token dictionary from a firmware.tokens.json, or straight from the ELF"""
+    if path.endswith(".elf"):
+        return extract(path)
+    try:
+        with open(path) as fp:
+            table = json.load(fp)
+    except (IOError, ValueError) as e:
+        raise DbgLogError("%s: %s" % (path, e))
+    if table.get("version") != DICT_VERSION:
+        raise DbgLogError("%s: unsupported token dictionary version %s" % (path, table.get("version")))
+    return dict((int(token, 0), fmt) for token, fmt in table["tokens"].items())
+
+
+def summary(tokens):
+    """(format strings, bytes) kept out of flash"""
+    return len(tokens), sum(len(fmt) + 1 for fmt in tokens.values())
+
+
+class _Args(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.truncated = False
+
+    def varint(self):
+        value, shift = 0, 0
+        while self.pos < len(self.data):
+            b = self.data[self.pos]
+            self.pos += 1
+            value |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                return value & 0xFFFFFFFF
+        self.truncated = True
+        return 0
+
+    def string(self):
+        end = self.data.find(b"\0", self.pos)
+        if end < 0:
+            self.truncated = True
+            end = len(self.data)
+        value = bytes(self.data[self.pos:end]).decode("latin-1")
+        self.pos = end + 1
+        return value
+
+
+def _signed(value, length):
+    bits = {"hh": 8, "h": 16}.get(length, 32)
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def format_message(fmt, args):
+    """printf `fmt` with the arguments packed in `args`"""
+    reader = _Args(args)
+
+    def convert(m):
+        flags, width, precision, length, conv = m.groups()
+        if conv == "%":
+            return "%"
+        if width == "*":
+            width = str(_signed(reader.varint(), None))
+        spec = "%" + flags.replace("#", "#" if conv in "oxX" else "") + (width or "")
+        if conv == "s":
+            value = reader.string()
+            return (spec + ("." + precision if precision else "") + "s") % value
+        value = reader.varint()
+        if conv == "c":
+            return (spec + "c") % chr(value & 0xFF)
+        if conv == "p":
+            return (spec + "s") % ("0x%08x" % value)
+        if conv in "di":
+            value = _signed(value, length)
+            conv = "d"
+        elif length in ("h", "hh"):
+            value &= 0xFF if length == "hh" else 0xFFFF
+        if precision:
+            spec += "." + precision
+        return (spec + conv) % value
+
+    text = FORMAT_RE.sub(convert, fmt)
+    if reader.truncated:
+        text += "<truncated>"
+    return text
+
+
+class Decoder(object):
+    """Rebuilds log text from the bytes read from the UART"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.buffer = bytearray()
+        self.frames = 0
+        self.unknown = 0
+
+    def feed(self, data):
+        """Text for the complete frames (and plain bytes) in `data`"""
+        self.buffer += data
+        out = []
+        while self.buffer:
+            start = self.buffer.find(bytes(bytearray([SYNC])))
+            if start != 0:
+                end = len(self.buffer) if start < 0 else start
+                out.append(bytes(self.buffer[:end]).decode("latin-1"))
+                del self.buffer[:end]
+                continue
+            if len(self.buffer) < 2 or len(self.buffer) < 2 + self.buffer[1]:
+                break
+            payload = self.buffer[2:2 + self.buffer[1]]
+            del self.buffer[:2 + len(payload)]
+            out.append(self.decode_frame(payload))
+        return "".join(out)
+
+    def decode_frame(self, payload):
+        self.frames += 1
+        reader = _Args(payload)
+        token = reader.varint()
+        fmt = self.tokens.get(token)
+        if fmt is None:
+            self.unknown += 1
+            return "<unknown token 0x%x: %s>\n" % (
+                token, " ".join("%02x" % b for b in payload[reader.pos:]))
+        return format_message(fmt, payload[reader.pos:])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode a tokenized JN516x debug log")
+    parser.add_argument("tokens", help="Token dictionary (firmware.tokens.json) or the firmware.elf")
+    parser.add_argument("--port", help="Serial port to read the log from")
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD)
+    parser.add_argument("--file", help="Decode a captured log instead")
+    parser.add_argument("--extract", metavar="JSON", help="Write the token dictionary of an ELF")
+    args = parser.parse_args(argv)
+
+    try:
+        tokens = load(args.tokens)
+    except DbgLogError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+    if args.extract:
+        save(tokens, args.extract)
+        print("%d format strings (%d bytes)" % summary(tokens))
+        return 0
+
+    decoder = Decoder(tokens)
+    if args.file:
+        with open(args.file, "rb") as fp:
+            sys.stdout.write(decoder.feed(fp.read()))
+        return 0
+    if not args.port:
+        parser.error("--port or --file is required")
+
+    from .uploader import open_port
+    port = open_port(args.port, args.baud, timeout=0.1)
+    try:
+        while True:
+            text = decoder.feed(port.read(256))
+            if text:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
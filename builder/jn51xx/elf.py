@@ -0,0 +1,177 @@
+"""
+Minimal ELF32 reader
+
+Reads section headers and symbol tables straight out of a buffer (bytes,
+memoryview or mmap) without copying, for either byte order. The BA2 core in
+the JN516x is big-endian.
+"""
+
+import mmap
+import struct
+from collections import namedtuple
+
+ELFMAG = b"\x7fELF"
+ELFCLASS32 = 1
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+# Section types
+SHT_NULL = 0
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_NOBITS = 8
+
+# Section flags
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+# Segment types
+PT_LOAD = 1
+
+SHN_UNDEF = 0
+SHN_ABS = 0xFFF1
+SHN_COMMON = 0xFFF2
+
+# Symbol binding/type
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+
+# GCC's LTO symbol table (.gnu.lto_.symtab*), which is all an object compiled
+# with -flto (but not -ffat-lto-objects) lists its symbols in: per symbol the
+# name and comdat group (NUL-terminated), kind and visibility (a byte each),
+# then size (8 bytes) and slot (4 bytes)
+LTO_SYMTAB = ".gnu.lto_.symtab"
+LDPK_DEF = 0
+LDPK_WEAKDEF = 1
+LDPK_UNDEF = 2
+LDPK_WEAKUNDEF = 3
+LDPK_COMMON = 4
+
+
+class ElfError(Exception):
+    pass
+
+
+Section = namedtuple("Section", [
+    "index", "name", "type", "flags", "addr", "offset", "size", "link", "info", "entsize"])
+
+Segment = namedtuple("Segment", [
+    "type", "offset", "vaddr", "paddr", "filesz", "memsz", "flags", "align"])
+
+Symbol = namedtuple("Symbol", ["name", "value", "size", "bind", "type", "shndx"])
+
+
+class ElfFile(object):
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        ident = self.data[:16].tobytes()
+        if ident[:4] != ELFMAG:
+            raise ElfError("Not an ELF file")
+        if bytearray(ident)[4] != ELFCLASS32:
+            raise ElfError("Only 32-bit ELF files are supported")
+        self.endian = ">" if bytearray(ident)[5] == ELFDATA2MSB else "<"
+
+        (self.e_type, self.e_machine, _, self.e_entry, self.e_phoff, self.e_shoff,
+         self.e_flags, _, self.e_phentsize, self.e_phnum, self.e_shentsize, self.e_shnum,
+         self.e_shstrndx) = self.unpack("HHIIIIIHHHHHH", 16)
+
+        self.sections = self._read_sections()
+        self.segments = [Segment(*self.unpack("IIIIIIII", self.e_phoff + i * self.e_phentsize))
+                         for i in range(self.e_phnum)]
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map an ELF file; the mapping lives as long as the ElfFile"""
+        with open(path, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def _read_sections(self):
+        raw = []
+        for i in range(self.e_shnum):
+            raw.append(self.unpack("IIIIIIIIII", self.e_shoff + i * self.e_shentsize))
+        if not raw:
+            return []
+        strtab = raw[self.e_shstrndx]
+        names = self.data[strtab[4]:strtab[4] + strtab[5]].tobytes()
+        return [Section(i, self._cstr(names, sh[0]), sh[1], sh[2], sh[3], sh[4], sh[5],
+                        sh[6], sh[7], sh[9]) for i, sh in enumerate(raw)]
+
+    @staticmethod
+    def _cstr(table, offset):
+        end = table.find(b"\0", offset)
+        return table[offset:end if end >= 0 else len(table)].decode("latin-1")
+
+    def section(self, name):
+        for sec in self.sections:
+            if sec.name == name:
+                return sec
+        return None
+
+    def section_data(self, sec):
+        if sec.type == SHT_NOBITS:
+            return memoryview(b"")
+        return self.data[sec.offset:sec.offset + sec.size]
+
+    def section_lma(self, sec):
+        """Load address of a section (where its initial contents live in flash)"""
+        for seg in self.segments:
+            if (seg.type == PT_LOAD and seg.filesz and
+                    seg.offset <= sec.offset < seg.offset + seg.filesz):
+                return seg.paddr + sec.offset - seg.offset
+        return sec.addr
+
+    def symbols(self):
+        for sec in self.sections:
+            if sec.type != SHT_SYMTAB:
+                continue
+            strings = self.section_data(self.sections[sec.link]).tobytes()
+            for off in range(sec.offset + sec.entsize, sec.offset + sec.size, sec.entsize):
+                name, value, size, info, _, shndx = self.unpack("IIIBBH", off)
+                yield Symbol(self._cstr(strings, name), value, size, info >> 4, info & 0xF, shndx)
+
+    def lto_symbols(self):
+        """(name, kind) of the symbols in the LTO symbol tables"""
+        for sec in self.sections:
+            if not sec.name.startswith(LTO_SYMTAB):
+                continue
+            table = self.section_data(sec).tobytes()
+            pos = 0
+            while pos < len(table):
+                name_end = table.index(b"\0", pos)
+                comdat_end = table.index(b"\0", name_end + 1)
+                yield table[pos:name_end].decode("latin-1"), bytearray(table)[comdat_end + 1]
+                pos = comdat_end + 1 + 2 + 8 + 4
+
+    def global_symbols(self):
+        """(defined, undefined) sets of global and weak symbol names, from the
+        ELF and LTO symbol tables; weak references are left out of undefined,
+        as they don't make the linker pull anything in"""
+        defined, undefined = set(), set()
+        for sym in self.symbols():
+            if sym.bind not in (STB_GLOBAL, STB_WEAK) or not sym.name:
+                continue
+            if sym.shndx != SHN_UNDEF:
+                defined.add(sym.name)
+            elif sym.bind == STB_GLOBAL:
+                undefined.add(sym.name)
+        try:
+            for name, kind in self.lto_symbols():
+                if kind == LDPK_UNDEF:
+                    undefined.add(name)
+                elif kind != LDPK_WEAKUNDEF:
+                    defined.add(name)
+        except (ValueError, IndexError):
+            raise ElfError("Corrupt LTO symbol table")
+        return defined, undefined - defined
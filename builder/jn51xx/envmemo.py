@@ -0,0 +1,136 @@
+"""
+Memo of the framework's resolved build environment
+
+Working out the include paths, library paths, SDK libraries, defines and
+linker script for a project means walking the project options through the
+SDK layout and checking the SDK on disk. The result only depends on those
+options and the SDK/toolchain, so the framework script records what it
+added to the environment and replays it on later runs with the same inputs.
+"""
+
+import json
+import os
+
+from .cache import make_key
+
+# Bumped whenever the stored format changes
+MEMO_VERSION = 2
+
+# Construction variables the framework resolves
+MEMO_VARS = [
+    "ASFLAGS", "CFLAGS", "CCFLAGS", "CXXFLAGS", "LINKFLAGS", "CPPDEFINES",
+    "CPPPATH", "LIBPATH", "JNLIBS", "LIBS", "LDSCRIPT_PATH",
+]
+
+MEMO_NAME = "config.json"
+
+
+def stat_id(path):
+    """Identity of a file or directory, or "" if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return "%s:%d:%d" % (path, st.st_size, int(st.st_mtime))
+
+
+def tree_id(root, suffix=".py"):
+    """Identity of the `suffix` files under a directory, eg. the platform's own scripts"""
+    ids = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        ids += [stat_id(os.path.join(dirpath, f)) for f in sorted(filenames) if f.endswith(suffix)]
+    return make_key(*ids)
+
+
+def _values(env, var):
+    value = env.get(var, [])
+    if value is None:
+        return []
+    if isinstance(value, (str, bytes)):
+        return [value]
+    return list(value)
+
+
+def snapshot(env):
+    return dict((var, _values(env, var)) for var in MEMO_VARS)
+
+
+def fingerprint(env):
+    """Key part for the environment the framework starts from"""
+    return make_key(*[repr(_values(env, var)) for var in MEMO_VARS])
+
+
+def _split(before, after):
+    """(prepended, appended) values if `after` is `before` with items added at
+    either end, else None"""
+    n = len(before)
+    for start in range(len(after) - n + 1):
+        if after[start:start + n] == before:
+            return after[:start], after[start + n:]
+    return None
+
+
+def changes(before, env):
+    """What the framework added to each variable since `before`, or None if
+    a value was replaced or removed (so it can't be replayed)"""
+    result = {}
+    for var in MEMO_VARS:
+        split = _split(before[var], _values(env, var))
+        if split is None:
+            if var != "LDSCRIPT_PATH":
+                return None
+            # The linker script is replaced, not added to
+            result[var] = dict(replace=_values(env, var))
+            continue
+        prepend, append = split
+        if prepend or append:
+            result[var] = dict(prepend=prepend, append=append)
+    return result
+
+
+def _restore(var, values):
+    if var == "CPPDEFINES":
+        # (name, value) defines come back from JSON as lists
+        return [tuple(v) if isinstance(v, list) else v for v in values]
+    return values
+
+
+def apply(env, memo):
+    for var, change in memo["env"].items():
+        if "replace" in change:
+            env.Replace(**{var: _restore(var, change["replace"])})
+            continue
+        if change["prepend"]:
+            env.Prepend(**{var: _restore(var, change["prepend"])})
+        if change["append"]:
+            env.Append(**{var: _restore(var, change["append"])})
+
+
+def load(cache, key):
+    data = cache.read(key, MEMO_NAME)
+    if data is None:
+        return None
+    try:
+        memo = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if memo.get("version") != MEMO_VERSION:
+        return None
+    return memo
+
+
+def save(cache, key, before, env, values):
+    """Store the changes made to `env` since `before`, with other resolved
+    `values`; returns False if they can't be memoized"""
+    env_changes = changes(before, env)
+    if env_changes is None:
+        return False
+    memo = dict(version=MEMO_VERSION, env=env_changes, values=values)
+    try:
+        data = json.dumps(memo, sort_keys=True).encode("utf-8")
+    except (TypeError, ValueError):
+        # Something other than strings and numbers got into the environment
+        return False
+    cache.write(key, MEMO_NAME, data)
+    return True
@@ -0,0 +1,220 @@
+"""
+Flash programming throughput benchmark
+
+Programs an image (the build's firmware.bin, or a synthetic one of a given
+size) into a simulated bootloader behind a modelled serial link
+(simulator.SimulatedLink) for every combination of baud rate, write block
+size, verify strategy and chip (flash size), through the same FlashUploader
+as `pio run -t upload`. Each run reports the modelled programming time (wire
+and device time on the link's virtual clock, independent of the host) and
+the host CPU time the uploader took.
+
+    python -m jn51xx.flashbench --image .pio/build/<env>/firmware.bin --json flashbench.json
+    python -m jn51xx.flashbench --size 150000 --baseline flashbench.json --max-regression 5%
+"""
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import time
+
+from . import protocol as bl
+from .image import load_layout
+from .simulator import SimulatedLink
+from .uploader import FlashUploader, layout_path
+
+RESULTS_VERSION = 1
+
+DEFAULT_SPEEDS = [115200, 250000, 500000, 1000000]
+DEFAULT_BLOCK_SIZES = [64, 128, bl.MAX_BLOCK_SIZE]
+DEFAULT_CHIPS = ["JN5168", "JN5169"]
+
+# none: program only; readback: read every block back and compare
+VERIFY_STRATEGIES = ["none", "readback"]
+
+DEFAULT_MAX_REGRESSION = "5%"
+
+
+class FlashBenchError(Exception):
+    pass
+
+
+def synthetic_image(size, seed=0):
+    """An image of `size` bytes that looks like firmware: mostly code, with
+    some erased (0xFF) stretches the uploader can skip"""
+    rng = random.Random(seed)
+    image = bytearray()
+    while len(image) < size:
+        if rng.random() < 0.1:
+            image += b"\xff" * rng.randint(256, 2048)
+        else:
+            image += bytearray(rng.getrandbits(8) for _ in range(rng.randint(512, 4096)))
+    return bytes(image[:size])
+
+
+def run_one(image, layout, chip, speed, block_size, verify, window=2):
+    link = SimulatedLink(chip=chip, max_baud=speed)
+    uploader = FlashUploader(link, speeds=[speed], block_size=block_size, window=window,
+                             verify=verify == "readback")
+    started = time.process_time()
+    with uploader:
+        stats = uploader.program(image, layout=layout)
+    host_time = time.process_time() - started
+    if bytes(link.device.flash[:len(image)]) != bytes(image):
+        raise FlashBenchError("%s: flash doesn't match the image after programming" % chip)
+    return dict(
+        chip=chip,
+        flash_size=link.device.flash_size,
+        image_size=len(image),
+        speed=stats.baudrate,
+        block_size=block_size,
+        verify=verify,
+        window=window,
+        seconds=link.clock,
+        throughput=len(image) / link.clock if link.clock else 0.0,
+        host_seconds=host_time,
+        written=stats.written,
+        verified=stats.verified,
+        requests=link.device.stats["requests"],
+        tx_bytes=link.tx_bytes,
+        rx_bytes=link.rx_bytes,
+    )
+
+
+def run(image, layout=None, chips=None, speeds=None, block_sizes=None, verify=None, window=2,
+        log=None):
+    flash_sizes = dict(bl.CHIPS.values())
+    results = []
+    for chip in chips or DEFAULT_CHIPS:
+        if chip not in flash_sizes:
+            raise FlashBenchError("Unknown chip '%s'" % chip)
+        flash_size = flash_sizes[chip]
+        if len(image) > flash_size:
+            if log:
+                log("Skipping %s: image doesn't fit in its %dKB flash" % (chip, flash_size // 1024))
+            continue
+        for speed, block_size, strategy in itertools.product(
+                speeds or DEFAULT_SPEEDS, block_sizes or DEFAULT_BLOCK_SIZES, verify or VERIFY_STRATEGIES):
+            result = run_one(image, layout, chip, speed, block_size, strategy, window)
+            if log:
+                log("%s %7d baud, %3d byte blocks, verify %-8s %6.2fs" % (
+                    chip, speed, block_size, strategy, result["seconds"]))
+            results.append(result)
+    if not results:
+        raise FlashBenchError("The image (%d bytes) doesn't fit in any of the chips" % len(image))
+    return results
+
+
+def result_key(result):
+    return (result["chip"], result["speed"], result["block_size"], result["verify"], result["window"])
+
+
+def parse_threshold(value):
+    """Allowed throughput drop, as a fraction ("5%" or 0.05)"""
+    value = str(value).strip()
+    if value.endswith("%"):
+        return float(value[:-1]) / 100
+    return float(value)
+
+
+def compare(results, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """Configurations whose throughput dropped more than `max_regression`"""
+    limit = parse_threshold(max_regression)
+    base = dict((result_key(r), r) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        old = base.get(result_key(r))
+        if old is None or old["image_size"] != r["image_size"] or not old["throughput"]:
+            continue
+        change = r["throughput"] / old["throughput"] - 1
+        if change < -limit:
+            regressions.append(dict(r, baseline_throughput=old["throughput"], change=change))
+    return regressions
+
+
+def format_results(results):
+    lines = ["%-7s %8s %6s %-9s %9s %10s %9s" % (
+        "Chip", "Baud", "Block", "Verify", "Time", "KB/s", "Host CPU")]
+    for r in results:
+        lines.append("%-7s %8d %6d %-9s %8.2fs %10.1f %8.2fs" % (
+            r["chip"], r["speed"], r["block_size"], r["verify"], r["seconds"],
+            r["throughput"] / 1024, r["host_seconds"]))
+    for chip in sorted(set(r["chip"] for r in results)):
+        best = max([r for r in results if r["chip"] == chip], key=lambda r: r["throughput"])
+        lines.append("Fastest on %s: %d baud, %d byte blocks, verify %s (%.2fs)" % (
+            chip, best["speed"], best["block_size"], best["verify"], best["seconds"]))
+    return "\n".join(lines)
+
+
+def save(results, path, image_name=None):
+    with open(path, "w") as fp:
+        json.dump(dict(version=RESULTS_VERSION, image=image_name, results=results), fp, indent=1)
+
+
+def load(path):
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except (IOError, ValueError) as e:
+        raise FlashBenchError("%s: %s" % (path, e))
+    if data.get("version") != RESULTS_VERSION:
+        raise FlashBenchError("%s: unsupported results version %s" % (path, data.get("version")))
+    return data
+
+
+def int_list(text):
+    return [int(v, 0) for v in text.replace(",", " ").split()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark flash programming against a simulated JN516x")
+    parser.add_argument("--image", help="Image to program (default: a synthetic one of --size bytes)")
+    parser.add_argument("--size", type=int, default=160 * 1024, help="Size of the synthetic image")
+    parser.add_argument("--chips", default=",".join(DEFAULT_CHIPS))
+    parser.add_argument("--speeds", type=int_list, default=DEFAULT_SPEEDS)
+    parser.add_argument("--block-sizes", type=int_list, default=DEFAULT_BLOCK_SIZES)
+    parser.add_argument("--verify", default=",".join(VERIFY_STRATEGIES),
+                        help="Verify strategies (%s)" % ", ".join(VERIFY_STRATEGIES))
+    parser.add_argument("--window", type=int, default=2)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Fail if throughput dropped against these results")
+    parser.add_argument("--max-regression", default=DEFAULT_MAX_REGRESSION)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.image:
+            with open(args.image, "rb") as fp:
+                image = fp.read()
+            layout = load_layout(layout_path(args.image), image)
+        else:
+            image, layout = synthetic_image(args.size), None
+        verify = [v.strip() for v in args.verify.split(",") if v.strip()]
+        for strategy in verify:
+            if strategy not in VERIFY_STRATEGIES:
+                raise FlashBenchError("Unknown verify strategy '%s'" % strategy)
+        baseline = load(args.baseline) if args.baseline else None
+        results = run(image, layout, [c.strip() for c in args.chips.split(",")], args.speeds,
+                      args.block_sizes, verify, args.window, log=print)
+    except (FlashBenchError, bl.BootloaderError, IOError, ValueError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+    print("")
+    print(format_results(results))
+    if args.json:
+        save(results, args.json, args.image)
+    if baseline:
+        regressions = compare(results, baseline, args.max_regression)
+        for r in regressions:
+            sys.stderr.write("Error: %s at %d baud, %d byte blocks, verify %s: %.1f KB/s, %.1f%% slower "
+                             "than the baseline\n" % (r["chip"], r["speed"], r["block_size"], r["verify"],
+                                                       r["throughput"] / 1024, -100 * r["change"]))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
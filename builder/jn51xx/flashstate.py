@@ -0,0 +1,69 @@
+"""
+Record of the image last programmed into each device
+
+The ROM bootloader has no checksum command, and reading the flash back costs
+as much as writing it, so differential uploads compare against a local record
+of what was last flashed to a device (keyed by its MAC address) instead.
+"""
+
+import hashlib
+import json
+import os
+from os.path import exists, join
+
+from .protocol import FLASH_SECTOR_SIZE, format_mac
+
+
+def sector_hashes(image, sector_size=FLASH_SECTOR_SIZE):
+    """SHA-1 of each sector of `image`, padded to a whole sector with 0xFF"""
+    view = memoryview(image)
+    hashes = []
+    for pos in range(0, len(image), sector_size):
+        h = hashlib.sha1(view[pos:pos + sector_size])
+        tail = pos + sector_size - len(image)
+        if tail > 0:
+            h.update(b"\xff" * tail)
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+class FlashState(object):
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+
+    def _path(self, mac):
+        return join(self.state_dir, format_mac(mac).replace(":", "") + ".json")
+
+    def load(self, mac, chip_id):
+        path = self._path(mac)
+        if not exists(path):
+            return None
+        try:
+            with open(path) as fp:
+                state = json.load(fp)
+        except ValueError:
+            return None
+        if state.get("chip_id") != chip_id:
+            return None
+        return state
+
+    def save(self, mac, chip_id, image, sector_size=FLASH_SECTOR_SIZE):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        state = dict(
+            chip_id=chip_id,
+            size=len(image),
+            sha1=hashlib.sha1(image).hexdigest(),
+            sector_size=sector_size,
+            sectors=sector_hashes(image, sector_size),
+        )
+        tmp = self._path(mac) + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(state, fp, indent=1)
+        os.replace(tmp, self._path(mac))
+        return state
+
+    def forget(self, mac):
+        if exists(self._path(mac)):
+            os.remove(self._path(mac))
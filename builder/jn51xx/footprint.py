@@ -0,0 +1,196 @@
+"""
+Flash and RAM footprint of a linked firmware image
+
+Reads firmware.elf directly (no ba-elf-size subprocess) and reports usage per
+section and per symbol. If the linker map file is available, usage is also
+broken down by the archive or object each input section came from.
+
+    python -m jn51xx.footprint firmware.elf --map firmware.map --json size.json
+"""
+
+import argparse
+import json
+import re
+import sys
+from collections import defaultdict
+from os.path import basename, exists
+
+from . import elf
+
+# Input section lines in a GNU ld map file, eg.
+#  .text.vAppMain  0x00080100       0x44 libZPSAPL_JN516x.a(zps_apl_af.o)
+# Long section names are wrapped, with the address on the following line.
+MAP_INPUT_RE = re.compile(r"^ (\.\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*)$")
+MAP_NAME_RE = re.compile(r"^ (\.\S+)\s*$")
+MAP_OUTPUT_RE = re.compile(r"^(\.\S+)")
+
+
+def section_regions(sec):
+    """Whether a section occupies (flash, RAM)"""
+    if not sec.flags & elf.SHF_ALLOC or not sec.size:
+        return False, False
+    in_flash = sec.type != elf.SHT_NOBITS
+    in_ram = bool(sec.flags & elf.SHF_WRITE)
+    return in_flash, in_ram
+
+
+def parse_map(path):
+    """Yield (output_section, input_section, size, origin) from a linker map"""
+    output = None
+    pending = None
+    in_memory_map = False
+    with open(path) as fp:
+        for line in fp:
+            line = line.rstrip("\n")
+            if line.startswith("Linker script and memory map"):
+                in_memory_map = True
+                continue
+            if not in_memory_map:
+                continue
+            m = MAP_OUTPUT_RE.match(line)
+            if m:
+                output = m.group(1)
+                pending = None
+                continue
+            m = MAP_NAME_RE.match(line)
+            if m:
+                pending = m.group(1)
+                continue
+            m = MAP_INPUT_RE.match(line)
+            if m and output:
+                name = m.group(1) or pending
+                pending = None
+                size = int(m.group(3), 16)
+                origin = m.group(4).strip()
+                if not size or origin.startswith("*") or name is None:
+                    continue
+                yield output, name, size, origin
+
+
+def origin_name(origin):
+    """Archive (or object) an input section came from"""
+    if "(" in origin and origin.endswith(")"):
+        return basename(origin[:origin.index("(")])
+    if ".ltrans" in origin:
+        return "(lto)"
+    return basename(origin)
+
+
+def analyze(elf_path, map_path=None, max_flash=None, max_ram=None, top=None):
+    image = elf.ElfFile.open(elf_path)
+
+    sections = []
+    regions = {}
+    flash = ram = 0
+    for sec in image.sections:
+        in_flash, in_ram = section_regions(sec)
+        if not (in_flash or in_ram):
+            continue
+        regions[sec.index] = (in_flash, in_ram)
+        regions[sec.name] = (in_flash, in_ram)
+        flash += sec.size if in_flash else 0
+        ram += sec.size if in_ram else 0
+        lma = image.section_lma(sec) if in_flash else sec.addr
+        sections.append(dict(name=sec.name, address=sec.addr, lma=lma,
+                             size=sec.size, flash=in_flash, ram=in_ram))
+
+    symbols = []
+    for sym in image.symbols():
+        if not sym.size or sym.type not in (elf.STT_FUNC, elf.STT_OBJECT):
+            continue
+        if sym.shndx not in regions:
+            continue
+        in_flash, in_ram = regions[sym.shndx]
+        symbols.append(dict(name=sym.name, address=sym.value, size=sym.size,
+                            section=image.sections[sym.shndx].name,
+                            type="function" if sym.type == elf.STT_FUNC else "object",
+                            flash=in_flash, ram=in_ram))
+    symbols.sort(key=lambda s: -s["size"])
+
+    archives = None
+    if map_path and exists(map_path):
+        usage = defaultdict(lambda: dict(flash=0, ram=0))
+        for output, _, size, origin in parse_map(map_path):
+            in_flash, in_ram = regions.get(output, (False, False))
+            entry = usage[origin_name(origin)]
+            entry["flash"] += size if in_flash else 0
+            entry["ram"] += size if in_ram else 0
+        archives = sorted(
+            (dict(name=name, **u) for name, u in usage.items() if u["flash"] or u["ram"]),
+            key=lambda a: -(a["flash"] + a["ram"]))
+
+    return dict(
+        elf=elf_path,
+        flash=flash,
+        ram=ram,
+        maximum_size=max_flash,
+        maximum_ram_size=max_ram,
+        sections=sections,
+        symbols=symbols[:top] if top else symbols,
+        archives=archives,
+    )
+
+
+def check_limits(report):
+    """List of messages for every limit the image exceeds"""
+    errors = []
+    if report["maximum_size"] and report["flash"] > report["maximum_size"]:
+        errors.append("Flash overflow: %d bytes used of %d" % (
+            report["flash"], report["maximum_size"]))
+    if report["maximum_ram_size"] and report["ram"] > report["maximum_ram_size"]:
+        errors.append("RAM overflow: %d bytes used of %d" % (
+            report["ram"], report["maximum_ram_size"]))
+    return errors
+
+
+def _usage(used, total):
+    if not total:
+        return "%d bytes" % used
+    return "%5.1f%% (used %d bytes from %d bytes)" % (100.0 * used / total, used, total)
+
+
+def format_report(report, top=10):
+    lines = [
+        "RAM:   %s" % _usage(report["ram"], report["maximum_ram_size"]),
+        "Flash: %s" % _usage(report["flash"], report["maximum_size"]),
+        "",
+        "%-20s %10s %8s  %s" % ("Section", "Address", "Size", "Region"),
+    ]
+    for sec in report["sections"]:
+        region = "/".join(r for r, used in (("flash", sec["flash"]), ("ram", sec["ram"])) if used)
+        lines.append("%-20s 0x%08X %8d  %s" % (sec["name"], sec["address"], sec["size"], region))
+
+    if report["archives"]:
+        lines += ["", "%-36s %8s %8s" % ("Archive", "Flash", "RAM")]
+        for a in report["archives"][:top]:
+            lines.append("%-36s %8d %8d" % (a["name"], a["flash"], a["ram"]))
+
+    lines += ["", "%-36s %8s  %s" % ("Largest symbols", "Size", "Section")]
+    for sym in report["symbols"][:top]:
+        lines.append("%-36s %8d  %s" % (sym["name"], sym["size"], sym["section"]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flash/RAM footprint of a JN516x ELF image")
+    parser.add_argument("elf")
+    parser.add_argument("--map", help="Linker map file, for a per-archive breakdown")
+    parser.add_argument("--max-flash", type=int)
+    parser.add_argument("--max-ram", type=int)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", help="Write the full report to this file")
+    args = parser.parse_args(argv)
+
+    report = analyze(args.elf, args.map, args.max_flash, args.max_ram)
+    print(format_report(report, args.top))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(report, fp, indent=1)
+    errors = check_limits(report)
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Running the SDK's config generators (PDUMConfig, OSConfig, ZPSConfig)
+
+The NXP generators are independent Windows executables writing to separate
+files, so they're launched together and waited on as one step. On other
+hosts they run under wine; a persistent wineserver is started first so the
+tools share one wine session instead of each paying its startup cost.
+"""
+
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+# Seconds the wineserver stays up after the last tool exits, so the next
+# build (or the next generator) reuses it
+WINESERVER_PERSIST = 300
+
+
+class ToolLauncher(object):
+
+    def __init__(self, wine=None):
+        if wine is None and sys.platform != "win32":
+            wine = shutil.which("wine")
+        self.wine = wine
+        self._server_started = False
+        self._lock = threading.Lock()
+
+    def command(self, exe, *args):
+        argv = [exe] + [str(a) for a in args]
+        if self.wine and exe.lower().endswith(".exe"):
+            self.start_server()
+            argv = [self.wine] + argv
+        return argv
+
+    def start_server(self):
+        with self._lock:
+            if self._server_started:
+                return
+            self._server_started = True
+            wineserver = shutil.which("wineserver")
+            if not wineserver:
+                return
+            try:
+                # Returns straight away if a server is already running
+                subprocess.call([wineserver, "-p%d" % WINESERVER_PERSIST])
+            except OSError:
+                pass
+
+
+class ToolRun(object):
+
+    def __init__(self, name, argv):
+        self.name = name
+        self.argv = argv
+        self.returncode = None
+        self.output = b""
+        self.elapsed = 0.0
+
+
+def run_parallel(runs, on_start=None, on_finish=None):
+    """Run every ToolRun at once and wait for all of them
+
+    Output is collected per tool so it isn't interleaved.
+    """
+    started = time.time()
+    procs = []
+    for run in runs:
+        if on_start:
+            on_start(run)
+        run.started = time.time()
+        try:
+            proc = subprocess.Popen(run.argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            run.returncode = 127
+            run.output = str(e).encode("utf-8")
+            if on_finish:
+                on_finish(run)
+            continue
+        procs.append((run, proc))
+
+    def wait(run, proc):
+        run.output, _ = proc.communicate()
+        run.returncode = proc.returncode
+        run.elapsed = time.time() - run.started
+        if on_finish:
+            on_finish(run)
+
+    # A thread per tool so each one's elapsed time is its own
+    threads = [threading.Thread(target=wait, args=(run, proc)) for run, proc in procs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started
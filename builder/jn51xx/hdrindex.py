@@ -0,0 +1,188 @@
+"""
+Index of the SDK's headers
+
+The SDK (framework-jennic) is read-only and versioned, so the file each
+`#include` of an SDK header resolves to, and everything that file includes
+in turn, only depends on the SDK version and the SDK include dirs in
+CPPPATH. The index records that once: dependency scanning then looks SDK
+headers up instead of searching every include dir for every include of every
+file, and the names found in more than one dir (where the first one silently
+wins) are known up front.
+
+Includes that aren't SDK headers (zcl_options.h, the generated headers, the
+toolchain's) are listed per header as "external", to be resolved by the build.
+
+    python -m jn51xx.hdrindex -I <sdk include dir> -I ... --duplicates
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from os.path import dirname, exists, isdir, join, normpath
+
+INDEX_VERSION = 1
+
+INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]+)[>"]', re.M)
+HEADER_SUFFIXES = (".h", ".hpp")
+
+
+def parse_includes(text):
+    """[(quote, name)] of the #includes in C source text (quote is '<' or '"')"""
+    return INCLUDE_RE.findall(text)
+
+
+def read_includes(path):
+    with open(path, "rb") as fp:
+        return parse_includes(fp.read().decode("latin-1"))
+
+
+class HeaderIndex(object):
+
+    def __init__(self, dirs, headers, duplicates, deps):
+        self.dirs = dirs
+        self.headers = headers          # {name: path}, the first in include order
+        self.duplicates = duplicates    # {name: [paths]} of names in more than one dir
+        self.deps = deps                # {path: dict(sdk=[[name, path]], external=[names])}
+        self._shadowed = {}
+
+    @classmethod
+    def build(cls, include_dirs):
+        dirs = [normpath(d) for d in include_dirs if isdir(d)]
+        found = {}
+        for d in dirs:
+            for name in sorted(os.listdir(d)):
+                if name.endswith(HEADER_SUFFIXES):
+                    found.setdefault(name, []).append(join(d, name))
+        headers = dict((name, paths[0]) for name, paths in found.items())
+        duplicates = dict((name, paths) for name, paths in found.items() if len(paths) > 1)
+
+        def resolve(quote, name, from_dir):
+            if quote == '"' and exists(join(from_dir, name)):
+                return normpath(join(from_dir, name))
+            if name in headers:
+                return headers[name]
+            if "/" in name:
+                for d in dirs:
+                    if exists(join(d, name)):
+                        return normpath(join(d, name))
+            return None
+
+        # Direct includes of every header reachable from the include dirs
+        direct = {}
+        pending = sorted(headers.values())
+        while pending:
+            path = pending.pop()
+            if path in direct:
+                continue
+            sdk, external = [], []
+            for quote, name in read_includes(path):
+                target = resolve(quote, name, dirname(path))
+                if target is None:
+                    external.append(name)
+                else:
+                    sdk.append((name, target))
+                    pending.append(target)
+            direct[path] = (sdk, external)
+
+        # Transitive closure of each
+        deps = {}
+        for path in direct:
+            seen = {path}
+            sdk, external = [], []
+            stack = [path]
+            while stack:
+                for name, target in direct[stack.pop()][0]:
+                    if target not in seen:
+                        seen.add(target)
+                        sdk.append([name, target])
+                        stack.append(target)
+            for target in [path] + [t for _, t in sdk]:
+                external += [n for n in direct[target][1] if n not in external]
+            deps[path] = dict(sdk=sdk, external=external)
+        return cls(dirs, headers, duplicates, deps)
+
+    def to_json(self):
+        return json.dumps(dict(version=INDEX_VERSION, dirs=self.dirs, headers=self.headers,
+                               duplicates=self.duplicates, deps=self.deps))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return cls(data["dirs"], data["headers"], data["duplicates"], data["deps"])
+
+    def shadowed(self, other_dirs):
+        """Names of SDK headers also found in non-SDK include dirs (eg. a
+        project's own copy), which must be looked up the normal way"""
+        key = tuple(other_dirs)
+        if key not in self._shadowed:
+            names = set()
+            for d in other_dirs:
+                if isdir(d):
+                    names.update(n for n in os.listdir(d) if n in self.headers)
+            self._shadowed[key] = names
+        return self._shadowed[key]
+
+    def lookup(self, name, shadowed=()):
+        """(SDK paths, external names) that including `name` brings in, or
+        None if it isn't an SDK header"""
+        if name in shadowed or name not in self.headers:
+            return None
+        return self.closure(self.headers[name], shadowed)
+
+    def closure(self, path, shadowed=()):
+        """(SDK paths, external names) of an indexed header and its includes"""
+        entry = self.deps.get(path)
+        if entry is None:
+            return None
+        paths, external = [path], list(entry["external"])
+        for name, target in entry["sdk"]:
+            if name in shadowed:
+                external.append(name)
+            else:
+                paths.append(target)
+        return paths, external
+
+    def format_duplicates(self, root=None):
+        lines = []
+        for name, paths in sorted(self.duplicates.items()):
+            if root:
+                paths = [os.path.relpath(p, root) for p in paths]
+            lines.append("%s: %s" % (name, ", ".join(paths)))
+        return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index the headers in a set of SDK include dirs")
+    parser.add_argument("-I", dest="dirs", action="append", default=[], help="Include dir, in CPPPATH order")
+    parser.add_argument("--duplicates", action="store_true", help="List headers found in more than one dir")
+    parser.add_argument("--lookup", metavar="HEADER", help="Show what including HEADER brings in")
+    parser.add_argument("-o", "--output", help="Write the index to this file")
+    args = parser.parse_args(argv)
+
+    index = HeaderIndex.build(args.dirs)
+    print("%d headers in %d dirs, %d in more than one" % (
+        len(index.headers), len(index.dirs), len(index.duplicates)))
+    if args.duplicates:
+        for line in index.format_duplicates():
+            print("  " + line)
+    if args.lookup:
+        result = index.lookup(args.lookup)
+        if result is None:
+            sys.stderr.write("Error: %s is not in the indexed dirs\n" % args.lookup)
+            return 1
+        for path in result[0]:
+            print(path)
+        for name in result[1]:
+            print("(external) %s" % name)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(index.to_json())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Flash images from a linked ELF file
+
+Builds the raw .bin, an Intel HEX file and a JSON layout manifest from the
+loadable sections of firmware.elf in one pass, without ba-elf-objcopy. The
+manifest lists the populated regions of the image and a checksum per flash
+sector, so uploaders can skip the gaps and tell which sectors changed
+without hashing the image themselves.
+
+    python -m jn51xx.image firmware.elf firmware.bin --hex firmware.hex --layout firmware.layout.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+from os.path import exists
+
+from . import elf
+from .flashstate import sector_hashes
+from .protocol import FLASH_SECTOR_SIZE
+
+LAYOUT_VERSION = 1
+HEX_RECORD_SIZE = 16
+
+
+class ImageError(Exception):
+    pass
+
+
+def load_sections(image):
+    """(lma, name, data) of every section with initial contents in flash"""
+    loadable = []
+    for sec in image.sections:
+        if not sec.flags & elf.SHF_ALLOC or sec.type == elf.SHT_NOBITS or not sec.size:
+            continue
+        loadable.append((image.section_lma(sec), sec.name, image.section_data(sec)))
+    loadable.sort(key=lambda s: s[0])
+    for (a, name_a, data_a), (b, name_b, _) in zip(loadable, loadable[1:]):
+        if a + len(data_a) > b:
+            raise ImageError("Sections %s and %s overlap at 0x%08X" % (name_a, name_b, b))
+    return loadable
+
+
+def merge_regions(sections):
+    """Group sections that are contiguous in flash into regions"""
+    regions = []
+    for lma, name, data in sections:
+        if regions and regions[-1]["address"] + regions[-1]["size"] == lma:
+            regions[-1]["size"] += len(data)
+            regions[-1]["sections"].append(name)
+        else:
+            regions.append(dict(address=lma, size=len(data), sections=[name]))
+    return regions
+
+
+def build_image(image, gap_fill=0xFF):
+    """Flat image of the loadable sections, and their layout
+
+    Gaps between sections are filled with `gap_fill`; erased flash reads as
+    0xFF, so the default lets uploaders skip them entirely.
+    """
+    sections = load_sections(image)
+    if not sections:
+        raise ImageError("ELF file has no loadable sections")
+    base = sections[0][0]
+    end = sections[-1][0] + len(sections[-1][2])
+
+    data = bytearray([gap_fill]) * (end - base)
+    for lma, _, contents in sections:
+        data[lma - base:lma - base + len(contents)] = contents
+
+    view = memoryview(data)
+    regions = merge_regions(sections)
+    for region in regions:
+        region["offset"] = region["address"] - base
+        region["crc32"] = zlib.crc32(view[region["offset"]:region["offset"] + region["size"]]) & 0xFFFFFFFF
+
+    sectors = []
+    for index, sha1 in enumerate(sector_hashes(data)):
+        start = index * FLASH_SECTOR_SIZE
+        stop = min(start + FLASH_SECTOR_SIZE, len(data))
+        populated = any(r["offset"] < stop and r["offset"] + r["size"] > start for r in regions)
+        sectors.append(dict(
+            index=index,
+            offset=start,
+            size=stop - start,
+            crc32=zlib.crc32(view[start:stop]) & 0xFFFFFFFF,
+            sha1=sha1,
+            populated=populated,
+        ))
+
+    layout = dict(
+        version=LAYOUT_VERSION,
+        base=base,
+        size=len(data),
+        entry=image.e_entry,
+        gap_fill=gap_fill,
+        sha1=hashlib.sha1(data).hexdigest(),
+        crc32=zlib.crc32(data) & 0xFFFFFFFF,
+        sector_size=FLASH_SECTOR_SIZE,
+        regions=regions,
+        sectors=sectors,
+    )
+    return data, layout
+
+
+def _hex_record(rtype, address, payload=b""):
+    record = bytearray([len(payload), (address >> 8) & 0xFF, address & 0xFF, rtype])
+    record += payload
+    record.append((-sum(record)) & 0xFF)
+    return ":" + record.hex().upper() + "\n"
+
+
+def write_hex(fp, data, layout):
+    """Intel HEX of the populated regions, at their flash (load) addresses"""
+    view = memoryview(data)
+    upper = None
+    for region in layout["regions"]:
+        for pos in range(region["offset"], region["offset"] + region["size"], HEX_RECORD_SIZE):
+            chunk = view[pos:min(pos + HEX_RECORD_SIZE, region["offset"] + region["size"])]
+            address = layout["base"] + pos
+            # Split records that would cross a 64KB boundary
+            if (address & 0xFFFF) + len(chunk) > 0x10000:
+                split = 0x10000 - (address & 0xFFFF)
+                parts = [(address, chunk[:split]), (address + split, chunk[split:])]
+            else:
+                parts = [(address, chunk)]
+            for address, part in parts:
+                if address >> 16 != upper:
+                    upper = address >> 16
+                    fp.write(_hex_record(0x04, 0, bytes(bytearray([upper >> 8, upper & 0xFF]))))
+                fp.write(_hex_record(0x00, address & 0xFFFF, part.tobytes()))
+    entry = layout["entry"]
+    fp.write(_hex_record(0x05, 0, bytes(bytearray(
+        [(entry >> 24) & 0xFF, (entry >> 16) & 0xFF, (entry >> 8) & 0xFF, entry & 0xFF]))))
+    fp.write(_hex_record(0x01, 0))
+
+
+def convert(elf_path, bin_path, hex_path=None, layout_path=None, gap_fill=0xFF):
+    image = elf.ElfFile.open(elf_path)
+    data, layout = build_image(image, gap_fill)
+    with open(bin_path, "wb") as fp:
+        fp.write(data)
+    if hex_path:
+        with open(hex_path, "w") as fp:
+            write_hex(fp, data, layout)
+    if layout_path:
+        tmp = layout_path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(layout, fp, indent=1)
+        os.replace(tmp, layout_path)
+    return layout
+
+
+def load_layout(path, image):
+    """Layout manifest at `path`, if it exists and describes `image`"""
+    if not path or not exists(path):
+        return None
+    try:
+        with open(path) as fp:
+            layout = json.load(fp)
+    except ValueError:
+        return None
+    if layout.get("version") != LAYOUT_VERSION or layout.get("size") != len(image):
+        return None
+    if layout.get("sha1") != hashlib.sha1(image).hexdigest():
+        return None
+    return layout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a JN516x ELF file to flash images")
+    parser.add_argument("elf")
+    parser.add_argument("bin")
+    parser.add_argument("--hex", help="Also write an Intel HEX file")
+    parser.add_argument("--layout", help="Also write a JSON layout manifest")
+    parser.add_argument("--gap-fill", type=lambda v: int(v, 0), default=0xFF)
+    args = parser.parse_args(argv)
+
+    try:
+        layout = convert(args.elf, args.bin, args.hex, args.layout, args.gap_fill)
+    except (ImageError, elf.ElfError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    for region in layout["regions"]:
+        print("0x%08X %8d  crc32 %08X  %s" % (
+            region["address"], region["size"], region["crc32"], " ".join(region["sections"])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
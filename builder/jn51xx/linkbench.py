@@ -0,0 +1,92 @@
+"""
+Link time and image size under each build profile
+
+Builds the project once per profile (in a separate build directory, with the
+build trace on), then deletes the .elf and builds again to time a relink on
+its own, as an incremental build would see it. Used by `pio run -t linkbench`.
+"""
+
+import json
+import os
+import subprocess
+import time
+from os.path import exists, join
+
+from . import footprint
+
+PROFILES = ["dev", "release"]
+
+
+class LinkBenchError(Exception):
+    pass
+
+
+def _link_time(trace_path):
+    """Seconds spent linking, from a build trace"""
+    if not exists(trace_path):
+        return None
+    with open(trace_path) as fp:
+        events = json.load(fp)["traceEvents"]
+    links = [e["dur"] for e in events if e.get("cat") == "link"]
+    return sum(links) / 1e6 if links else None
+
+
+def _build(command, project_dir, env_name, profile, build_root, trace_path):
+    if exists(trace_path):
+        os.remove(trace_path)
+    environ = dict(os.environ,
+                   JENNIC_BUILD_PROFILE=profile,
+                   JENNIC_BUILD_TRACE="yes",
+                   PLATFORMIO_BUILD_DIR=build_root)
+    started = time.time()
+    # Only the firmware: the default targets include `size`, which would add
+    # these builds to the project's size history (and apply its growth gate)
+    proc = subprocess.Popen(command + ["-d", project_dir, "-e", env_name, "-t", "buildprog"], env=environ,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = proc.communicate()
+    if proc.returncode:
+        raise LinkBenchError("%s build failed:\n%s" % (
+            profile, output.decode("utf-8", "replace")[-2000:]))
+    return time.time() - started
+
+
+def run_profile(command, project_dir, env_name, profile, build_root, progname="firmware"):
+    """Build with `profile`; returns its build and link times and image size"""
+    build_dir = join(build_root, env_name)
+    elf_path = join(build_dir, progname + ".elf")
+    trace_path = join(build_dir, "build-trace.json")
+
+    build_time = _build(command, project_dir, env_name, profile, build_root, trace_path)
+    link_time = _link_time(trace_path)
+
+    # Relink only
+    try:
+        os.remove(elf_path)
+    except OSError as e:
+        raise LinkBenchError("Can't remove %s to time a relink: %s" % (elf_path, e))
+    relink_build_time = _build(command, project_dir, env_name, profile, build_root, trace_path)
+    relink_time = _link_time(trace_path)
+
+    map_path = join(build_dir, progname + ".map")
+    report = footprint.analyze(elf_path, map_path if exists(map_path) else None)
+    return dict(profile=profile, build_time=build_time, link_time=link_time,
+                relink_build_time=relink_build_time, relink_time=relink_time,
+                flash=report["flash"], ram=report["ram"])
+
+
+def format_results(results):
+    lines = ["%-8s %10s %9s %9s %10s %9s" % ("Profile", "Build", "Link", "Relink", "Flash", "RAM")]
+
+    def seconds(value):
+        return "-" if value is None else "%.2fs" % value
+
+    for r in results:
+        lines.append("%-8s %10s %9s %9s %10d %9d" % (
+            r["profile"], seconds(r["build_time"]), seconds(r["link_time"]),
+            seconds(r["relink_time"]), r["flash"], r["ram"]))
+    if len(results) > 1:
+        base = results[-1]
+        for r in results[:-1]:
+            lines.append("%s vs %s: flash %+d bytes, RAM %+d bytes" % (
+                r["profile"], base["profile"], r["flash"] - base["flash"], r["ram"] - base["ram"]))
+    return "\n".join(lines)
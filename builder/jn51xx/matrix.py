@@ -0,0 +1,227 @@
+"""
+Build matrix: one application as many chip / device type / feature variants
+
+    [env:light]
+    jennic_matrix = board: jn5168 | jn5169; zbpro_device_type: ZCR | ZED
+
+    python -m jn51xx.matrix -d path/to/project -e light
+
+Every combination is built as its own environment (eg. `light-jn5169-zed`),
+several at once. Each variant has its own build dir, which SCons' CacheDir
+(`build_cache_dir`) takes into every signature, so it isn't used: variants
+share work through the platform's caches in `jennic_cache_dir` instead, whose
+keys leave the build dir out. SDK libraries compiled with the same flags,
+defines and headers are linked prebuilt, and a translation unit that
+preprocesses and compiles identically for several variants is only compiled
+once (the compiler output cache). The first variant builds on its own to fill
+the caches, then the rest are built concurrently. Ends with a size and timing
+report, including how much each variant took from the caches that another
+build had put there.
+"""
+
+import argparse
+import configparser
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, exists, isdir, join
+
+from . import footprint
+
+MATRIX_OPTION = "jennic_matrix"
+
+Variant = namedtuple("Variant", ["name", "base", "options"])
+
+
+class MatrixError(Exception):
+    pass
+
+
+def parse_matrix(spec):
+    """[(option, [values])] from "option: a | b; option: c | d"
+
+    Values are separated by "|" as some (eg. zllha_features) contain commas.
+    """
+    axes = []
+    for axis in re.split(r"[;\n]", spec):
+        if not axis.strip():
+            continue
+        option, sep, values = axis.partition(":")
+        values = [v.strip() for v in values.split("|") if v.strip()]
+        if not sep or not option.strip() or not values:
+            raise MatrixError("Invalid matrix axis '%s' (expected 'option: value | value')" % axis.strip())
+        axes.append((option.strip(), values))
+    return axes
+
+
+def slug(value):
+    return re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_")
+
+
+def expand(base, axes):
+    variants = []
+    for values in itertools.product(*[v for _, v in axes]):
+        options = list(zip([o for o, _ in axes], values))
+        name = "-".join([base] + [slug(v) for v in values])
+        variants.append(Variant(name, base, options))
+    return variants
+
+
+def load_project(project_dir):
+    path = join(project_dir, "platformio.ini")
+    if not exists(path):
+        raise MatrixError("No platformio.ini in %s" % project_dir)
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    return config
+
+
+def variants_of(config, envs=None):
+    """Variants of the given environments, or of every one with a matrix"""
+    names = envs or [s[len("env:"):] for s in config.sections()
+                     if s.startswith("env:") and config.has_option(s, MATRIX_OPTION)]
+    if not names:
+        raise MatrixError("No environment has a %s option" % MATRIX_OPTION)
+    variants = []
+    for name in names:
+        section = "env:" + name
+        if not config.has_section(section):
+            raise MatrixError("No [%s] in platformio.ini" % section)
+        if not config.has_option(section, MATRIX_OPTION):
+            raise MatrixError("[%s] has no %s option" % (section, MATRIX_OPTION))
+        variants += expand(name, parse_matrix(config.get(section, MATRIX_OPTION)))
+    return variants
+
+
+def write_config(config, variants, path, cache_dir=None):
+    """A platformio.ini with an environment per variant, extending its base"""
+    for variant in variants:
+        section = "env:" + variant.name
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, "extends", "env:" + variant.base)
+        if cache_dir:
+            config.set(section, "jennic_cache_dir", cache_dir)
+        for option, value in variant.options:
+            config.set(section, option, value)
+    if not isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fp:
+        config.write(fp)
+
+
+def run_variant(variant, pio, project_dir, conf, build_dir, log_dir, jobs):
+    log_path = join(log_dir, variant.name + ".log")
+    started = time.time()
+    with open(log_path, "wb") as log:
+        returncode = subprocess.call(
+            [pio, "run", "-d", project_dir, "-c", conf, "-e", variant.name, "-j", str(jobs)],
+            stdout=log, stderr=subprocess.STDOUT)
+    result = dict(name=variant.name, options=dict(variant.options), returncode=returncode,
+                  elapsed=time.time() - started, log=log_path, flash=None, ram=None, prebuilt=None,
+                  cc_hits=None, cc_shared=None, cc_misses=None)
+
+    with open(log_path, "rb") as fp:
+        output = fp.read()
+    m = re.search(br"Library cache: (\d+) prebuilt, (\d+) to build", output)
+    if m:
+        result["prebuilt"] = int(m.group(1))
+        result["built"] = int(m.group(2))
+    m = re.search(br"Compiler cache: (\d+) hits(?: \((\d+) from other builds\))?, (\d+) misses", output)
+    if m:
+        result["cc_hits"] = int(m.group(1))
+        result["cc_shared"] = int(m.group(2) or 0)
+        result["cc_misses"] = int(m.group(3))
+
+    elf = join(build_dir, variant.name, "firmware.elf")
+    if returncode == 0 and exists(elf):
+        mapfile = join(build_dir, variant.name, "firmware.map")
+        report = footprint.analyze(elf, mapfile if exists(mapfile) else None)
+        result["flash"] = report["flash"]
+        result["ram"] = report["ram"]
+    return result
+
+
+def build_matrix(project_dir, variants, config, pio="pio", jobs=None, parallel=None,
+                 cache_dir=None, build_dir=None, log=print):
+    project_dir = abspath(project_dir)
+    jobs = jobs or os.cpu_count() or 1
+    parallel = max(1, min(parallel or max(1, jobs // 2), len(variants)))
+    build_dir = build_dir or join(project_dir, ".pio", "build")
+    matrix_dir = join(project_dir, ".pio", "matrix")
+    conf = join(matrix_dir, "platformio.ini")
+    write_config(config, variants, conf, cache_dir)
+
+    def run(variant, variant_jobs):
+        log("Building %s (%s)" % (variant.name, ", ".join("%s=%s" % o for o in variant.options)))
+        result = run_variant(variant, pio, project_dir, conf, build_dir, matrix_dir, variant_jobs)
+        log("%s %s in %.1fs" % (variant.name, "failed" if result["returncode"] else "built",
+                                result["elapsed"]))
+        return result
+
+    # The first variant fills the caches for everything it shares with the rest
+    results = [run(variants[0], jobs)]
+    rest = variants[1:]
+    if rest:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            results += list(pool.map(lambda v: run(v, max(1, jobs // parallel)), rest))
+    return results
+
+
+def format_report(results):
+    lines = ["%-36s %-6s %9s %9s %8s %9s %13s" % (
+        "Variant", "Status", "Flash", "RAM", "Time", "Prebuilt", "Shared/Objs")]
+    for r in results:
+        lines.append("%-36s %-6s %9s %9s %7.1fs %9s %13s" % (
+            r["name"], "FAILED" if r["returncode"] else "OK",
+            "-" if r["flash"] is None else r["flash"],
+            "-" if r["ram"] is None else r["ram"],
+            r["elapsed"],
+            "-" if r["prebuilt"] is None else "%d/%d" % (r["prebuilt"], r["prebuilt"] + r["built"]),
+            "-" if r["cc_hits"] is None else "%d/%d" % (r["cc_shared"], r["cc_hits"] + r["cc_misses"])))
+    lines.append("%d variants, %d failed, %.1fs total build time, %d objects from other builds" % (
+        len(results), len([r for r in results if r["returncode"]]), sum(r["elapsed"] for r in results),
+        sum(r["cc_shared"] or 0 for r in results)))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build every variant of a jennic_matrix")
+    parser.add_argument("-d", "--project-dir", default=".")
+    parser.add_argument("-e", "--environment", action="append",
+                        help="Environment whose matrix to build (default: all with a matrix)")
+    parser.add_argument("-j", "--jobs", type=int, help="Compile jobs in total (default: CPU count)")
+    parser.add_argument("--parallel", type=int, help="Variants to build at once (default: jobs / 2)")
+    parser.add_argument("--cache-dir", help="jennic_cache_dir for every variant (default: the project's)")
+    parser.add_argument("--pio", default="pio", help="PlatformIO executable")
+    parser.add_argument("--json", help="Write the per-variant results to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_project(args.project_dir)
+        variants = variants_of(config, args.environment)
+        results = build_matrix(args.project_dir, variants, config, pio=args.pio, jobs=args.jobs,
+                               parallel=args.parallel, cache_dir=args.cache_dir)
+    except (MatrixError, configparser.Error, OSError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+    print("")
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+    for r in results:
+        if r["returncode"]:
+            print("%s: see %s" % (r["name"], r["log"]))
+    return 1 if any(r["returncode"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
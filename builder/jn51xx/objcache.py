@@ -0,0 +1,371 @@
+"""
+Compiler output cache
+
+Runs a ba-elf-gcc compile (`-c`) through a store shared by all projects,
+keyed by the preprocessed source, the command line (less the output path)
+and the compiler. Compiling the same thing again, eg. after switching back to
+a branch or set of options built before, copies the stored object back
+instead of compiling it. The compiler's warnings and the -fstack-usage .su
+file are stored and restored along with the object.
+
+-flto objects hold the compiler's intermediate representation rather than
+machine code, which only the exact compiler that wrote it can link, so the
+key covers the toolchain version and the compiler binary as well as the
+-flto options themselves.
+
+Paths under `--base-dir` (the build dir) are left out of the key, so builds
+in different dirs (eg. the variants of a build matrix) share the objects of
+sources that preprocess the same, such as generated headers with the same
+contents. Such an object's debug info still names the other build's dir.
+Entries record the `--origin` (build) that stored them, and hits on another
+build's objects are counted as shared.
+
+Anything that isn't a single source compiled to an object (links, dependency
+generation, -save-temps, ...) runs the compiler as is. Least recently used
+entries are removed once the store grows past its size limit (`--prune`),
+which may happen while another build is restoring one: that compile then
+runs the compiler after all. Pruning also compacts the stats log.
+
+    python -m jn51xx.objcache --dir ~/.platformio/.cache/jennic/cc --base-dir .pio/build/env ba-elf-gcc -c foo.c -o foo.o
+    python -m jn51xx.objcache --dir ~/.platformio/.cache/jennic/cc --stats
+"""
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+from os.path import exists, isdir, join, splitext
+
+from .cache import ArtifactCache, file_id, make_key
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = "1G"
+
+STATS_NAME = "stats.log"
+OUTCOMES = ["hit", "miss", "uncacheable"]
+# Also counted: hits on objects another build stored
+COUNTERS = OUTCOMES + ["shared"]
+
+# Names of the files in a cache entry
+OBJECT = "object.o"
+STACK_USAGE = "object.su"
+STDERR = "stderr.txt"
+ORIGIN = "origin.txt"
+
+BASE_DIR_PLACEHOLDER = "<base>"
+
+# Options followed by a separate value
+VALUE_OPTIONS = {
+    "-o", "-I", "-D", "-U", "-include", "-imacros", "-isystem", "-iquote", "-idirafter", "-iprefix",
+    "-x", "-MF", "-MT", "-MQ", "-Xpreprocessor", "-Xassembler", "-Xlinker", "--param", "-aux-info",
+    "-L", "-l", "-T", "-u",
+}
+
+# Options with outputs or side effects that aren't captured
+UNCACHEABLE_OPTIONS = (
+    "-M", "-Wp,-M", "-E", "-S", "-save-temps", "-fsyntax-only", "-fprofile", "--coverage",
+    "-ftest-coverage", "-fdump", "-fcallgraph-info",
+)
+
+
+class ObjCacheError(Exception):
+    pass
+
+
+def parse_size(text):
+    """Bytes in a size like "500M" or "2G" """
+    text = str(text).strip().upper().rstrip("B")
+    scale = 1
+    if text and text[-1] in "KMG":
+        scale = 1024 ** ("KMG".index(text[-1]) + 1)
+        text = text[:-1]
+    try:
+        return int(float(text) * scale)
+    except ValueError:
+        raise ObjCacheError("Invalid size '%s'" % text)
+
+
+def expand_response_files(args):
+    expanded = []
+    for arg in args:
+        if arg.startswith("@") and os.path.isfile(arg[1:]):
+            with open(arg[1:]) as fp:
+                expanded += shlex.split(fp.read())
+        else:
+            expanded.append(arg)
+    return expanded
+
+
+class Compile(object):
+    """A compiler command line, taken apart"""
+
+    def __init__(self, args):
+        self.args = expand_response_files(args)
+        self.compiler = self.args[0]
+        self.output = None
+        self.sources = []
+        self.options = []
+        i = 1
+        while i < len(self.args):
+            arg = self.args[i]
+            if arg in VALUE_OPTIONS and i + 1 < len(self.args):
+                if arg == "-o":
+                    self.output = self.args[i + 1]
+                else:
+                    self.options += [arg, self.args[i + 1]]
+                i += 2
+                continue
+            if arg.startswith("-o") and len(arg) > 2:
+                self.output = arg[2:]
+            elif arg.startswith("-") and arg != "-":
+                self.options.append(arg)
+            else:
+                self.sources.append(arg)
+            i += 1
+
+    def cacheable(self):
+        return ("-c" in self.options and self.output is not None and
+                len(self.sources) == 1 and self.sources[0] != "-" and
+                not any(o.startswith(UNCACHEABLE_OPTIONS) for o in self.options))
+
+    def preprocess_args(self):
+        return [self.compiler] + [o for o in self.options if o != "-c"] + ["-E", self.sources[0]]
+
+    def stack_usage_path(self):
+        """Where gcc writes the .su file, if -fstack-usage is on"""
+        if "-fstack-usage" not in self.options:
+            return None
+        return splitext(self.output)[0] + ".su"
+
+    def key(self, preprocessed, toolchain_version="", base_dir=None):
+        compiler = shutil.which(self.compiler) or self.compiler
+        options = "\0".join(self.options)
+        if base_dir:
+            options = relocate(options, base_dir)
+            preprocessed = relocate(preprocessed, base_dir)
+        return make_key(
+            "objcache", CACHE_VERSION, toolchain_version,
+            file_id(compiler) if exists(compiler) else compiler,
+            # The source path also appears in the preprocessor's line markers
+            options, self.sources[0], preprocessed)
+
+
+def relocate(text, base_dir):
+    """`text` (str or bytes) with the paths of `base_dir` replaced by a placeholder"""
+    forms = set()
+    for path in (os.path.abspath(base_dir), os.path.relpath(base_dir)):
+        # Line markers escape backslashes (Windows paths)
+        forms.update([path, path.replace("\\", "\\\\")])
+    for form in sorted(forms, key=len, reverse=True):
+        if isinstance(text, bytes):
+            text = text.replace(form.encode("utf-8"), BASE_DIR_PLACEHOLDER.encode("ascii"))
+        else:
+            text = text.replace(form, BASE_DIR_PLACEHOLDER)
+    return text
+
+
+def record(path, outcomes):
+    """Count outcomes in a stats log (appends are atomic, so parallel compiles can share it)"""
+    try:
+        if not isdir(os.path.dirname(path) or "."):
+            os.makedirs(os.path.dirname(path))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(o + "\n" for o in outcomes).encode("ascii"))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def read_stats(path):
+    """{counter: count} from a stats log: a line per outcome, or "<counter> <count>" once compacted"""
+    counts = dict((counter, 0) for counter in COUNTERS)
+    if exists(path):
+        with open(path) as fp:
+            for line in fp:
+                fields = line.split()
+                if fields and fields[0] in counts:
+                    counts[fields[0]] += int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 1
+    return counts
+
+
+def compact_stats(path):
+    """Rewrite a stats log as one line per counter (outcomes recorded while
+    it's being rewritten may be lost)"""
+    if not exists(path):
+        return
+    counts = read_stats(path)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as fp:
+            fp.writelines("%s %d\n" % (counter, counts[counter]) for counter in COUNTERS)
+        os.replace(tmp, path)
+    except OSError:
+        if exists(tmp):
+            os.remove(tmp)
+
+
+def hit_rate(counts):
+    total = counts["hit"] + counts["miss"]
+    return counts["hit"] / total if total else 0.0
+
+
+def format_stats(counts):
+    return "Compiler cache: %d hits%s, %d misses (%.1f%% hit rate), %d not cacheable" % (
+        counts["hit"], " (%d from other builds)" % counts["shared"] if counts["shared"] else "",
+        counts["miss"], 100 * hit_rate(counts), counts["uncacheable"])
+
+
+def _write_stderr(data):
+    if data:
+        sys.stderr.flush()
+        getattr(sys.stderr, "buffer", sys.stderr).write(data)
+        sys.stderr.flush()
+
+
+def restore(cache, key, cmd):
+    """Copy a stored object back, returns the origin that stored it ("" if
+    unknown), or None if there's none"""
+    obj = cache.lookup(key, OBJECT)
+    if obj is None:
+        return None
+    entry = cache.entry(key)
+    # Anything here raises OSError if the entry is pruned meanwhile, so
+    # nothing is shown until it has all been read
+    shutil.copyfile(obj, cmd.output)
+    su_path = cmd.stack_usage_path()
+    if su_path and exists(join(entry, STACK_USAGE)):
+        shutil.copyfile(join(entry, STACK_USAGE), su_path)
+    stderr = b""
+    if exists(join(entry, STDERR)):
+        with open(join(entry, STDERR), "rb") as fp:
+            stderr = fp.read()
+    origin = ""
+    if exists(join(entry, ORIGIN)):
+        with open(join(entry, ORIGIN)) as fp:
+            origin = fp.read()
+    _write_stderr(stderr)
+    return origin
+
+
+def store(cache, key, cmd, stderr, origin=""):
+    if not isdir(cache.root):
+        os.makedirs(cache.root)
+    tmp = tempfile.mkdtemp(dir=cache.root, prefix=".tmp-")
+    try:
+        files = [join(tmp, OBJECT), join(tmp, STDERR), join(tmp, ORIGIN)]
+        shutil.copyfile(cmd.output, files[0])
+        with open(files[1], "wb") as fp:
+            fp.write(stderr)
+        with open(files[2], "w") as fp:
+            fp.write(origin)
+        su_path = cmd.stack_usage_path()
+        if su_path and exists(su_path):
+            files.append(join(tmp, STACK_USAGE))
+            shutil.copyfile(su_path, files[-1])
+        cache.put(key, files)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def cached_compile(args, cache_dir, toolchain_version="", base_dir=None, origin="", build_stats=None):
+    """Run a compiler command line through the cache, returns its exit code
+
+    Outcomes are counted in the cache's stats log and, if given, in the
+    `build_stats` log of this build alone.
+    """
+    def count(*outcomes):
+        for path in [join(cache_dir, STATS_NAME)] + ([build_stats] if build_stats else []):
+            record(path, outcomes)
+
+    cmd = Compile(args)
+    if not cmd.cacheable():
+        count("uncacheable")
+        return subprocess.call(cmd.args)
+
+    pre = subprocess.run(cmd.preprocess_args(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if pre.returncode != 0:
+        # Let the compile report the error
+        count("uncacheable")
+        return subprocess.call(cmd.args)
+
+    cache = ArtifactCache(cache_dir)
+    key = cmd.key(pre.stdout, toolchain_version, base_dir)
+    try:
+        stored_by = restore(cache, key, cmd)
+    except OSError:
+        # Pruned by another build while being copied: compile it instead
+        stored_by = None
+    if stored_by is not None:
+        if stored_by and stored_by != origin:
+            count("hit", "shared")
+        else:
+            count("hit")
+        return 0
+
+    proc = subprocess.run(cmd.args, stderr=subprocess.PIPE)
+    _write_stderr(proc.stderr)
+    if proc.returncode == 0 and exists(cmd.output):
+        store(cache, key, cmd, proc.stderr, origin)
+        count("miss")
+    return proc.returncode
+
+
+def prune(cache_dir, max_size=DEFAULT_MAX_SIZE):
+    """Remove least recently used entries until the cache fits in `max_size`"""
+    removed = ArtifactCache(cache_dir).prune(parse_size(max_size))
+    compact_stats(join(cache_dir, STATS_NAME))
+    return removed
+
+
+def clear(cache_dir):
+    if isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile through the compiler output cache")
+    parser.add_argument("--dir", required=True, help="Cache directory")
+    parser.add_argument("--toolchain-version", default="", help="Version of the toolchain package")
+    parser.add_argument("--base-dir", help="Build dir, whose paths are left out of the key")
+    parser.add_argument("--origin", default="", help="Name of this build, recorded with what it stores")
+    parser.add_argument("--build-stats", help="Also count this compile's outcome in this file")
+    parser.add_argument("--stats", action="store_true", help="Show the hit rate and size")
+    parser.add_argument("--zero-stats", action="store_true", help="Reset the hit/miss counts")
+    parser.add_argument("--prune", action="store_true", help="Shrink the cache to --max-size")
+    parser.add_argument("--max-size", default=DEFAULT_MAX_SIZE)
+    parser.add_argument("--clear", action="store_true", help="Remove everything in the cache")
+    parser.add_argument("compiler", nargs=argparse.REMAINDER, help="Compiler command line")
+    args = parser.parse_args(argv)
+
+    compiler = args.compiler[1:] if args.compiler[:1] == ["--"] else args.compiler
+    if compiler:
+        try:
+            return cached_compile(compiler, args.dir, args.toolchain_version,
+                                  args.base_dir, args.origin, args.build_stats)
+        except OSError as e:
+            sys.stderr.write("Error: %s: %s\n" % (compiler[0], e))
+            return 1
+
+    try:
+        if args.clear:
+            clear(args.dir)
+        if args.zero_stats and exists(join(args.dir, STATS_NAME)):
+            os.remove(join(args.dir, STATS_NAME))
+        if args.prune:
+            print("Removed %d entries" % prune(args.dir, args.max_size))
+    except ObjCacheError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    if args.stats:
+        print(format_stats(read_stats(join(args.dir, STATS_NAME))))
+        print("Size: %.1f MB" % (ArtifactCache(args.dir).size() / 1024.0 / 1024))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
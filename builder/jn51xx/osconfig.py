@@ -0,0 +1,164 @@
+"""
+Reader for the JenOS configuration (.oscfgdiag)
+
+Lists the tasks, mutexes, message queues, software timers and interrupt
+handlers the OS configuration editor declared, with their priorities. The
+sources (os_gen.c, os_irq*.S) are always generated by NXP's OSConfig.exe;
+this is for the host tools that need to know what the OS will run, such as
+the stack depth analysis.
+
+    python -m jn51xx.osconfig app.oscfgdiag
+"""
+
+import argparse
+import re
+import sys
+from collections import namedtuple
+
+from . import xmi
+
+# CPU exceptions, by the source names the editor uses for them
+EXCEPTIONS = [
+    ("alignment", ("alignment", "unalignedaccess")),
+    ("buserror", ("buserror",)),
+    ("illegalinstruction", ("illegalinstruction",)),
+    ("stackoverflowexception", ("stackoverflow", "stackoverflowexception")),
+    ("unimplementedmodule", ("unimplementedmodule",)),
+]
+
+# OS_TASK(x) and OS_ISR(x) declare the function os_v<x>
+FUNCTION_PREFIX = "os_v"
+
+Task = namedtuple("Task", ["name", "module", "priority", "autostart", "mutexes"])
+Mutex = namedtuple("Mutex", ["name", "module", "ceiling"])
+Message = namedtuple("Message", ["name", "module", "type", "size", "tasks"])
+SWTimer = namedtuple("SWTimer", ["name", "module", "task"])
+Isr = namedtuple("Isr", ["name", "module", "priority", "source", "vector"])
+
+
+class OsConfigError(Exception):
+    pass
+
+
+class OsConfig(object):
+    """The objects of an .oscfgdiag, in declaration order"""
+
+    def __init__(self, path):
+        self.path = path
+        self.doc = xmi.XmiDocument.parse(path)
+        self.modules = []
+        self.tasks = []
+        self.mutexes = []
+        self.messages = []
+        self.timers = []
+        self.isrs = []
+        self.num_vectors = 0
+        self._load()
+
+    def _load(self):
+        doc = self.doc
+        mutex_users = {}
+
+        modules = xmi.children(doc.root, "Modules") or [doc.root]
+        for module in modules:
+            module_name = module.get("Name", "")
+            self.modules.append(module_name)
+            for el in xmi.children(module, "Tasks"):
+                for m in doc.refs(el, "Mutexs") + doc.refs(el, "Mutexes"):
+                    mutex_users.setdefault(m, []).append(el)
+
+        for module in modules:
+            module_name = module.get("Name", "")
+            for el in xmi.children(module, "Mutexs") + xmi.children(module, "Mutexes"):
+                users = mutex_users.get(el, []) + doc.refs(el, "Tasks")
+                # Priority ceiling: the highest priority of any task using it
+                ceiling = max([xmi.get_int(t, "Priority") for t in users] or [0])
+                self.mutexes.append(Mutex(el.get("Name"), module_name, ceiling))
+
+            for el in xmi.children(module, "Tasks"):
+                self.tasks.append(Task(
+                    el.get("Name"), module_name, xmi.get_int(el, "Priority"),
+                    xmi.get_bool(el, "AutoStart"),
+                    [m.get("Name") for m in doc.refs(el, "Mutexs") + doc.refs(el, "Mutexes")]))
+
+            for el in xmi.children(module, "Messages"):
+                size = xmi.get_int(el, "Size", xmi.get_int(el, "QueueSize", 1))
+                self.messages.append(Message(
+                    el.get("Name"), module_name, el.get("Type") or "uint32", size,
+                    [t.get("Name") for t in doc.refs(el, "Tasks") + doc.refs(el, "Task")]))
+
+            for el in xmi.children(module, "SWTimers"):
+                task = doc.ref(el, "Task")
+                self.timers.append(SWTimer(
+                    el.get("Name"), module_name, task.get("Name") if task is not None else None))
+
+            for el in xmi.children(module, "ISRs"):
+                self.isrs.append(self._load_isr(el, module_name))
+
+        names = [o.name for o in self.tasks + self.mutexes + self.messages + self.timers + self.isrs]
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        if duplicates:
+            raise OsConfigError("Duplicate OS object names: %s" % ", ".join(duplicates))
+        self.num_vectors = max([i.vector + 1 for i in self.isrs if i.vector is not None] or [0])
+
+    def _load_isr(self, el, module_name):
+        source = self.doc.ref(el, "Source") if el.get("Source", "").startswith("//") else None
+        vector = None
+        if source is not None:
+            source_name = source.get("Name", "")
+            # Position of the source among its siblings is its PIC source number
+            siblings = xmi.children(self._parent(source), xmi.local_name(source.tag))
+            vector = siblings.index(source)
+        else:
+            source_name = el.get("Source") or el.get("Interrupt") or ""
+            if el.get("Vector") is not None:
+                vector = xmi.get_int(el, "Vector")
+        if self.exception_of(source_name) is not None:
+            vector = None
+        return Isr(el.get("Name"), module_name, xmi.get_int(el, "Priority"), source_name, vector)
+
+    def _parent(self, element):
+        for parent in self.doc.root.iter():
+            if element in list(parent):
+                return parent
+        return self.doc.root
+
+    @staticmethod
+    def exception_of(source_name):
+        key = re.sub(r"[^a-z]", "", source_name.lower())
+        for suffix, names in EXCEPTIONS:
+            if key in names:
+                return suffix
+        return None
+
+
+def function_name(name):
+    """Symbol of the function behind a task or ISR"""
+    return FUNCTION_PREFIX + name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List what a JenOS configuration (.oscfgdiag) declares")
+    parser.add_argument("config")
+    args = parser.parse_args(argv)
+
+    try:
+        config = OsConfig(args.config)
+    except (OsConfigError, xmi.XmiError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    for t in config.tasks:
+        print("Task   %-32s priority %2d%s" % (t.name, t.priority, ", autostart" if t.autostart else ""))
+    for i in config.isrs:
+        print("ISR    %-32s priority %2d, %s" % (i.name, i.priority, i.source or "?"))
+    for m in config.mutexes:
+        print("Mutex  %-32s ceiling %2d" % (m.name, m.ceiling))
+    for m in config.messages:
+        print("Queue  %-32s %d x %s" % (m.name, m.size, m.type))
+    for t in config.timers:
+        print("Timer  %-32s task %s" % (t.name, t.task or "-"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+Zigbee OTA upgrade files
+
+Wraps a firmware image in the standard Zigbee OTA file format (ZCL OTA
+Upgrade cluster: file header, then tagged sub-elements) so it can be served
+by any OTA server.
+
+Experimental, and not understood by the SDK's OTA client (which only takes
+full, unencrypted images from these files), so only of use with a client
+extended to handle them:
+
+- A delta file against a previous release carries a compressed patch in a
+  manufacturer-specific sub-element (TAG_DELTA_IMAGE) instead of the full
+  image, under its own image type (the image type with DELTA_IMAGE_TYPE_BIT
+  flipped) so that a client can't mistake it for a full image. The patch is
+  a deflate stream of COPY (from the old image) and INSERT (new bytes)
+  operations; the client has to rebuild the image (as apply_delta() does)
+  before writing it to flash.
+- Either kind of image may be AES-128-CTR encrypted. Each sub-element gets
+  its own initial counter block, derived from the IV, the image type, the
+  file version and the sub-element's tag (element_iv()), so no two files of
+  a release, or releases, encrypt with the same key stream. This is not the
+  SDK's OTA_ENCRYPTED scheme.
+
+    python -m jn51xx.ota firmware.bin firmware.ota --version 0x00010002
+    python -m jn51xx.ota firmware.bin firmware.delta.ota --version 0x00010002 --base v1.0.1.bin --experimental
+"""
+
+import argparse
+import struct
+import sys
+import zlib
+from os.path import exists
+
+OTA_FILE_IDENTIFIER = 0x0BEEF11E
+OTA_HEADER_VERSION = 0x0100
+OTA_HEADER_STRING_SIZE = 32
+OTA_HEADER_FORMAT = "<IHHHHHIH32sI"
+OTA_HEADER_SIZE = struct.calcsize(OTA_HEADER_FORMAT)
+OTA_SUBELEMENT_FORMAT = "<HI"
+
+# Header field control bits
+FIELD_SECURITY_CREDENTIAL = 0x0001
+FIELD_DEVICE_SPECIFIC = 0x0002
+FIELD_HARDWARE_VERSIONS = 0x0004
+
+ZIGBEE_STACK_PRO = 0x0002
+NXP_MANUFACTURER_CODE = 0x1037
+
+# Sub-element tags
+TAG_UPGRADE_IMAGE = 0x0000
+TAG_ECDSA_SIGNATURE = 0x0001
+TAG_ECDSA_CERTIFICATE = 0x0002
+TAG_IMAGE_INTEGRITY_CODE = 0x0003
+TAG_DELTA_IMAGE = 0xF000
+
+# Flipped in the image type of delta files
+DELTA_IMAGE_TYPE_BIT = 0x8000
+
+# Delta patch format
+DELTA_MAGIC = b"JDLT"
+DELTA_VERSION = 1
+DELTA_HEADER_FORMAT = "<4sBxxxIIII"
+DELTA_OP_COPY = 0
+DELTA_OP_INSERT = 1
+DELTA_BLOCK = 16
+
+# Section the NXP OTA client reads its own OTA header from, if the
+# application links one in (JET.exe --embed_hdr)
+EMBEDDED_HEADER_SECTION = ".ro_ota_header"
+
+
+class OtaError(Exception):
+    pass
+
+
+def build_header(manufacturer, image_type, file_version, total_size, header_string=b"",
+                 stack_version=ZIGBEE_STACK_PRO, min_hw=None, max_hw=None):
+    field_control = 0
+    optional = b""
+    if min_hw is not None or max_hw is not None:
+        field_control |= FIELD_HARDWARE_VERSIONS
+        optional += struct.pack("<HH", min_hw or 0, max_hw if max_hw is not None else 0xFFFF)
+    header_length = OTA_HEADER_SIZE + len(optional)
+    if isinstance(header_string, str):
+        header_string = header_string.encode("ascii", "replace")
+    return struct.pack(
+        OTA_HEADER_FORMAT,
+        OTA_FILE_IDENTIFIER,
+        OTA_HEADER_VERSION,
+        header_length,
+        field_control,
+        manufacturer,
+        image_type,
+        file_version,
+        stack_version,
+        header_string[:OTA_HEADER_STRING_SIZE].ljust(OTA_HEADER_STRING_SIZE, b"\0"),
+        total_size + header_length,
+    ) + optional
+
+
+def build_ota(elements, manufacturer, image_type, file_version, **header_args):
+    """OTA file from a list of (tag, data) sub-elements"""
+    body = b"".join(struct.pack(OTA_SUBELEMENT_FORMAT, tag, len(data)) + bytes(data)
+                    for tag, data in elements)
+    return build_header(manufacturer, image_type, file_version, len(body), **header_args) + body
+
+
+def parse_ota(data):
+    """(header dict, [(tag, data), ...]) of an OTA file"""
+    if len(data) < OTA_HEADER_SIZE:
+        raise OtaError("File is too short for an OTA header")
+    fields = struct.unpack_from(OTA_HEADER_FORMAT, data, 0)
+    if fields[0] != OTA_FILE_IDENTIFIER:
+        raise OtaError("Not a Zigbee OTA file")
+    header = dict(
+        header_version=fields[1],
+        header_length=fields[2],
+        field_control=fields[3],
+        manufacturer=fields[4],
+        image_type=fields[5],
+        file_version=fields[6],
+        stack_version=fields[7],
+        header_string=fields[8].rstrip(b"\0").decode("ascii", "replace"),
+        total_size=fields[9],
+    )
+    if header["total_size"] != len(data):
+        raise OtaError("OTA file size mismatch (header says %d, file is %d)" % (
+            header["total_size"], len(data)))
+    elements = []
+    pos = header["header_length"]
+    while pos < len(data):
+        tag, length = struct.unpack_from(OTA_SUBELEMENT_FORMAT, data, pos)
+        pos += struct.calcsize(OTA_SUBELEMENT_FORMAT)
+        elements.append((tag, data[pos:pos + length]))
+        pos += length
+    return header, elements
+
+
+def read_image(path):
+    """Firmware image from a .bin file, or the upgrade image of an .ota file"""
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if len(data) >= 4 and struct.unpack_from("<I", data)[0] == OTA_FILE_IDENTIFIER:
+        _, elements = parse_ota(data)
+        for tag, element in elements:
+            if tag == TAG_UPGRADE_IMAGE:
+                return bytes(element)
+        raise OtaError("%s has no full upgrade image to diff against" % path)
+    return data
+
+
+def embed_header(image, offset, header):
+    """Copy of `image` with the OTA header written into its embedded header section"""
+    if offset + len(header) > len(image):
+        raise OtaError("Embedded OTA header section is outside the image")
+    return image[:offset] + header + image[offset + len(header):]
+
+
+#
+# Delta images
+#
+
+def make_delta(old, new, block=DELTA_BLOCK):
+    """Patch that rebuilds `new` from `old`
+
+    Greedy block matching: every `block`-byte string of the old image is
+    indexed, and runs of the new image found in it become COPY operations
+    (extended as far as they match). Firmware changes tend to shift code
+    rather than rewrite it, so most of a new release is found in the old one.
+    """
+    old = bytes(old)
+    new = bytes(new)
+    index = {}
+    for pos in range(len(old) - block, -1, -1):
+        index[old[pos:pos + block]] = pos
+
+    ops = []
+    literal_start = 0
+    pos = 0
+    expected = None
+    while pos + block <= len(new):
+        key = new[pos:pos + block]
+        # Prefer carrying on from where the last copy ended
+        if expected is not None and old[expected:expected + block] == key:
+            src = expected
+        else:
+            src = index.get(key)
+        if src is None:
+            pos += 1
+            continue
+        # Extend backwards into pending literals, then forwards
+        while pos > literal_start and src > 0 and new[pos - 1] == old[src - 1]:
+            pos -= 1
+            src -= 1
+        length = block
+        while pos + length < len(new) and src + length < len(old) and \
+                new[pos + length] == old[src + length]:
+            length += 1
+        if pos > literal_start:
+            ops.append((DELTA_OP_INSERT, new[literal_start:pos]))
+        ops.append((DELTA_OP_COPY, src, length))
+        pos += length
+        literal_start = pos
+        expected = src + length
+    if literal_start < len(new):
+        ops.append((DELTA_OP_INSERT, new[literal_start:]))
+
+    stream = bytearray()
+    for op in ops:
+        if op[0] == DELTA_OP_COPY:
+            stream += struct.pack("<BII", DELTA_OP_COPY, op[1], op[2])
+        else:
+            stream += struct.pack("<BI", DELTA_OP_INSERT, len(op[1])) + op[1]
+    header = struct.pack(DELTA_HEADER_FORMAT, DELTA_MAGIC, DELTA_VERSION,
+                         len(old), zlib.crc32(old) & 0xFFFFFFFF,
+                         len(new), zlib.crc32(new) & 0xFFFFFFFF)
+    return header + zlib.compress(bytes(stream), 9)
+
+
+def apply_delta(old, patch):
+    """Rebuild the new image from `old` and a patch made by make_delta"""
+    header_size = struct.calcsize(DELTA_HEADER_FORMAT)
+    magic, version, old_size, old_crc, new_size, new_crc = struct.unpack_from(
+        DELTA_HEADER_FORMAT, patch, 0)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise OtaError("Not a delta patch")
+    if len(old) != old_size or zlib.crc32(old) & 0xFFFFFFFF != old_crc:
+        raise OtaError("Delta patch was made against a different base image")
+    stream = zlib.decompress(bytes(patch[header_size:]))
+    new = bytearray()
+    pos = 0
+    while pos < len(stream):
+        op = stream[pos]
+        if op == DELTA_OP_COPY:
+            src, length = struct.unpack_from("<II", stream, pos + 1)
+            new += old[src:src + length]
+            pos += 9
+        elif op == DELTA_OP_INSERT:
+            length, = struct.unpack_from("<I", stream, pos + 1)
+            new += stream[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise OtaError("Corrupt delta patch")
+    if len(new) != new_size or zlib.crc32(bytes(new)) & 0xFFFFFFFF != new_crc:
+        raise OtaError("Delta patch produced the wrong image")
+    return bytes(new)
+
+
+#
+# Encryption
+#
+
+def parse_key(value, size=16):
+    """AES key or IV from a hex string, or from a file holding one"""
+    value = value.strip()
+    if exists(value):
+        with open(value) as fp:
+            value = fp.read().strip()
+    value = value.replace(" ", "").replace(":", "")
+    if value.lower().startswith("0x"):
+        value = value[2:]
+    try:
+        key = bytes(bytearray.fromhex(value))
+    except ValueError:
+        raise OtaError("AES key/IV must be %d hex bytes" % size)
+    if len(key) != size:
+        raise OtaError("AES key/IV must be %d bytes, got %d" % (size, len(key)))
+    return key
+
+
+def element_iv(iv, manufacturer, image_type, file_version, tag):
+    """Initial counter block for one sub-element of an OTA file
+
+    The first 10 bytes of `iv` are XORed with the manufacturer code, image
+    type, file version and tag (big-endian), leaving the low 48 bits for the
+    block counter.
+    """
+    fields = struct.pack(">HHIH", manufacturer, image_type, file_version, tag)
+    return bytes(a ^ b for a, b in zip(iv, fields)) + bytes(iv[len(fields):])
+
+
+def encrypt_ctr(data, key, iv):
+    """AES-128-CTR (the IV is the initial 128-bit big-endian counter block)"""
+    try:
+        from Crypto.Cipher import AES
+        from Crypto.Util import Counter
+    except ImportError:
+        try:
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        except ImportError:
+            raise OtaError("Encrypted OTA images need pycryptodome (pip install pycryptodome)")
+        encryptor = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend()).encryptor()
+        return encryptor.update(bytes(data)) + encryptor.finalize()
+    counter = Counter.new(128, initial_value=int.from_bytes(iv, "big"))
+    return AES.new(key, AES.MODE_CTR, counter=counter).encrypt(bytes(data))
+
+
+def make_ota_files(image, manufacturer, image_type, file_version, header_string="",
+                   base=None, key=None, iv=None, embedded_header_offset=None,
+                   min_hw=None, max_hw=None, delta_image_type=None):
+    """(full OTA file, delta OTA file or None) for a firmware image"""
+    if delta_image_type is None:
+        delta_image_type = image_type ^ DELTA_IMAGE_TYPE_BIT
+    if base is not None and delta_image_type == image_type:
+        raise OtaError("The delta image type must differ from the full image's (0x%04x)" % image_type)
+    iv = iv or bytes(16)
+    header_args = dict(header_string=header_string, min_hw=min_hw, max_hw=max_hw)
+    if embedded_header_offset is not None:
+        # The header of the full upgrade file, which the device later serves itself
+        body_size = struct.calcsize(OTA_SUBELEMENT_FORMAT) + len(image)
+        image = embed_header(image, embedded_header_offset, build_header(
+            manufacturer, image_type, file_version, body_size, **header_args))
+
+    def protect(data, image_type, tag):
+        if not key:
+            return data
+        return encrypt_ctr(data, key, element_iv(iv, manufacturer, image_type, file_version, tag))
+
+    full = build_ota([(TAG_UPGRADE_IMAGE, protect(image, image_type, TAG_UPGRADE_IMAGE))],
+                     manufacturer, image_type, file_version, **header_args)
+    delta = None
+    if base is not None:
+        patch = make_delta(base, image)
+        if apply_delta(base, patch) != image:
+            raise OtaError("Delta patch does not reproduce the image")
+        delta = build_ota([(TAG_DELTA_IMAGE, protect(patch, delta_image_type, TAG_DELTA_IMAGE))],
+                          manufacturer, delta_image_type, file_version, **header_args)
+    return full, delta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build Zigbee OTA upgrade files")
+    parser.add_argument("image", help="Firmware .bin")
+    parser.add_argument("output", help="OTA file to write")
+    parser.add_argument("--version", type=lambda v: int(v, 0), required=True,
+                        help="File version (eg. 0x00010002)")
+    parser.add_argument("--manufacturer", type=lambda v: int(v, 0), default=NXP_MANUFACTURER_CODE)
+    parser.add_argument("--image-type", type=lambda v: int(v, 0), default=0)
+    parser.add_argument("--delta-image-type", type=lambda v: int(v, 0),
+                        help="Image type of the delta file (default: --image-type ^ 0x%04x)" % DELTA_IMAGE_TYPE_BIT)
+    parser.add_argument("--header-string", default="")
+    parser.add_argument("--base", help="Previous release (.bin or .ota) to build a delta against")
+    parser.add_argument("--key", help="AES-128 key (hex, or a file holding it)")
+    parser.add_argument("--iv", help="AES-CTR IV each sub-element's initial counter block is derived from (hex, or a file)")
+    parser.add_argument("--experimental", action="store_true",
+                        help="Allow --base and --key, whose files the SDK's OTA client can't use")
+    args = parser.parse_args(argv)
+
+    if (args.base or args.key) and not args.experimental:
+        parser.error("--base and --key build files the SDK's OTA client can't use; add --experimental")
+
+    try:
+        with open(args.image, "rb") as fp:
+            image = fp.read()
+        key = parse_key(args.key) if args.key else None
+        iv = parse_key(args.iv) if args.iv else None
+        base = read_image(args.base) if args.base else None
+        full, delta = make_ota_files(image, args.manufacturer, args.image_type, args.version,
+                                     args.header_string, base, key, iv,
+                                     delta_image_type=args.delta_image_type)
+    except (OtaError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    with open(args.output, "wb") as fp:
+        fp.write(delta if delta is not None else full)
+    print("OTA image: %d bytes%s" % (len(full), (
+        ", delta: %d bytes (%.1f%%)" % (len(delta), 100.0 * len(delta) / len(full))
+        if delta is not None else "")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Upload port detection for JN516x devices
+
+Probes every candidate serial port at once with a bootloader Get Chip ID
+request, and picks the one whose chip matches the board (`build.mcu`), or the
+device with a given MAC address. Ports that don't answer (other adapters on
+the bench) are left alone after the probe times out.
+
+What was found on each port is remembered (by the port's USB serial number
+and location), so the next upload uses the same port without probing as
+long as the same adapter is still plugged into it. Ports without a USB
+identity are always probed. The uploader checks the MAC of the device it
+connects to against the one found, in case another board is now on the
+adapter.
+
+    python -m jn51xx.portdetect --mcu JN5169
+    python -m jn51xx.portdetect --ports "/dev/pts/*" --mac 00:15:8d:00:00:00:00:01
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, exists, isdir
+
+from . import protocol as bl
+from .batch import expand_ports
+from .uploader import open_port
+
+Device = namedtuple("Device", ["port", "chip_id", "mac", "usb"])
+
+PROBE_TIMEOUT = 0.3
+CACHE_VERSION = 1
+
+
+class PortDetectError(Exception):
+    pass
+
+
+def list_ports():
+    """{port: USB identity} of the serial ports on the host
+
+    Only USB adapters are candidates: built-in UARTs and Bluetooth ports are
+    never a JN516x bootloader, and probing them is slow."""
+    from serial.tools import list_ports as lp
+    ports = {}
+    for info in lp.comports():
+        if info.vid is None:
+            continue
+        ports[info.device] = "%04X:%04X %s %s" % (info.vid, info.pid, info.serial_number or "",
+                                                  info.location or "")
+    return ports
+
+
+def probe(port, timeout=PROBE_TIMEOUT, usb=""):
+    """The Device on `port`, or None if no bootloader answers"""
+    try:
+        serial = open_port(port, bl.BOOTLOADER_BAUD)
+    except (IOError, ValueError):
+        return None
+    try:
+        serial.reset_input_buffer()
+        bootloader = bl.Bootloader(serial, timeout)
+        chip_id = bootloader.get_chip_id()
+        mac = bootloader.read_mac()
+    except (bl.BootloaderError, IOError):
+        return None
+    finally:
+        serial.close()
+    return Device(port, chip_id, mac, usb)
+
+
+def parse_mac(text):
+    digits = "".join(c for c in str(text) if c not in ":-. ")
+    if len(digits) != 16:
+        raise PortDetectError("Invalid MAC address '%s'" % text)
+    try:
+        return bytes(bytearray.fromhex(digits))
+    except ValueError:
+        raise PortDetectError("Invalid MAC address '%s'" % text)
+
+
+def matches(device, mcu=None, mac=None):
+    if mac is not None:
+        return device.mac == mac
+    return mcu is None or bl.chip_name(device.chip_id).upper() == mcu.upper()
+
+
+class PortCache(object):
+    """Devices last found on each port"""
+
+    def __init__(self, path):
+        self.path = path
+        self.devices = {}
+        if path and exists(path):
+            try:
+                with open(path) as fp:
+                    data = json.load(fp)
+            except ValueError:
+                data = {}
+            if data.get("version") == CACHE_VERSION:
+                for port, entry in data.get("ports", {}).items():
+                    self.devices[port] = Device(port, entry["chip_id"],
+                                                bytes(bytearray.fromhex(entry["mac"])), entry["usb"])
+
+    def lookup(self, ports, mcu=None, mac=None):
+        """Cached devices still on a port with the same adapter (ports
+        without a USB identity can't be told apart, so never match)"""
+        return [d for port, d in sorted(self.devices.items())
+                if port in ports and d.usb and ports[port] == d.usb and matches(d, mcu, mac)]
+
+    def update(self, devices):
+        for device in devices:
+            self.devices[device.port] = device
+        self.save()
+
+    def forget(self, port):
+        if self.devices.pop(port, None) is not None:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        if not isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        data = dict(version=CACHE_VERSION, ports=dict(
+            (d.port, dict(chip_id=d.chip_id, mac=bl.format_mac(d.mac).replace(":", ""), usb=d.usb))
+            for d in self.devices.values()))
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(data, fp, indent=1)
+        os.replace(tmp, self.path)
+
+
+def probe_all(ports, timeout=PROBE_TIMEOUT, workers=None):
+    """Devices answering on any of `ports` ({port: USB identity}), probed concurrently"""
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or min(32, len(ports))) as pool:
+        found = pool.map(lambda port: probe(port, timeout, ports[port]), sorted(ports))
+        return [d for d in found if d is not None]
+
+
+def describe(device):
+    return "%s (%s, MAC %s)" % (device.port, bl.chip_name(device.chip_id), bl.format_mac(device.mac))
+
+
+def detect(ports=None, mcu=None, mac=None, cache_path=None, timeout=PROBE_TIMEOUT, log=None):
+    """The Device to upload to
+
+    `ports` is a list of ports/globs to consider (default: every USB serial
+    port). Raises PortDetectError unless exactly one device matches.
+    """
+    log = log or (lambda msg: None)
+    if ports:
+        # Explicit ports are identified like any other, where they're USB adapters
+        try:
+            usb = list_ports()
+        except ImportError:
+            usb = {}
+        candidates = dict((p, usb.get(p, "")) for p in expand_ports(ports))
+    else:
+        candidates = list_ports()
+    cache = PortCache(cache_path)
+
+    cached = cache.lookup(candidates, mcu, mac)
+    if len(cached) == 1:
+        log("Using %s (remembered, not probed)" % describe(cached[0]))
+        return cached[0]
+
+    started = time.time()
+    found = probe_all(candidates, timeout)
+    log("Probed %d ports in %.1fs: %s" % (
+        len(candidates), time.time() - started,
+        ", ".join(describe(d) for d in found) or "no JN516x bootloader found"))
+    # Ports that no longer answer (eg. unplugged, or now running firmware) are forgotten
+    for port in candidates:
+        if port in cache.devices and port not in [d.port for d in found]:
+            cache.devices.pop(port)
+    cache.update(found)
+
+    selected = [d for d in found if matches(d, mcu, mac)]
+    wanted = "MAC %s" % bl.format_mac(mac) if mac is not None else (mcu or "JN516x")
+    if not selected:
+        raise PortDetectError("No %s in bootloader mode found on %d ports%s" % (
+            wanted, len(candidates), " (found %s)" % ", ".join(describe(d) for d in found) if found else ""))
+    if len(selected) > 1:
+        raise PortDetectError("Several %s devices found (%s): set `upload_port`, or `jennic_upload_mac` "
+                              "to pick one" % (wanted, ", ".join(describe(d) for d in selected)))
+    return selected[0]
+
+
+def forget(cache_path, port):
+    """Drop a port from the cache, eg. after an upload to it failed"""
+    PortCache(cache_path).forget(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the serial port of a JN516x in bootloader mode")
+    parser.add_argument("--ports", help="Ports or globs to probe (default: all USB serial ports)")
+    parser.add_argument("--mcu", help="Chip to look for, eg. JN5169")
+    parser.add_argument("--mac", help="MAC address of the device to look for")
+    parser.add_argument("--cache", help="Port cache file")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT)
+    args = parser.parse_args(argv)
+
+    try:
+        device = detect(args.ports, args.mcu, parse_mac(args.mac) if args.mac else None,
+                        args.cache, args.timeout, log=lambda msg: sys.stderr.write(msg + "\n"))
+    except PortDetectError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    print(device.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
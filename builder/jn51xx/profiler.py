@@ -0,0 +1,296 @@
+"""
+Function-level profile of the firmware from a `jennic_profile` trace
+
+Reads the entry/exit records the instrumented firmware streams over the UART
+(see frameworks/jennic/include/profiler.h), names the functions from the ELF
+symbol table and rebuilds the call trees. Reports the calls, total and self
+time of each function, and writes the folded stacks ("a;b;c <us>", as read by
+flamegraph.pl and speedscope) and a flame graph SVG.
+
+    python -m jn51xx.profiler firmware.elf --port /dev/ttyUSB1 --duration 10 --save trace.bin
+    python -m jn51xx.profiler firmware.elf --file trace.bin --svg profile.svg
+"""
+
+import argparse
+import json
+import struct
+import sys
+import time
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from . import elf
+
+ENTER = 0xE0
+EXIT = 0xE1
+DROPPED = 0xE2
+RECORD = struct.Struct(">BII")
+
+# Tick timer
+DEFAULT_CLOCK_HZ = 16000000
+
+
+class ProfilerError(Exception):
+    pass
+
+
+def parse_records(data):
+    """([(type, address or count, timestamp)], bytes skipped) from a capture
+
+    Bytes that don't start a record (eg. debug output on the same UART) are
+    skipped until the stream lines up again."""
+    records = []
+    skipped = 0
+    pos = 0
+    data = bytes(data)
+    while pos + RECORD.size <= len(data):
+        kind = bytearray(data[pos:pos + 1])[0]
+        if kind not in (ENTER, EXIT, DROPPED):
+            skipped += 1
+            pos += 1
+            continue
+        records.append(RECORD.unpack_from(data, pos))
+        pos += RECORD.size
+    return records, skipped + len(data) - pos
+
+
+def load_symbols(elf_path):
+    """{address: function name} from the ELF"""
+    try:
+        image = elf.ElfFile.open(elf_path)
+    except (IOError, elf.ElfError) as e:
+        raise ProfilerError("%s: %s" % (elf_path, e))
+    symbols = {}
+    for sym in image.symbols():
+        if sym.type == elf.STT_FUNC and sym.name:
+            symbols.setdefault(sym.value, sym.name)
+    if not symbols:
+        raise ProfilerError("%s has no function symbols" % elf_path)
+    return symbols
+
+
+class Profile(object):
+
+    def __init__(self, clock_hz=DEFAULT_CLOCK_HZ):
+        self.clock_hz = clock_hz
+        self.functions = defaultdict(lambda: dict(calls=0, total=0, self=0))
+        self.folded = defaultdict(int)
+        self.dropped = 0
+        self.unmatched = 0
+        self.elapsed = 0
+
+    def us(self, ticks):
+        return ticks * 1e6 / self.clock_hz
+
+
+def build(records, symbols, clock_hz=DEFAULT_CLOCK_HZ):
+    """Profile from the records; times are in clock ticks"""
+    profile = Profile(clock_hz)
+    stack = []  # [name, start, time in callees]
+    now = None
+    last = None
+
+    def close(frame):
+        name, start, callees = frame
+        duration = now - start
+        stats = profile.functions[name]
+        stats["calls"] += 1
+        stats["self"] += duration - callees
+        # Recursive calls are already covered by the outer call's total
+        if name not in [f[0] for f in stack]:
+            stats["total"] += duration
+        profile.folded[tuple(f[0] for f in stack) + (name,)] += duration - callees
+        if stack:
+            stack[-1][2] += duration
+
+    for kind, value, timestamp in records:
+        # 32-bit timestamps, unwrapped
+        now = 0 if last is None else now + ((timestamp - last) & 0xFFFFFFFF)
+        last = timestamp
+
+        if kind == DROPPED:
+            # The open calls can't be matched up any more
+            profile.dropped += value
+            del stack[:]
+            continue
+        name = symbols.get(value, "0x%08x" % value)
+        if kind == ENTER:
+            stack.append([name, now, 0])
+        elif name in [f[0] for f in stack]:
+            # Exits missed in between (eg. longjmp) close their calls here too
+            while True:
+                frame = stack.pop()
+                close(frame)
+                if frame[0] == name:
+                    break
+        else:
+            # Entered before the capture started
+            profile.unmatched += 1
+    profile.elapsed = now or 0
+    return profile
+
+
+def analyze(data, symbols, clock_hz=DEFAULT_CLOCK_HZ):
+    records, skipped = parse_records(data)
+    if not records:
+        raise ProfilerError("No profiler records in the capture (%d bytes)" % len(data))
+    profile = build(records, symbols, clock_hz)
+    profile.records = len(records)
+    profile.skipped = skipped
+    return profile
+
+
+def folded_lines(profile):
+    """Folded stacks in microseconds, the input format of flamegraph.pl"""
+    return ["%s %d" % (";".join(stack), round(profile.us(ticks)))
+            for stack, ticks in sorted(profile.folded.items()) if ticks > 0]
+
+
+def to_json(profile):
+    return dict(
+        clock_hz=profile.clock_hz,
+        elapsed_us=profile.us(profile.elapsed),
+        dropped=profile.dropped,
+        unmatched=profile.unmatched,
+        functions=dict((name, dict(calls=s["calls"], total_us=profile.us(s["total"]),
+                                   self_us=profile.us(s["self"])))
+                       for name, s in profile.functions.items()))
+
+
+def format_report(profile, top=20):
+    busy = sum(s["self"] for s in profile.functions.values()) or 1
+    lines = ["%-40s %8s %12s %12s %6s" % ("Function", "Calls", "Total (us)", "Self (us)", "Self")]
+    ranked = sorted(profile.functions.items(), key=lambda item: -item[1]["self"])
+    for name, s in ranked[:top]:
+        lines.append("%-40s %8d %12.1f %12.1f %5.1f%%" % (
+            name, s["calls"], profile.us(s["total"]), profile.us(s["self"]), 100.0 * s["self"] / busy))
+    if len(ranked) > top:
+        lines.append("(+%d more functions)" % (len(ranked) - top))
+    lines.append("")
+    lines.append("%.1f ms traced, %.1f ms in instrumented functions" % (
+        profile.us(profile.elapsed) / 1000, profile.us(busy) / 1000))
+    if profile.dropped:
+        lines.append("%d records dropped (ring buffer full): flush more often or raise "
+                     "PROFILER_BUFFER_SIZE" % profile.dropped)
+    if profile.unmatched:
+        lines.append("%d exits without an entry (calls in progress when the capture started)" %
+                     profile.unmatched)
+    return "\n".join(lines)
+
+
+def flame_graph(profile, width=1200, row_height=16, title="Flame graph"):
+    """SVG flame graph of the folded stacks"""
+    root = dict(name="all", value=0, children={})
+    for stack, ticks in profile.folded.items():
+        if ticks <= 0:
+            continue
+        node = root
+        node["value"] += ticks
+        for name in stack:
+            node = node["children"].setdefault(name, dict(name=name, value=0, children={}))
+            node["value"] += ticks
+
+    rects = []
+
+    def layout(node, x, depth):
+        rects.append((node, x, depth))
+        for child in sorted(node["children"].values(), key=lambda n: n["name"]):
+            layout(child, x, depth + 1)
+            x += child["value"]
+
+    layout(root, 0, 0)
+    depth = max(d for _, _, d in rects) + 1
+    height = (depth + 2) * row_height
+    scale = float(width) / (root["value"] or 1)
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="monospace" '
+           'font-size="11">' % (width, height),
+           '<text x="%d" y="%d" text-anchor="middle" font-size="13">%s</text>' % (
+               width // 2, row_height - 3, escape(title))]
+    for node, x, d in rects:
+        w = node["value"] * scale
+        if w < 0.5:
+            continue
+        y = height - (d + 1) * row_height
+        # Stable warm colour per function
+        h = sum(bytearray(node["name"].encode("utf-8"))) % 60
+        label = "%s (%.1f us, %.1f%%)" % (node["name"], profile.us(node["value"]),
+                                           100.0 * node["value"] / (root["value"] or 1))
+        out.append('<g><title>%s</title><rect x="%.1f" y="%d" width="%.1f" height="%d" '
+                   'fill="rgb(%d,%d,%d)" stroke="white" stroke-width="0.5"/>' % (
+                       escape(label), x * scale, y, w, row_height - 1, 200 + h, 80 + 2 * h, 40))
+        chars = int(w / 7)
+        if chars >= 3:
+            text = node["name"] if len(node["name"]) <= chars else node["name"][:chars - 2] + ".."
+            out.append('<text x="%.1f" y="%d">%s</text>' % (x * scale + 2, y + row_height - 4, escape(text)))
+        out.append('</g>')
+    out.append('</svg>')
+    return "\n".join(out)
+
+
+def capture(port, baud, duration=None, log=None):
+    """Raw bytes from the port, for `duration` seconds or until interrupted"""
+    from .uploader import open_port
+    serial = open_port(port, baud, timeout=0.1)
+    data = bytearray()
+    started = time.time()
+    try:
+        while duration is None or time.time() - started < duration:
+            data += serial.read(4096)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serial.close()
+    if log:
+        log("Captured %d bytes in %.1fs" % (len(data), time.time() - started))
+    return bytes(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile a JN516x firmware built with jennic_profile")
+    parser.add_argument("elf", help="The firmware.elf the trace was recorded from")
+    parser.add_argument("--port", help="Serial port to capture the trace from")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--duration", type=float, help="Seconds to capture (default: until Ctrl-C)")
+    parser.add_argument("--save", help="Also write the raw capture to this file")
+    parser.add_argument("--file", help="Analyse a saved capture instead")
+    parser.add_argument("--clock-hz", type=int, default=DEFAULT_CLOCK_HZ,
+                        help="Rate of the timestamps (default: the 16MHz tick timer)")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--folded", help="Write the folded stacks (for flamegraph.pl) to this file")
+    parser.add_argument("--svg", help="Write a flame graph to this file")
+    parser.add_argument("--json", help="Write the per-function totals to this file")
+    args = parser.parse_args(argv)
+    if not args.port and not args.file:
+        parser.error("--port or --file is required")
+
+    try:
+        symbols = load_symbols(args.elf)
+        if args.file:
+            with open(args.file, "rb") as fp:
+                data = fp.read()
+        else:
+            data = capture(args.port, args.baud, args.duration, log=print)
+            if args.save:
+                with open(args.save, "wb") as fp:
+                    fp.write(data)
+        profile = analyze(data, symbols, args.clock_hz)
+    except (ProfilerError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+    print(format_report(profile, args.top))
+    if args.folded:
+        with open(args.folded, "w") as fp:
+            fp.write("\n".join(folded_lines(profile)) + "\n")
+    if args.svg:
+        with open(args.svg, "w") as fp:
+            fp.write(flame_graph(profile, title=args.elf))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(to_json(profile), fp, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
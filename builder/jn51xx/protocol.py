@@ -0,0 +1,277 @@
+"""
+JN516x serial bootloader protocol
+
+Every message on the wire is framed as:
+
+    [length] [type] [payload ...] [checksum]
+
+where length counts the bytes following it (type, payload and checksum) and
+checksum is the XOR of every preceding byte in the message, including the
+length. Addresses and lengths in flash/RAM requests are little-endian, the
+chip ID is big-endian. See NXP JN-AN-1003 (Boot Loader Operation).
+"""
+
+import struct
+import time
+from collections import deque
+
+# Message types
+FLASH_ERASE_REQUEST         = 0x07
+FLASH_ERASE_RESPONSE        = 0x08
+FLASH_PROGRAM_REQUEST       = 0x09
+FLASH_PROGRAM_RESPONSE      = 0x0A
+FLASH_READ_REQUEST          = 0x0B
+FLASH_READ_RESPONSE         = 0x0C
+SECTOR_ERASE_REQUEST        = 0x0D
+SECTOR_ERASE_RESPONSE       = 0x0E
+RESET_REQUEST               = 0x14
+RESET_RESPONSE              = 0x15
+RAM_WRITE_REQUEST           = 0x1D
+RAM_WRITE_RESPONSE          = 0x1E
+RAM_READ_REQUEST            = 0x1F
+RAM_READ_RESPONSE           = 0x20
+RUN_REQUEST                 = 0x21
+RUN_RESPONSE                = 0x22
+READ_FLASH_ID_REQUEST       = 0x25
+READ_FLASH_ID_RESPONSE      = 0x26
+CHANGE_BAUD_RATE_REQUEST    = 0x27
+CHANGE_BAUD_RATE_RESPONSE   = 0x28
+SELECT_FLASH_TYPE_REQUEST   = 0x2C
+SELECT_FLASH_TYPE_RESPONSE  = 0x2D
+GET_CHIP_ID_REQUEST         = 0x32
+GET_CHIP_ID_RESPONSE        = 0x33
+EEPROM_READ_REQUEST         = 0x3A
+EEPROM_READ_RESPONSE        = 0x3B
+EEPROM_WRITE_REQUEST        = 0x3C
+EEPROM_WRITE_RESPONSE       = 0x3D
+
+# Response status codes
+STATUS_OK               = 0x00
+STATUS_NOT_SUPPORTED    = 0xFF
+STATUS_WRITE_FAIL       = 0xFE
+STATUS_INVALID_RESPONSE = 0xFD
+STATUS_CRC_ERROR        = 0xFC
+STATUS_ASSERT_FAIL      = 0xFB
+STATUS_USER_INTERRUPT   = 0xFA
+STATUS_READ_FAIL        = 0xF9
+STATUS_TST_ERROR        = 0xF8
+STATUS_AUTH_ERROR       = 0xF7
+STATUS_NO_RESPONSE      = 0xF6
+
+# The ROM bootloader always starts at 38400 baud. Faster rates are selected
+# with a divisor of the 1MHz UART reference clock.
+BOOTLOADER_BAUD = 38400
+MAX_BAUD = 1000000
+BAUD_RATES = [1000000, 500000, 250000, 115200, 38400]
+
+FLASH_TYPE_INTERNAL = 8
+FLASH_SECTOR_SIZE = 32 * 1024
+
+# Largest payload of a flash program/read request. The length field is one
+# byte, leaving 249 bytes for data after the type, address and checksum.
+MAX_BLOCK_SIZE = 248
+DEFAULT_BLOCK_SIZE = 128
+
+# Factory programmed MAC address (customer MAC lives at 0x01001570)
+MAC_ADDRESS_LOCATION = 0x01001580
+CUSTOMER_MAC_ADDRESS_LOCATION = 0x01001570
+
+# Lower 16 bits of the chip ID identify the part; upper bits are the revision
+CHIP_ID_MASK = 0x0000FFFF
+CHIPS = {
+    0x5686: ("JN5161", 64 * 1024),
+    0x8686: ("JN5164", 160 * 1024),
+    0x6686: ("JN5168", 256 * 1024),
+    0xB686: ("JN5169", 512 * 1024),
+}
+EEPROM_SIZES = {
+    "JN5161": 4 * 1024,
+    "JN5164": 4 * 1024,
+    "JN5168": 4 * 1024,
+    "JN5169": 16 * 1024,
+}
+
+
+class BootloaderError(Exception):
+    pass
+
+
+class BootloaderTimeout(BootloaderError):
+    pass
+
+
+def checksum(data):
+    value = 0
+    for b in bytearray(data):
+        value ^= b
+    return value
+
+
+def encode(msg_type, payload=b""):
+    payload = bytes(payload)
+    if len(payload) > 253:
+        raise BootloaderError("Payload too long (%d bytes)" % len(payload))
+    msg = bytearray([len(payload) + 2, msg_type]) + payload
+    msg.append(checksum(msg))
+    return bytes(msg)
+
+
+def decode(frame):
+    """Decode a complete frame (including the length byte) to (type, payload)"""
+    frame = bytearray(frame)
+    if len(frame) < 3 or frame[0] != len(frame) - 1:
+        raise BootloaderError("Malformed message")
+    if checksum(frame[:-1]) != frame[-1]:
+        raise BootloaderError("Checksum mismatch")
+    return frame[1], bytes(frame[2:-1])
+
+
+def baud_divisor(rate):
+    divisor = int(round(float(MAX_BAUD) / rate))
+    if not 1 <= divisor <= 255:
+        raise BootloaderError("Unsupported baud rate: %d" % rate)
+    return divisor
+
+
+def chip_name(chip_id):
+    return CHIPS.get(chip_id & CHIP_ID_MASK, ("unknown", 0))[0]
+
+
+def chip_flash_size(chip_id):
+    return CHIPS.get(chip_id & CHIP_ID_MASK, ("unknown", 0))[1]
+
+
+def chip_eeprom_size(chip_id):
+    return EEPROM_SIZES.get(chip_name(chip_id), 0)
+
+
+def format_mac(mac):
+    return ":".join("%02X" % b for b in bytearray(mac))
+
+
+class Bootloader(object):
+    """Request/response interface to a JN516x ROM bootloader
+
+    `port` is any pyserial-compatible object (read, write, baudrate).
+    """
+
+    def __init__(self, port, timeout=1.0):
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, msg_type, payload=b""):
+        self.port.write(encode(msg_type, payload))
+
+    def receive(self, response_type, timeout=None):
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        header = self._read(1, deadline)
+        frame = header + self._read(bytearray(header)[0], deadline)
+        msg_type, payload = decode(frame)
+        if msg_type != response_type:
+            raise BootloaderError("Unexpected response 0x%02X (expected 0x%02X)" % (
+                msg_type, response_type))
+        if not payload:
+            raise BootloaderError("Empty response 0x%02X" % msg_type)
+        status = bytearray(payload)[0]
+        if status != STATUS_OK:
+            raise BootloaderError("Request 0x%02X failed with status 0x%02X" % (
+                response_type - 1, status))
+        return payload[1:]
+
+    def request(self, msg_type, payload=b"", timeout=None):
+        self.send(msg_type, payload)
+        return self.receive(msg_type + 1, timeout)
+
+    def _read(self, size, deadline):
+        data = b""
+        while len(data) < size:
+            chunk = self.port.read(size - len(data))
+            if chunk:
+                data += chunk
+            elif time.time() > deadline:
+                raise BootloaderTimeout("Timed out waiting for bootloader response")
+        return data
+
+    #
+    # Identification
+    #
+
+    def get_chip_id(self):
+        payload = self.request(GET_CHIP_ID_REQUEST)
+        return struct.unpack(">I", payload[:4])[0]
+
+    def read_mac(self):
+        mac = self.read_ram(CUSTOMER_MAC_ADDRESS_LOCATION, 8)
+        if mac == b"\xff" * 8:
+            mac = self.read_ram(MAC_ADDRESS_LOCATION, 8)
+        return mac
+
+    def change_baud(self, rate):
+        self.request(CHANGE_BAUD_RATE_REQUEST, bytearray([baud_divisor(rate)]))
+
+    #
+    # Flash
+    #
+
+    def select_flash(self, flash_type=FLASH_TYPE_INTERNAL):
+        self.request(SELECT_FLASH_TYPE_REQUEST, struct.pack("<BI", flash_type, 0))
+
+    def erase_flash(self):
+        self.request(FLASH_ERASE_REQUEST, timeout=max(self.timeout, 10.0))
+
+    def erase_sector(self, sector):
+        self.request(SECTOR_ERASE_REQUEST, bytearray([sector]),
+                     timeout=max(self.timeout, 5.0))
+
+    def write_flash(self, address, data):
+        self.request(FLASH_PROGRAM_REQUEST, struct.pack("<I", address) + bytes(data))
+
+    def write_flash_blocks(self, blocks, window=1, progress=None):
+        """Program an iterable of (address, data) blocks
+
+        Up to `window` requests are written to the port back-to-back before
+        the first response is collected, so the device is never left idle
+        waiting for the host to turn the link around.
+        """
+        in_flight = deque()
+        written = 0
+        for address, data in blocks:
+            self.send(FLASH_PROGRAM_REQUEST, struct.pack("<I", address) + bytes(data))
+            in_flight.append(len(data))
+            if len(in_flight) >= window:
+                self.receive(FLASH_PROGRAM_RESPONSE)
+                written += in_flight.popleft()
+                if progress:
+                    progress(written)
+        while in_flight:
+            self.receive(FLASH_PROGRAM_RESPONSE)
+            written += in_flight.popleft()
+            if progress:
+                progress(written)
+        return written
+
+    def read_flash(self, address, length):
+        return self.request(FLASH_READ_REQUEST, struct.pack("<IH", address, length))
+
+    #
+    # EEPROM (the PDM's storage)
+    #
+
+    def read_eeprom(self, address, length):
+        return self.request(EEPROM_READ_REQUEST, struct.pack("<IH", address, length))
+
+    def write_eeprom(self, address, data):
+        self.request(EEPROM_WRITE_REQUEST, struct.pack("<I", address) + bytes(data))
+
+    #
+    # RAM
+    #
+
+    def read_ram(self, address, length):
+        return self.request(RAM_READ_REQUEST, struct.pack("<IH", address, length))
+
+    def write_ram(self, address, data):
+        self.request(RAM_WRITE_REQUEST, struct.pack("<I", address) + bytes(data))
+
+    def reset(self):
+        self.send(RESET_REQUEST)
@@ -0,0 +1,248 @@
+"""
+Per-device EEPROM provisioning images
+
+Builds the data a device should leave the line with (install code, keys, any
+application records) from a JSON table keyed by MAC address, so it can be
+written to the EEPROM in the same bootloader session as the flash image,
+for the application to read and apply.
+
+    {
+        "offset": 3840,
+        "defaults": {"network_key": "000102030405060708090a0b0c0d0e0f"},
+        "devices": {
+            "00:15:8d:00:00:00:00:01": {
+                "install_code": "83FED3407A939723A5C639B26916D505",
+                "records": {"0x0101": "deadbeef"}
+            }
+        }
+    }
+
+The records are written as one block at `offset` (by default the last four
+64-byte EEPROM segments, wherever the chip's EEPROM ends: 4 KB on the
+JN5161/4/8, 16 KB on the JN5169), little-endian:
+
+    "JNPV"  u16 version  u16 record count
+    per record: u16 id, u16 length, data (padded to 4 bytes)
+    u32 CRC-32 of everything before it, then 0xFF up to the block size
+
+Nothing in the SDK reads the block: the application keeps its segments out
+of the PDM's range and reads it itself, eg. with
+iAHI_ReadDataFromEEPROMsegment() from segment u16AHI_InitialiseEEP() - 4 on,
+checking the magic, version and CRC (the zlib CRC-32) before looking records
+up by ID.
+
+    python -m jn51xx.provision devices.json --mac 00158d0000000001 --eeprom-size 16384 -o device.eeprom
+"""
+
+import argparse
+import binascii
+import json
+import re
+import struct
+import sys
+
+# JN5161/4/8 (the JN5169 has 16 KB, see protocol.EEPROM_SIZES)
+DEFAULT_EEPROM_SIZE = 4 * 1024
+EEPROM_SEGMENT_SIZE = 64
+DEFAULT_SIZE = 4 * EEPROM_SEGMENT_SIZE
+
+MAGIC = b"JNPV"
+VERSION = 1
+
+# Well-known records, which may be given by name in the table
+NAMED_RECORDS = {
+    "install_code":     0xF001,
+    "link_key":         0xF002,
+    "network_key":      0xF003,
+    "extended_pan_id":  0xF004,
+    "channel_mask":     0xF005,
+}
+
+INSTALL_CODE_SIZES = (6, 8, 12, 16)
+KEY_SIZE = 16
+
+
+class ProvisionError(Exception):
+    pass
+
+
+def parse_mac(text):
+    digits = re.sub(r"[^0-9a-fA-F]", "", str(text))
+    if len(digits) != 16:
+        raise ProvisionError("Invalid MAC address '%s'" % text)
+    return binascii.unhexlify(digits)
+
+
+def parse_hex(value, what):
+    digits = re.sub(r"[\s:\-]", "", str(value))
+    try:
+        return binascii.unhexlify(digits)
+    except (TypeError, ValueError, binascii.Error):
+        raise ProvisionError("%s: '%s' is not a hex string" % (what, value))
+
+
+def crc16_x25(data):
+    """CRC-16/X-25, the CRC appended to Zigbee install codes"""
+    crc = 0xFFFF
+    for b in bytearray(data):
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+    return crc ^ 0xFFFF
+
+
+def install_code(value):
+    """Install code with its CRC, adding the CRC if it was left off"""
+    code = parse_hex(value, "install_code")
+    if len(code) in INSTALL_CODE_SIZES:
+        return code + struct.pack("<H", crc16_x25(code))
+    if len(code) - 2 in INSTALL_CODE_SIZES:
+        if struct.unpack("<H", code[-2:])[0] != crc16_x25(code[:-2]):
+            raise ProvisionError("install_code: CRC doesn't match")
+        return code
+    raise ProvisionError("install_code: must be 6, 8, 12 or 16 bytes (+ CRC), not %d" % len(code))
+
+
+def record_id(name):
+    if name in NAMED_RECORDS:
+        return NAMED_RECORDS[name]
+    try:
+        value = int(str(name), 0)
+    except ValueError:
+        raise ProvisionError("Unknown record '%s'" % name)
+    if not 0 <= value <= 0xFFFF:
+        raise ProvisionError("Record ID %s out of range" % name)
+    return value
+
+
+def parse_records(entry):
+    """{record id: data} of one device (or the defaults) in the table"""
+    records = {}
+    for name, value in entry.items():
+        if name == "records":
+            for rid, data in value.items():
+                records[record_id(rid)] = parse_hex(data, "record %s" % rid)
+        elif name == "install_code":
+            records[NAMED_RECORDS[name]] = install_code(value)
+        elif name in ("link_key", "network_key"):
+            key = parse_hex(value, name)
+            if len(key) != KEY_SIZE:
+                raise ProvisionError("%s: must be %d bytes" % (name, KEY_SIZE))
+            records[NAMED_RECORDS[name]] = key
+        elif name == "extended_pan_id":
+            records[NAMED_RECORDS[name]] = struct.pack("<Q", int(str(value), 16))
+        elif name == "channel_mask":
+            records[NAMED_RECORDS[name]] = struct.pack("<I", int(str(value), 0))
+        else:
+            raise ProvisionError("Unknown field '%s'" % name)
+    return records
+
+
+def encode_block(records, size=DEFAULT_SIZE):
+    body = MAGIC + struct.pack("<HH", VERSION, len(records))
+    for rid, data in sorted(records.items()):
+        body += struct.pack("<HH", rid, len(data)) + data + b"\xff" * (-len(data) % 4)
+    body += struct.pack("<I", binascii.crc32(body) & 0xFFFFFFFF)
+    if len(body) > size:
+        raise ProvisionError("Provisioning data is %d bytes, more than the %d reserved" % (len(body), size))
+    return body + b"\xff" * (size - len(body))
+
+
+def decode_block(data):
+    if data[:4] != MAGIC:
+        raise ProvisionError("No provisioning block (bad magic)")
+    version, count = struct.unpack("<HH", data[4:8])
+    if version != VERSION:
+        raise ProvisionError("Unsupported provisioning block version %d" % version)
+    records = {}
+    pos = 8
+    for _ in range(count):
+        rid, length = struct.unpack("<HH", data[pos:pos + 4])
+        records[rid] = bytes(data[pos + 4:pos + 4 + length])
+        pos += 4 + length + (-length % 4)
+    crc, = struct.unpack("<I", data[pos:pos + 4])
+    if crc != binascii.crc32(bytes(data[:pos])) & 0xFFFFFFFF:
+        raise ProvisionError("Provisioning block CRC mismatch")
+    return records
+
+
+class ProvisioningTable(object):
+
+    def __init__(self, table, path="<table>"):
+        self.path = path
+        # By default the block ends where the EEPROM does, which depends on the chip
+        self.offset = int(str(table["offset"]), 0) if "offset" in table else None
+        self.size = int(str(table["size"]), 0) if "size" in table else None
+        if (self.offset is not None and self.offset < 0) or (self.size is not None and self.size <= 0):
+            raise ProvisionError("%s: invalid block offset or size" % path)
+        self.defaults = parse_records(table.get("defaults", {}))
+        self.devices = {}
+        for mac, entry in table.get("devices", {}).items():
+            self.devices[parse_mac(mac)] = parse_records(entry)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as fp:
+                return cls(json.load(fp), path)
+        except ValueError as e:
+            raise ProvisionError("%s: %s" % (path, e))
+
+    def records(self, mac):
+        if mac not in self.devices and not self.defaults:
+            raise ProvisionError("No provisioning data for %s in %s" % (
+                ":".join("%02x" % b for b in bytearray(mac)), self.path))
+        records = dict(self.defaults)
+        records.update(self.devices.get(mac, {}))
+        return records
+
+    def layout(self, eeprom_size=DEFAULT_EEPROM_SIZE):
+        """(offset, size) of the block in an EEPROM of `eeprom_size` bytes"""
+        offset = self.offset
+        if offset is None:
+            offset = eeprom_size - (self.size or DEFAULT_SIZE)
+        size = self.size or eeprom_size - offset
+        if offset < 0 or size <= 0 or offset + size > eeprom_size:
+            raise ProvisionError("%s: block at %d (+%d) is outside the %d byte EEPROM" % (
+                self.path, offset, size, eeprom_size))
+        return offset, size
+
+    def image(self, mac, eeprom_size=DEFAULT_EEPROM_SIZE):
+        """(EEPROM offset, data) to write to the device with this MAC"""
+        offset, size = self.layout(eeprom_size)
+        return offset, encode_block(self.records(mac), size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build per-device EEPROM provisioning images")
+    parser.add_argument("table", nargs="?", help="Device table (JSON)")
+    parser.add_argument("--mac", help="Device to build the image for")
+    parser.add_argument("--eeprom-size", type=int, default=DEFAULT_EEPROM_SIZE,
+                        help="EEPROM size of the chip (default: %d, 16384 for the JN5169)" % DEFAULT_EEPROM_SIZE)
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--dump", metavar="IMAGE", help="List the records in a provisioning image")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.dump:
+            with open(args.dump, "rb") as fp:
+                records = decode_block(fp.read())
+            names = dict((v, k) for k, v in NAMED_RECORDS.items())
+            for rid, data in sorted(records.items()):
+                print("0x%04X %-16s %s" % (rid, names.get(rid, ""), binascii.hexlify(data).decode("ascii")))
+            return 0
+        if not args.table or not args.mac:
+            parser.error("table and --mac are required")
+        offset, data = ProvisioningTable.load(args.table).image(parse_mac(args.mac), args.eeprom_size)
+    except (ProvisionError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    if args.output:
+        with open(args.output, "wb") as fp:
+            fp.write(data)
+    print("%d bytes at EEPROM offset 0x%03X" % (len(data), offset))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
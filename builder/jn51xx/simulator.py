@@ -0,0 +1,345 @@
+"""
+Simulated JN516x serial bootloader
+
+Stands in for a real device when exercising the uploader on hosts without
+hardware (eg. Linux CI). The simulated device is exposed on a pseudo-terminal
+so it can be opened like any other serial port:
+
+    python -m jn51xx.simulator --chip JN5168 --count 4
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+
+from . import protocol as bl
+
+
+class SimulatedDevice(object):
+    """Bootloader state machine operating on an in-memory flash array"""
+
+    def __init__(self, chip="JN5168", mac=None, flash_size=None, revision=0x10000000):
+        chip_ids = dict((name, cid) for cid, (name, _) in bl.CHIPS.items())
+        if chip not in chip_ids:
+            raise ValueError("Unknown chip: %s" % chip)
+        self.chip = chip
+        self.chip_id = revision | chip_ids[chip]
+        self.flash_size = flash_size or bl.chip_flash_size(self.chip_id)
+        self.flash = bytearray(b"\xff" * self.flash_size)
+        self.eeprom = bytearray(b"\xff" * bl.chip_eeprom_size(self.chip_id))
+        self.ram = {}
+        self.mac = mac or b"\x00\x15\x8d\x00\x00\x00\x00\x01"
+        self.baudrate = bl.BOOTLOADER_BAUD
+        self.flash_selected = False
+        self.stats = dict(requests=0, erased=0, programmed=0, read=0)
+        self.lock = threading.Lock()
+
+    def handle(self, msg_type, payload):
+        """Process one request, returning (response_type, response_payload)"""
+        with self.lock:
+            self.stats["requests"] += 1
+            handler = self.HANDLERS.get(msg_type)
+            if handler is None:
+                return msg_type + 1, bytearray([bl.STATUS_NOT_SUPPORTED])
+            try:
+                data = handler(self, bytes(payload))
+            except (IndexError, struct.error, ValueError):
+                return msg_type + 1, bytearray([bl.STATUS_INVALID_RESPONSE])
+            if data is None:
+                return None
+            return msg_type + 1, bytearray([bl.STATUS_OK]) + data
+
+    def _get_chip_id(self, payload):
+        return struct.pack(">II", self.chip_id, 0x00080006)
+
+    def _change_baud(self, payload):
+        self.baudrate = int(bl.MAX_BAUD / bytearray(payload)[0])
+        return b""
+
+    def _select_flash(self, payload):
+        self.flash_selected = True
+        return b""
+
+    def _flash_erase(self, payload):
+        self.flash[:] = b"\xff" * self.flash_size
+        self.stats["erased"] += self.flash_size
+        return b""
+
+    def _sector_erase(self, payload):
+        start = bytearray(payload)[0] * bl.FLASH_SECTOR_SIZE
+        if start >= self.flash_size:
+            raise ValueError("Sector out of range")
+        self.flash[start:start + bl.FLASH_SECTOR_SIZE] = b"\xff" * bl.FLASH_SECTOR_SIZE
+        self.stats["erased"] += bl.FLASH_SECTOR_SIZE
+        return b""
+
+    def _flash_program(self, payload):
+        address, = struct.unpack("<I", payload[:4])
+        data = bytearray(payload[4:])
+        if address + len(data) > self.flash_size:
+            raise ValueError("Write out of range")
+        # NOR flash can only clear bits
+        for i, b in enumerate(data):
+            self.flash[address + i] &= b
+        self.stats["programmed"] += len(data)
+        return b""
+
+    def _flash_read(self, payload):
+        address, length = struct.unpack("<IH", payload[:6])
+        if address + length > self.flash_size:
+            raise ValueError("Read out of range")
+        self.stats["read"] += length
+        return bytes(self.flash[address:address + length])
+
+    def _eeprom_read(self, payload):
+        address, length = struct.unpack("<IH", payload[:6])
+        if address + length > len(self.eeprom):
+            raise ValueError("Read out of range")
+        return bytes(self.eeprom[address:address + length])
+
+    def _eeprom_write(self, payload):
+        address, = struct.unpack("<I", payload[:4])
+        data = bytearray(payload[4:])
+        if address + len(data) > len(self.eeprom):
+            raise ValueError("Write out of range")
+        self.eeprom[address:address + len(data)] = data
+        return b""
+
+    def _ram_read(self, payload):
+        address, length = struct.unpack("<IH", payload[:6])
+        if address == bl.MAC_ADDRESS_LOCATION:
+            return self.mac[:length]
+        return bytes(bytearray(self.ram.get(address + i, 0xff) for i in range(length)))
+
+    def _ram_write(self, payload):
+        address, = struct.unpack("<I", payload[:4])
+        for i, b in enumerate(bytearray(payload[4:])):
+            self.ram[address + i] = b
+        return b""
+
+    def _reset(self, payload):
+        self.baudrate = bl.BOOTLOADER_BAUD
+        return None
+
+    HANDLERS = {
+        bl.GET_CHIP_ID_REQUEST:         _get_chip_id,
+        bl.CHANGE_BAUD_RATE_REQUEST:    _change_baud,
+        bl.SELECT_FLASH_TYPE_REQUEST:   _select_flash,
+        bl.FLASH_ERASE_REQUEST:         _flash_erase,
+        bl.SECTOR_ERASE_REQUEST:        _sector_erase,
+        bl.FLASH_PROGRAM_REQUEST:       _flash_program,
+        bl.FLASH_READ_REQUEST:          _flash_read,
+        bl.EEPROM_READ_REQUEST:         _eeprom_read,
+        bl.EEPROM_WRITE_REQUEST:        _eeprom_write,
+        bl.RAM_READ_REQUEST:            _ram_read,
+        bl.RAM_WRITE_REQUEST:           _ram_write,
+        bl.RESET_REQUEST:               _reset,
+    }
+
+
+class SimulatedLink(object):
+    """A SimulatedDevice behind a modelled serial link, as a pyserial-compatible port
+
+    Nothing is actually sent at the baud rate: a virtual clock (`clock`, in
+    seconds) accounts for each byte on the wire (10 bits), each request's
+    processing time on the device (`TIMING`) and requests queued behind each
+    other, so programming time at any rate can be measured without waiting
+    for it. Requests sent while the host and device rates don't match are lost.
+    """
+
+    # Estimated device-side timings (seconds)
+    TIMING = dict(
+        request=50e-6,              # any request, from receiving it to starting the response
+        program_byte=4e-6,          # per byte programmed
+        sector_erase=0.05,          # per 32KB sector, also for a full erase
+        read_byte=0.2e-6,           # per byte read back
+    )
+
+    # Largest host/device rate mismatch a UART still receives correctly
+    BAUD_TOLERANCE = 0.04
+
+    def __init__(self, device=None, max_baud=bl.MAX_BAUD, timeout=0.05, **kwargs):
+        self.device = device or SimulatedDevice(**kwargs)
+        self.max_baud = max_baud
+        self.timeout = timeout
+        self._baudrate = bl.BOOTLOADER_BAUD
+        self.clock = 0.0
+        self.tx_free = 0.0          # host to device line
+        self.device_free = 0.0
+        self.rx_free = 0.0          # device to host line
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self._request = bytearray()
+        self._responses = []        # [(arrival time, bytes)]
+
+    def __str__(self):
+        return "simulated %s" % self.device.chip
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        if not bl.BOOTLOADER_BAUD <= rate <= self.max_baud:
+            raise ValueError("Unsupported baud rate: %d" % rate)
+        self._baudrate = rate
+
+    @staticmethod
+    def wire_time(size, rate):
+        return size * 10.0 / rate
+
+    def busy_time(self, msg_type, payload):
+        timing = self.TIMING
+        busy = timing["request"]
+        if msg_type == bl.FLASH_PROGRAM_REQUEST:
+            busy += (len(payload) - 4) * timing["program_byte"]
+        elif msg_type == bl.SECTOR_ERASE_REQUEST:
+            busy += timing["sector_erase"]
+        elif msg_type == bl.FLASH_ERASE_REQUEST:
+            busy += timing["sector_erase"] * (self.device.flash_size // bl.FLASH_SECTOR_SIZE)
+        elif msg_type in (bl.FLASH_READ_REQUEST, bl.EEPROM_READ_REQUEST):
+            busy += struct.unpack("<IH", payload[:6])[1] * timing["read_byte"]
+        return busy
+
+    def write(self, data):
+        data = bytes(data)
+        self.tx_bytes += len(data)
+        start = max(self.clock, self.tx_free)
+        self.tx_free = start + self.wire_time(len(data), self._baudrate)
+        self._request += data
+        while self._request and len(self._request) >= self._request[0] + 1:
+            frame = self._request[:self._request[0] + 1]
+            del self._request[:len(frame)]
+            self._deliver(frame)
+        return len(data)
+
+    def _deliver(self, frame):
+        device_baud = self.device.baudrate
+        # The device's rate is a divisor of 1MHz, so only close to the host's
+        if abs(device_baud - self._baudrate) > self.BAUD_TOLERANCE * self._baudrate:
+            return
+        try:
+            msg_type, payload = bl.decode(frame)
+        except bl.BootloaderError:
+            return
+        start = max(self.tx_free, self.device_free)
+        self.device_free = start + self.busy_time(msg_type, payload)
+        response = self.device.handle(msg_type, payload)
+        if response is None:
+            return
+        data = bl.encode(*response)
+        # The response goes out at the rate the request came in at
+        start = max(self.device_free, self.rx_free)
+        self.rx_free = start + self.wire_time(len(data), device_baud)
+        self._responses.append((self.rx_free, bytearray(data)))
+
+    @property
+    def in_waiting(self):
+        return sum(len(data) for arrival, data in self._responses if arrival <= self.clock)
+
+    def read(self, size=1):
+        if not self._responses:
+            self.clock += self.timeout
+            return b""
+        arrival, data = self._responses[0]
+        # Waits for the next response to arrive
+        self.clock = max(self.clock, arrival)
+        chunk = bytes(data[:size])
+        del data[:size]
+        if not data:
+            self._responses.pop(0)
+        self.rx_bytes += len(chunk)
+        return chunk
+
+    def reset_input_buffer(self):
+        self._responses = [(arrival, data) for arrival, data in self._responses
+                           if arrival > self.clock]
+
+    def close(self):
+        pass
+
+
+class PtyBootloader(object):
+    """Serve a SimulatedDevice on the slave side of a pseudo-terminal"""
+
+    def __init__(self, device=None, **kwargs):
+        import tty
+        self.device = device or SimulatedDevice(**kwargs)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name="jn51xx-sim")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1.0)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self):
+        import select
+        buf = bytearray()
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                return
+            while buf and len(buf) >= buf[0] + 1:
+                frame, buf = buf[:buf[0] + 1], buf[buf[0] + 1:]
+                try:
+                    msg_type, payload = bl.decode(frame)
+                except bl.BootloaderError:
+                    # Lost sync; a real bootloader would wait for a timeout
+                    buf = bytearray()
+                    break
+                response = self.device.handle(msg_type, payload)
+                if response is not None:
+                    os.write(self.master, bl.encode(*response))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated JN516x bootloader on a pty")
+    parser.add_argument("--chip", default="JN5168", choices=[n for n, _ in bl.CHIPS.values()])
+    parser.add_argument("--count", type=int, default=1, help="Number of devices to simulate")
+    args = parser.parse_args(argv)
+
+    sims = []
+    for i in range(args.count):
+        mac = struct.pack(">Q", 0x00158d0000000001 + i)
+        sim = PtyBootloader(chip=args.chip, mac=mac).start()
+        sims.append(sim)
+        print(sim.port)
+    sys.stdout.flush()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    for sim in sims:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
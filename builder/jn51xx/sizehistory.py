@@ -0,0 +1,242 @@
+"""
+Footprint history of a project's builds, and comparison between them
+
+Every build appends a compact record of its footprint report (totals,
+sections, libraries and symbol sizes) to a JSON-lines file, tagged with the
+git commit it was built from. Any two records, or a record and a saved
+`firmware.size.json`, can then be diffed to find what grew.
+
+    python -m jn51xx.sizehistory list .pio/size-history/dimmable-light.jsonl
+    python -m jn51xx.sizehistory diff .pio/size-history/dimmable-light.jsonl --baseline 1a2b3c4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import dirname, exists, isdir
+
+DEFAULT_LIMIT = 500
+
+
+def git_revision(path):
+    """(commit, dirty) of the git checkout at `path`, or (None, False)"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=path, stderr=subprocess.STDOUT)
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=path, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit.decode("ascii").strip(), bool(status.strip())
+
+
+def make_record(report, elf_hash, commit=None, dirty=False):
+    """Condense a footprint report into a history record"""
+    return dict(
+        time=int(time.time()),
+        commit=commit,
+        dirty=dirty,
+        elf_hash=elf_hash,
+        flash=report["flash"],
+        ram=report["ram"],
+        sections=dict((s["name"], s["size"]) for s in report["sections"]),
+        archives=dict((a["name"], [a["flash"], a["ram"]]) for a in report["archives"] or []),
+        symbols=dict((s["name"], s["size"]) for s in report["symbols"]),
+    )
+
+
+def hash_elf(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SizeHistory(object):
+
+    def __init__(self, path, limit=DEFAULT_LIMIT):
+        self.path = path
+        self.limit = limit
+
+    def records(self):
+        if not exists(self.path):
+            return []
+        records = []
+        with open(self.path) as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Truncated by an interrupted build
+                    continue
+        return records
+
+    def append(self, record):
+        """Add a record, unless it is the same image as the latest one"""
+        records = self.records()
+        if records and records[-1].get("elf_hash") == record["elf_hash"]:
+            return False
+        records.append(record)
+        if not isdir(dirname(self.path) or "."):
+            os.makedirs(dirname(self.path))
+        if len(records) > self.limit:
+            records = records[-self.limit:]
+            self._rewrite(records)
+        else:
+            with open(self.path, "a") as fp:
+                fp.write(json.dumps(record, sort_keys=True) + "\n")
+        return True
+
+    def _rewrite(self, records):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            for record in records:
+                fp.write(json.dumps(record, sort_keys=True) + "\n")
+        os.replace(tmp, self.path)
+
+    def baseline(self, spec, current):
+        """Record to compare `current` against
+
+        `spec` is "previous" (the latest build of a different image), a git
+        commit (or prefix), or the path of a footprint report (.size.json).
+        """
+        if spec and spec != "previous" and exists(spec):
+            with open(spec) as fp:
+                data = json.load(fp)
+            if "elf_hash" not in data:
+                data = make_record(data, None)
+            return data
+
+        for record in reversed(self.records()):
+            if record.get("elf_hash") == current.get("elf_hash"):
+                continue
+            if not spec or spec == "previous":
+                return record
+            if record.get("commit") and record["commit"].startswith(spec) and not record.get("dirty"):
+                return record
+        return None
+
+
+def _delta(old, new):
+    """List of (name, old, new, delta) for entries that changed size"""
+    changes = []
+    for name in set(old) | set(new):
+        a, b = old.get(name, 0), new.get(name, 0)
+        if a != b:
+            changes.append((name, a, b, b - a))
+    changes.sort(key=lambda c: (-abs(c[3]), c[0]))
+    return changes
+
+
+def diff(baseline, current):
+    archives_old = baseline.get("archives") or {}
+    archives_new = current.get("archives") or {}
+    return dict(
+        flash=(baseline["flash"], current["flash"], current["flash"] - baseline["flash"]),
+        ram=(baseline["ram"], current["ram"], current["ram"] - baseline["ram"]),
+        sections=_delta(baseline.get("sections") or {}, current.get("sections") or {}),
+        archives_flash=_delta(dict((k, v[0]) for k, v in archives_old.items()),
+                              dict((k, v[0]) for k, v in archives_new.items())),
+        archives_ram=_delta(dict((k, v[1]) for k, v in archives_old.items()),
+                            dict((k, v[1]) for k, v in archives_new.items())),
+        symbols=_delta(baseline.get("symbols") or {}, current.get("symbols") or {}),
+    )
+
+
+def parse_threshold(value):
+    """"2048" (bytes) or "1.5%" -> (bytes, percent), either may be None"""
+    if value is None or str(value).strip() == "":
+        return None, None
+    value = str(value).strip()
+    if value.endswith("%"):
+        return None, float(value[:-1])
+    return int(value), None
+
+
+def check_growth(changes, max_flash=None, max_ram=None):
+    """Messages for each region whose growth exceeds its threshold"""
+    errors = []
+    for region, threshold in (("Flash", max_flash), ("RAM", max_ram)):
+        limit_bytes, limit_percent = parse_threshold(threshold)
+        old, new, delta = changes[region.lower()]
+        if limit_bytes is not None and delta > limit_bytes:
+            errors.append("%s grew by %d bytes (%d -> %d), limit is %d bytes" % (
+                region, delta, old, new, limit_bytes))
+        elif limit_percent is not None and old and 100.0 * delta / old > limit_percent:
+            errors.append("%s grew by %.2f%% (%d -> %d), limit is %g%%" % (
+                region, 100.0 * delta / old, old, new, limit_percent))
+    return errors
+
+
+def describe(record):
+    if record.get("commit"):
+        return "%s%s" % (record["commit"][:10], "+" if record.get("dirty") else "")
+    if record.get("time"):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(record["time"]))
+    return "baseline"
+
+
+def format_diff(changes, baseline, current, top=10):
+    lines = ["Comparing %s -> %s" % (describe(baseline), describe(current))]
+    for label, region in (("Flash:", "flash"), ("RAM:", "ram")):
+        old, new, delta = changes[region]
+        lines.append("%-6s %8d -> %8d  %+7d" % (label, old, new, delta))
+
+    for title, key in (("Section", "sections"), ("Library (flash)", "archives_flash"),
+                       ("Library (RAM)", "archives_ram"), ("Symbol", "symbols")):
+        entries = changes[key][:top]
+        if not entries:
+            continue
+        lines += ["", "%-36s %8s %8s %8s" % (title, "Before", "After", "Delta")]
+        for name, old, new, delta in entries:
+            lines.append("%-36s %8d %8d %+8d" % (name, old, new, delta))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Firmware footprint history")
+    sub = parser.add_subparsers(dest="command")
+    p_list = sub.add_parser("list", help="List recorded builds")
+    p_list.add_argument("history")
+    p_diff = sub.add_parser("diff", help="Compare the latest build with a baseline")
+    p_diff.add_argument("history")
+    p_diff.add_argument("--baseline", default="previous",
+                        help="'previous', a git commit, or a .size.json report")
+    p_diff.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    history = SizeHistory(args.history)
+    records = history.records()
+    if args.command == "list":
+        for record in records:
+            print("%-16s %-12s flash %8d  ram %6d" % (
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(record["time"])),
+                (record.get("commit") or "-")[:10] + ("+" if record.get("dirty") else ""),
+                record["flash"], record["ram"]))
+        return 0
+    if args.command == "diff":
+        if not records:
+            sys.stderr.write("Error: No builds recorded in %s\n" % args.history)
+            return 1
+        current = records[-1]
+        baseline = history.baseline(args.baseline, current)
+        if baseline is None:
+            sys.stderr.write("Error: No baseline matching '%s'\n" % args.baseline)
+            return 1
+        print(format_diff(diff(baseline, current), baseline, current, args.top))
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+"""
+Worst-case stack depth of a linked firmware image
+
+Combines the per-function stack usage the compiler reports (`-fstack-usage`,
+one .su file per object) with the call graph from the disassembly of the
+ELF, and works out the deepest call chain from each entry point: the
+application's AppColdStart/AppWarmStart, the os_irq* interrupt handlers and,
+given the JenOS configuration, every OS task and ISR. The OS dispatches
+those through tables, so they can't be found in the call graph, and both
+preempt each other by priority on the one stack: the worst case counts the
+deepest task of every task priority plus the deepest ISR of every interrupt
+priority.
+
+Functions without a .su file (prebuilt SDK libraries) have their frame size
+estimated from the stack pointer adjustment in their prologue. The .su files
+are written before link time optimisation, which can inline callees into a
+function (and renames static ones, eg. foo.lto_priv.0), so the larger of the
+two is used wherever both are known. While anything reachable can't be
+accounted for (indirect calls, frames that didn't come from the compiler,
+recursion) the worst case is only a lower bound and no stack size is
+suggested.
+
+    python -m jn51xx.stackusage firmware.elf --su-dir .pio/build/<env> --stack-size 6000 --os-config app.oscfgdiag
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from os.path import join
+
+from . import osconfig, xmi
+
+# "file.c:12:6:vAppMain	48	static"
+SU_RE = re.compile(r"^(?:.*?:\d+:\d+:)?(\S+)\s+(\d+)\s+(\S+)")
+
+# Disassembly (objdump -d) lines
+FUNCTION_RE = re.compile(r"^[0-9a-fA-F]+ <([^>]+)>:$")
+CALL_RE = re.compile(r"\b(?:b[nwt]?\.jal|call|bl|jal)\s+[0-9a-fA-F]+ <([^>+]+)>")
+TAIL_CALL_RE = re.compile(r"\b(?:b[nwt]?\.j|jmp|b)\s+[0-9a-fA-F]+ <([^>+]+)>")
+INDIRECT_CALL_RE = re.compile(r"\b(?:b[nwt]?\.jalr\b|call\s+\*)")
+FRAME_RE = re.compile(r"\b(?:b[nwt]?)\.addi\s+r1,\s*r1,\s*(-(?:0x[0-9a-fA-F]+|\d+))")
+
+# Suffixes gcc gives the copies of functions it makes (LTO, cloning, splitting)
+CLONE_SUFFIX_RE = re.compile(r"\.(?:lto_priv|constprop|isra|part|cold)\.\d+.*$")
+
+TASK_ENTRY_POINTS = ["AppColdStart", "AppWarmStart"]
+IRQ_ENTRY_PREFIX = "os_irq"
+
+HEAP_ALLOCATORS = ["malloc", "calloc", "realloc", "_malloc_r", "pvHeap_Alloc"]
+
+DEFAULT_MARGIN = 0.1
+
+
+class StackUsageError(Exception):
+    pass
+
+
+def parse_su(paths):
+    """{function: (bytes, qualifier)} from .su files (static, dynamic, bounded)"""
+    usage = {}
+    for path in paths:
+        with open(path) as fp:
+            for line in fp:
+                m = SU_RE.match(line.strip())
+                if not m:
+                    continue
+                name, size, qualifier = m.group(1), int(m.group(2)), m.group(3)
+                # Static functions of the same name in different files: assume the larger
+                if name not in usage or usage[name][0] < size:
+                    usage[name] = (size, qualifier)
+    return usage
+
+
+def find_su_files(root):
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        found += [join(dirpath, f) for f in filenames if f.endswith(".su")]
+    return sorted(found)
+
+
+def parse_disassembly(text):
+    """{function: dict(calls, indirect, frame)} from `objdump -d` output"""
+    functions = {}
+    current = None
+    for line in text.splitlines():
+        m = FUNCTION_RE.match(line.strip())
+        if m:
+            current = functions.setdefault(m.group(1), dict(calls=set(), indirect=False, frame=None))
+            continue
+        if current is None:
+            continue
+        m = CALL_RE.search(line) or TAIL_CALL_RE.search(line)
+        if m:
+            current["calls"].add(m.group(1))
+        elif INDIRECT_CALL_RE.search(line):
+            current["indirect"] = True
+        m = FRAME_RE.search(line)
+        if m:
+            frame = -int(m.group(1), 0)
+            current["frame"] = max(current["frame"] or 0, frame)
+    return functions
+
+
+def disassemble(elf_path, objdump="ba-elf-objdump"):
+    try:
+        return subprocess.check_output([objdump, "-d", elf_path]).decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise StackUsageError("Could not disassemble %s with %s: %s" % (elf_path, objdump, e))
+
+
+def base_name(name):
+    """Source name of a function gcc made a copy of (foo.lto_priv.0 is foo)"""
+    return CLONE_SUFFIX_RE.sub("", name)
+
+
+class CallGraph(object):
+
+    def __init__(self, functions, usage):
+        self.functions = functions
+        self.usage = usage
+        self.depths = {}
+        self.unknown = set()
+        self.estimated = set()
+        self.recursive = set()
+
+    def frame(self, name):
+        estimate = self.functions.get(name, {}).get("frame")
+        usage = self.usage.get(name) or self.usage.get(base_name(name))
+        if usage is not None:
+            # Pre-LTO figure; LTO may have inlined more into the function since
+            return max(usage[0], estimate or 0)
+        if estimate is None:
+            self.unknown.add(name)
+            return 0
+        self.estimated.add(name)
+        return estimate
+
+    def find(self, *names):
+        """The function of the first of `names` in the image, allowing for LTO renaming"""
+        for name in names:
+            if name in self.functions:
+                return name
+        for name in names:
+            for function in sorted(self.functions):
+                if base_name(function) == name:
+                    return function
+        return None
+
+    def depth(self, name, stack=()):
+        """(worst stack bytes, call path) from entering `name`"""
+        if name in self.depths:
+            return self.depths[name]
+        if name in stack:
+            self.recursive.add(name)
+            return 0, []
+        worst, path = 0, []
+        for callee in sorted(self.functions.get(name, {}).get("calls", ())):
+            depth, callee_path = self.depth(callee, stack + (name,))
+            if depth > worst:
+                worst, path = depth, callee_path
+        result = (self.frame(name) + worst, [name] + path)
+        self.depths[name] = result
+        return result
+
+    def reachable(self, roots):
+        seen = set()
+        pending = list(roots)
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            pending += self.functions.get(name, {}).get("calls", ())
+        return seen
+
+
+def round_up(value, align=8):
+    return (value + align - 1) // align * align
+
+
+def nested_depth(entries):
+    """Stack of `entries` preempting each other: the deepest of each priority
+    level on top of one another (equal priorities don't preempt each other)"""
+    levels = {}
+    for e in entries:
+        level = e["priority"] if e["priority"] is not None else e["name"]
+        levels[level] = max(levels.get(level, 0), e["depth"])
+    return sum(levels.values())
+
+
+def analyze(elf_path, su_files, objdump="ba-elf-objdump", stack_size=None, heap_size=None,
+            margin=DEFAULT_MARGIN, disassembly=None, os_config=None):
+    """Worst-case stack depth report; `os_config` is an osconfig.OsConfig, for the OS tasks and ISRs"""
+    functions = parse_disassembly(disassembly if disassembly is not None
+                                  else disassemble(elf_path, objdump))
+    usage = parse_su(su_files)
+    graph = CallGraph(functions, usage)
+
+    entries = []
+    missing = []
+
+    def add_entry(name, kind, priority, *names):
+        function = graph.find(*names)
+        if function is None:
+            missing.append(name)
+            return
+        depth, path = graph.depth(function)
+        entries.append(dict(name=name, kind=kind, priority=priority, depth=depth, path=path))
+
+    for name in TASK_ENTRY_POINTS:
+        if name in functions:
+            add_entry(name, "start", None, name)
+    for name in sorted(f for f in functions if f.startswith(IRQ_ENTRY_PREFIX)):
+        add_entry(name, "dispatch", None, name)
+    if os_config is not None:
+        for t in os_config.tasks:
+            add_entry(t.name, "task", t.priority, osconfig.function_name(t.name), t.name)
+        for i in os_config.isrs:
+            add_entry(i.name, "irq", i.priority, osconfig.function_name(i.name), i.name)
+    if not entries:
+        raise StackUsageError("No entry points (%s, %s*) in %s" % (
+            "/".join(TASK_ENTRY_POINTS), IRQ_ENTRY_PREFIX, elf_path))
+
+    def of_kind(kind):
+        return [e for e in entries if e["kind"] == kind]
+
+    # A higher priority task can preempt a task at its deepest point, and so on up
+    task = max([e["depth"] for e in of_kind("start")] or [0]) + nested_depth(of_kind("task"))
+    dispatch = of_kind("dispatch")
+    isrs = of_kind("irq")
+    if isrs:
+        # Each nested interrupt goes through the dispatcher again
+        wrapper = max([e["depth"] for e in dispatch] or [0])
+        irq = nested_depth([dict(e, depth=wrapper + e["depth"]) for e in isrs])
+    else:
+        # Without the OS configuration the priority of each handler isn't
+        # known, so assume they can all nest
+        irq = nested_depth(dispatch)
+    # Interrupts can arrive at the tasks' deepest point
+    worst = task + irq
+
+    reachable = graph.reachable([e["path"][0] for e in entries])
+    allocators = sorted(a for a in HEAP_ALLOCATORS if a in reachable)
+    # "dynamic,bounded" frames are still covered by the reported size
+    dynamic = sorted(n for n in reachable if (usage.get(n) or usage.get(base_name(n)) or
+                                              (0, "static"))[1] == "dynamic")
+    indirect = sorted(n for n in reachable if functions.get(n, {}).get("indirect"))
+    unknown = sorted(graph.unknown & reachable)
+    estimated = sorted(graph.estimated & reachable)
+    recursive = sorted(graph.recursive)
+
+    # What the worst case can't account for, which makes it a lower bound. The
+    # generated os_irq* dispatchers are assembly, so their prologue is all there is
+    unaccounted = [title for title, names in (
+        ("indirect calls", indirect),
+        ("frames not from the compiler", unknown + [n for n in estimated if not n.startswith(IRQ_ENTRY_PREFIX)]),
+        ("recursion", recursive), ("dynamic stack allocation", dynamic),
+        ("OS tasks/ISRs not found in the image", missing)) if names]
+
+    return dict(
+        elf=elf_path,
+        entries=entries,
+        task=task,
+        irq=irq,
+        worst=worst,
+        stack_size=stack_size,
+        heap_size=heap_size,
+        margin=margin,
+        os_config=os_config is not None,
+        suggested_stack_size=None if unaccounted else round_up(int(worst * (1 + margin))),
+        unaccounted=unaccounted,
+        # Heap use can't be bounded statically; if nothing reachable allocates, none is needed
+        suggested_heap_size=0 if not allocators else heap_size,
+        allocators=allocators,
+        unknown=unknown,
+        estimated=estimated,
+        recursive=recursive,
+        dynamic=dynamic,
+        indirect=indirect,
+        missing=missing,
+        measured=len([n for n in reachable if n in usage or base_name(n) in usage]),
+        functions=len(reachable),
+    )
+
+
+def check(report):
+    errors = []
+    if report["stack_size"] is not None and report["worst"] > report["stack_size"]:
+        errors.append("Worst-case stack depth %d bytes exceeds the stack size of %d bytes" % (
+            report["worst"], report["stack_size"]))
+    return errors
+
+
+def format_report(report, top=10):
+    lines = ["%-32s %-8s %4s %6s  %s" % ("Entry point", "Kind", "Prio", "Stack", "Deepest path")]
+    for e in sorted(report["entries"], key=lambda e: -e["depth"]):
+        path = e["path"] if len(e["path"]) <= 6 else e["path"][:3] + ["..."] + e["path"][-2:]
+        lines.append("%-32s %-8s %4s %6d  %s" % (
+            e["name"], e["kind"], "-" if e["priority"] is None else e["priority"],
+            e["depth"], " > ".join(path)))
+    lines.append("")
+    lines.append("Worst case: %s%d bytes (tasks %d + nested interrupts %d)%s" % (
+        "at least " if report["unaccounted"] else "", report["worst"], report["task"], report["irq"],
+        "" if report["stack_size"] is None else ", stack size %d (%+d)" % (
+            report["stack_size"], report["stack_size"] - report["worst"])))
+    if not report["os_config"]:
+        lines.append("No OS configuration: OS tasks and ISRs aren't included, every os_irq* handler is assumed to nest")
+    if report["suggested_stack_size"] is not None:
+        lines.append("Suggested: jennic_stack_size = %d (%d%% margin)" % (
+            report["suggested_stack_size"], round(report["margin"] * 100)))
+    else:
+        lines.append("No stack size suggested, the worst case doesn't account for: %s" % (
+            ", ".join(report["unaccounted"])))
+    if report["allocators"]:
+        lines.append("Heap: allocated through %s, can't be bounded statically%s" % (
+            ", ".join(report["allocators"]), "" if report["heap_size"] is None else
+            " (jennic_min_heap_size = %d)" % report["heap_size"]))
+    else:
+        lines.append("Heap: nothing reachable allocates, jennic_min_heap_size = 0 is enough")
+
+    lines.append("Stack usage from the compiler for %d of %d reachable functions" % (
+        report["measured"], report["functions"]))
+    for key, title in (("recursive", "Recursive (depth not bounded)"),
+                       ("dynamic", "Dynamic stack allocation"),
+                       ("indirect", "Indirect calls (not followed)"),
+                       ("missing", "OS tasks/ISRs not in the image"),
+                       ("estimated", "Frame size estimated from the prologue"),
+                       ("unknown", "Unknown frame size (counted as 0)")):
+        if report[key]:
+            names = report[key]
+            lines.append("%s: %s%s" % (title, ", ".join(names[:top]),
+                                       " (+%d more)" % (len(names) - top) if len(names) > top else ""))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worst-case stack depth of a JN516x ELF image")
+    parser.add_argument("elf")
+    parser.add_argument("--su-dir", action="append", default=[],
+                        help="Directory to search for -fstack-usage .su files (may be repeated)")
+    parser.add_argument("--objdump", default="ba-elf-objdump")
+    parser.add_argument("--stack-size", type=int)
+    parser.add_argument("--heap-size", type=int)
+    parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN)
+    parser.add_argument("--os-config", help="JenOS configuration (.oscfgdiag), for the OS tasks and ISRs")
+    parser.add_argument("--json", help="Write the full report to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        os_config = osconfig.OsConfig(args.os_config) if args.os_config else None
+        report = analyze(args.elf, sum([find_su_files(d) for d in args.su_dir], []), args.objdump,
+                         args.stack_size, args.heap_size, args.margin, os_config=os_config)
+    except (StackUsageError, osconfig.OsConfigError, xmi.XmiError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(report, fp, indent=1)
+    errors = check(report)
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
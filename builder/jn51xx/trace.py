@@ -0,0 +1,207 @@
+"""
+Build phase timing
+
+Records when each build step (config generators, SDK library objects and
+archives, the link, image conversion, size check) starts and ends, then
+writes a Chrome trace file (open in chrome://tracing or ui.perfetto.dev) and
+prints a summary of where the time went.
+
+Steps are timed by wrapping the environment's SPAWN, which runs every
+command: a command writing one of the instrumented targets (its `-o` output,
+or the archive) is timed as building it. Unlike pre/post actions on the
+targets this leaves their build signatures alone, so turning tracing on or
+off doesn't rebuild anything. Steps that are up to date (or restored from a
+cache) don't show up at all; Python function actions are timed with span().
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import abspath, basename, dirname, isdir, normcase
+
+_active = None
+
+
+def start(path, log=print):
+    """Start tracing this build; the trace is written to `path` on exit"""
+    global _active
+    if _active is None:
+        _active = BuildTrace(path, log)
+        atexit.register(_active.finish)
+    return _active
+
+
+def active():
+    """The trace of this build, or None if tracing is off"""
+    return _active
+
+
+@contextmanager
+def span(name, category, group=None):
+    """Time a step of this build, if it's being traced"""
+    if _active is None:
+        yield
+    else:
+        with _active.span(name, category, group):
+            yield
+
+
+class BuildTrace(object):
+
+    def __init__(self, path, log=print):
+        self.path = path
+        self.log = log
+        self.origin = time.time()
+        self.events = []
+        self.pending = {}
+        self.targets = {}
+        self.target_events = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        """Microseconds since the build started"""
+        return int((time.time() - self.origin) * 1e6)
+
+    def _tid(self):
+        ident = threading.current_thread().ident
+        if ident not in self.threads:
+            self.threads[ident] = len(self.threads) + 1
+        return self.threads[ident]
+
+    def begin(self, key, name, category, group=None):
+        with self.lock:
+            self.pending[key] = (self.now(), name, category, group)
+
+    def end(self, key):
+        with self.lock:
+            started = self.pending.pop(key, None)
+            if started is None:
+                return
+            ts, name, category, group = started
+            self.events.append(dict(
+                name=name, cat=category, ph="X", ts=ts, dur=self.now() - ts,
+                pid=1, tid=self._tid(), args=dict(group=group or name)))
+
+    @contextmanager
+    def span(self, name, category, group=None):
+        key = object()
+        self.begin(key, name, category, group)
+        try:
+            yield
+        finally:
+            self.end(key)
+
+    def wrap(self, func, name, category):
+        """SCons action function `func`, timed"""
+        def timed(target, source, env):
+            with self.span(name, category):
+                return func(target, source, env)
+        timed.__name__ = getattr(func, "__name__", "action")
+        return timed
+
+    def hook(self, env):
+        """Time the commands `env` (and its clones from now on) runs that
+        build instrumented targets"""
+        spawn = env["SPAWN"]
+
+        def timed_spawn(sh, escape, cmd, args, spawn_env):
+            target = self._target_of(args)
+            if target is None:
+                return spawn(sh, escape, cmd, args, spawn_env)
+            started = self.now()
+            try:
+                return spawn(sh, escape, cmd, args, spawn_env)
+            finally:
+                self._record(target, started)
+
+        env["SPAWN"] = timed_spawn
+
+    def _target_of(self, args):
+        """The instrumented target a command line writes, if any"""
+        args = [str(a).strip("\"'") for a in args]
+        outputs = [args[i + 1] for i in range(len(args) - 1) if args[i] == "-o"]
+        outputs += [a[2:] for a in args if a.startswith("-o") and len(a) > 2]
+        # Without -o, the first target named (ar lists the archive before its objects)
+        for arg in outputs or args[1:]:
+            path = normcase(abspath(arg))
+            if path in self.targets:
+                return path
+        return None
+
+    def _record(self, target, started):
+        name, category, group = self.targets[target]
+        with self.lock:
+            event = self.target_events.get(target)
+            if event is not None:
+                # Another command of the same step (eg. ranlib after ar)
+                event["dur"] = self.now() - event["ts"]
+                return
+            event = dict(name=name, cat=category, ph="X", ts=started, dur=self.now() - started,
+                         pid=1, tid=self._tid(), args=dict(group=group or name))
+            self.target_events[target] = event
+            self.events.append(event)
+
+    def instrument(self, env, nodes, category, group=None):
+        """Time the building of each of `nodes` (by the commands hook() sees)"""
+        for node in nodes:
+            self.targets[normcase(node.get_abspath())] = (basename(str(node)), category, group)
+
+    def instrument_library(self, env, lib, name):
+        """Time each object of a static library as it compiles, and the archive"""
+        for node in lib:
+            self.instrument(env, [s for s in node.sources if s.has_builder()], "compile", name)
+        self.instrument(env, lib, "archive", name)
+
+    def summary(self):
+        """Rows of (category, group, count, total seconds, wall seconds)"""
+        groups = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e["ts"]):
+            key = (event["cat"], event["args"]["group"])
+            groups.setdefault(key, []).append(event)
+        rows = []
+        for (category, group), events in groups.items():
+            total = sum(e["dur"] for e in events) / 1e6
+            wall = (max(e["ts"] + e["dur"] for e in events) - min(e["ts"] for e in events)) / 1e6
+            rows.append((category, group, len(events), total, wall))
+        rows.sort(key=lambda r: -r[3])
+        return rows
+
+    def format_summary(self, top=20):
+        rows = self.summary()
+        elapsed = self.now() / 1e6
+        lines = ["%-10s %-28s %6s %9s %9s" % ("Phase", "Step", "Count", "Total", "Wall")]
+        for category, group, count, total, wall in rows[:top]:
+            lines.append("%-10s %-28s %6d %8.2fs %8.2fs" % (category, group, count, total, wall))
+        if len(rows) > top:
+            rest = rows[top:]
+            lines.append("%-10s %-28s %6d %8.2fs" % (
+                "", "(%d more)" % len(rest), sum(r[2] for r in rest), sum(r[3] for r in rest)))
+        lines.append("Build took %.2fs" % elapsed)
+        return "\n".join(lines)
+
+    def write(self):
+        if not isdir(dirname(self.path) or "."):
+            os.makedirs(dirname(self.path))
+        with self.lock:
+            events = list(self.events)
+        trace = dict(
+            traceEvents=[dict(name="process_name", ph="M", pid=1,
+                              args=dict(name="platformio build"))] + events,
+            displayTimeUnit="ms",
+            otherData=dict(started=self.origin),
+        )
+        with open(self.path, "w") as fp:
+            json.dump(trace, fp)
+
+    def finish(self):
+        if not self.events:
+            return
+        self.write()
+        self.log("")
+        self.log(self.format_summary())
+        self.log("Build trace: %s" % self.path)
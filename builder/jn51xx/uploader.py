@@ -0,0 +1,409 @@
+"""
+Native JN516x flash uploader
+
+Programs a firmware image through the ROM serial bootloader without the
+interactive JN51xxProgrammer.exe console. The link is switched to the fastest
+baud rate that the adapter and device will sustain before programming.
+
+    python -m jn51xx.uploader --port /dev/ttyUSB0 firmware.bin
+"""
+
+import argparse
+import sys
+import time
+from os.path import splitext
+
+from . import protocol as bl
+from .flashstate import FlashState, sector_hashes
+from .image import load_layout
+from .provision import ProvisionError, ProvisioningTable, parse_mac
+
+# How the sectors an incremental upload leaves alone are checked against the
+# image recorded in the flash state: not at all (the record is trusted), read
+# back in full, or sampled (SAMPLE_COUNT reads of SAMPLE_SIZE bytes spread
+# across each)
+CHECK_NONE = "none"
+CHECK_FULL = "full"
+CHECK_SAMPLE = "sample"
+CHECK_MODES = (CHECK_NONE, CHECK_FULL, CHECK_SAMPLE)
+SAMPLE_SIZE = 32
+SAMPLE_COUNT = 16
+
+
+def open_port(port, baudrate=bl.BOOTLOADER_BAUD, timeout=0.05):
+    import serial
+    return serial.serial_for_url(port, baudrate=baudrate, timeout=timeout)
+
+
+def iter_blocks(image, block_size, offset=0, start=0, end=None, skip_blank=True):
+    """Split image[start:end] into flash program blocks
+
+    Blocks that are entirely 0xFF are skipped as they match erased flash.
+    """
+    view = memoryview(image)
+    end = len(image) if end is None else end
+    blank = b"\xff" * block_size
+    for pos in range(start, end, block_size):
+        block = view[pos:min(pos + block_size, end)]
+        if skip_blank and block.tobytes() == blank[:len(block)]:
+            continue
+        yield offset + pos, block
+
+
+def populated_ranges(layout, start, end):
+    """Parts of image[start:end] that hold section contents, per the layout
+    manifest (the whole range if there is no manifest)
+    """
+    if layout is None:
+        return [(start, end)] if start < end else []
+    ranges = []
+    for region in layout["regions"]:
+        lo = max(start, region["offset"])
+        hi = min(end, region["offset"] + region["size"])
+        if lo < hi:
+            ranges.append((lo, hi))
+    return ranges
+
+
+def layout_path(path):
+    """Layout manifest written next to an image by the build"""
+    return splitext(path)[0] + ".layout.json"
+
+
+class UploadStats(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.baudrate = bl.BOOTLOADER_BAUD
+        self.image_size = 0
+        self.erased = 0
+        self.written = 0
+        self.verified = 0
+        self.sectors_total = 0
+        self.sectors_changed = None
+        self.checked = 0
+        self.provisioned = 0
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        return self.image_size / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        text = "%d bytes in %.2fs (%.1f KB/s @ %d baud)" % (
+            self.image_size, self.elapsed, self.throughput / 1024.0, self.baudrate)
+        if self.sectors_changed is not None:
+            text += ", %d/%d sectors changed" % (self.sectors_changed, self.sectors_total)
+        if self.checked:
+            text += ", %d bytes of unchanged sectors checked" % self.checked
+        if self.provisioned:
+            text += ", %d bytes EEPROM provisioning" % self.provisioned
+        return text
+
+
+class FlashUploader(object):
+
+    def __init__(self, port, speeds=None, block_size=bl.DEFAULT_BLOCK_SIZE, window=2,
+                 verify=True, timeout=1.0, log=None, progress=None, expect_mac=None,
+                 check_unchanged=CHECK_NONE):
+        if not 0 < block_size <= bl.MAX_BLOCK_SIZE:
+            raise ValueError("Block size must be between 1 and %d" % bl.MAX_BLOCK_SIZE)
+        self.port_name = port
+        self.speeds = sorted(speeds or bl.BAUD_RATES, reverse=True)
+        self.block_size = block_size
+        self.window = max(1, window)
+        self.verify = verify
+        self.timeout = timeout
+        self.log = log or (lambda msg: None)
+        self.progress = progress
+        self.expect_mac = expect_mac
+        if check_unchanged not in CHECK_MODES:
+            raise ValueError("Unchanged sector check must be one of %s" % ", ".join(CHECK_MODES))
+        self.check_unchanged = check_unchanged
+        self.port = None
+        self.bootloader = None
+        self.chip_id = None
+        self.mac = None
+        self.stats = UploadStats()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def chip(self):
+        return bl.chip_name(self.chip_id)
+
+    def connect(self):
+        # A port name, or an already open pyserial-compatible port (eg. a simulator.SimulatedLink)
+        if isinstance(self.port_name, str):
+            self.port = open_port(self.port_name, bl.BOOTLOADER_BAUD)
+        else:
+            self.port = self.port_name
+        self.bootloader = bl.Bootloader(self.port, self.timeout)
+        self.port.reset_input_buffer()
+        self.chip_id = self.bootloader.get_chip_id()
+        self.mac = self.bootloader.read_mac()
+        self.log("Found %s (chip ID 0x%08X, MAC %s) on %s" % (
+            self.chip, self.chip_id, bl.format_mac(self.mac), self.port_name))
+        # Before anything is written, make sure it's the device that was asked for
+        if self.expect_mac is not None and self.mac != self.expect_mac:
+            raise bl.BootloaderError("Expected the device with MAC %s on %s, found %s" % (
+                bl.format_mac(self.expect_mac), self.port_name, bl.format_mac(self.mac)))
+        self.negotiate_baud()
+        self.bootloader.select_flash()
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+    def negotiate_baud(self):
+        """Switch to the fastest rate that both ends accept and that passes a probe"""
+        current = bl.BOOTLOADER_BAUD
+        for rate in self.speeds:
+            if rate <= current:
+                break
+            try:
+                self.port.baudrate = rate
+                self.port.baudrate = current
+            except (ValueError, IOError):
+                # The host adapter can't do this rate
+                continue
+            self.bootloader.change_baud(rate)
+            self.port.baudrate = rate
+            try:
+                self.port.reset_input_buffer()
+                self.bootloader.get_chip_id()
+                current = rate
+                break
+            except bl.BootloaderError:
+                # Link is unreliable at this rate, ask the device to drop back
+                self.log("Link unstable at %d baud, falling back" % rate)
+                try:
+                    self.bootloader.send(bl.CHANGE_BAUD_RATE_REQUEST,
+                                         bytearray([bl.baud_divisor(current)]))
+                except IOError:
+                    pass
+                self.port.baudrate = current
+                time.sleep(0.05)
+                self.port.reset_input_buffer()
+                self.bootloader.get_chip_id()
+        self.stats.baudrate = current
+        return current
+
+    def program(self, image, erase=True, layout=None):
+        """Erase flash and program `image` from offset 0
+
+        With a `layout` manifest only its populated regions are written and
+        verified.
+        """
+        image = bytes(image)
+        flash_size = bl.chip_flash_size(self.chip_id)
+        if flash_size and len(image) > flash_size:
+            raise bl.BootloaderError("Image (%d bytes) does not fit in %s flash (%d bytes)" % (
+                len(image), self.chip, flash_size))
+        self.stats.image_size = len(image)
+
+        if erase:
+            self.log("Erasing flash...")
+            self.bootloader.erase_flash()
+            self.stats.erased = flash_size
+
+        self.log("Programming %d bytes..." % len(image))
+        for start, end in populated_ranges(layout, 0, len(image)):
+            self.stats.written += self.bootloader.write_flash_blocks(
+                iter_blocks(image, self.block_size, start=start, end=end),
+                self.window, self.progress)
+
+        if self.verify:
+            self.log("Verifying...")
+            for start, end in populated_ranges(layout, 0, len(image)):
+                self.verify_range(image, start, end)
+
+        self.stats.finished = time.time()
+        return self.stats
+
+    def program_incremental(self, image, state_dir, layout=None):
+        """Erase, program and verify only the sectors that differ from the
+        image recorded as last flashed to this device
+        """
+        image = bytes(image)
+        flash_state = FlashState(state_dir)
+        previous = flash_state.load(self.mac, self.chip_id)
+        if layout is not None and layout["sector_size"] == bl.FLASH_SECTOR_SIZE:
+            sectors = [s["sha1"] for s in layout["sectors"]]
+        else:
+            sectors = sector_hashes(image)
+        self.stats.sectors_total = len(sectors)
+
+        if previous is None or previous["sector_size"] != bl.FLASH_SECTOR_SIZE:
+            self.log("No record of this device's flash contents, programming full image")
+            previous = None
+        elif not self._check_unchanged(image, previous["sectors"], sectors, layout):
+            self.log("Device flash does not match its recorded contents, programming full image")
+            previous = None
+
+        if previous is None:
+            flash_state.forget(self.mac)
+            self.program(image, layout=layout)
+            self.stats.sectors_changed = len(sectors)
+            flash_state.save(self.mac, self.chip_id, image)
+            return self.stats
+
+        blank = sector_hashes(b"\xff" * bl.FLASH_SECTOR_SIZE)[0]
+        old = previous["sectors"]
+        changed = [i for i in range(len(sectors)) if i >= len(old) or old[i] != sectors[i]]
+        # Sectors the previous image used but the new one doesn't
+        stale = [i for i in range(len(sectors), len(old)) if old[i] != blank]
+        self.stats.image_size = len(image)
+        self.stats.sectors_changed = len(changed)
+        self.log("Updating %d of %d sectors" % (len(changed), len(sectors)))
+
+        # Invalidate the record first so an interrupted upload falls back to
+        # a full program next time
+        flash_state.forget(self.mac)
+        for sector in changed + stale:
+            self.bootloader.erase_sector(sector)
+            self.stats.erased += bl.FLASH_SECTOR_SIZE
+
+        for sector in changed:
+            start = sector * bl.FLASH_SECTOR_SIZE
+            end = min(start + bl.FLASH_SECTOR_SIZE, len(image))
+            for lo, hi in populated_ranges(layout, start, end):
+                self.stats.written += self.bootloader.write_flash_blocks(
+                    iter_blocks(image, self.block_size, start=lo, end=hi),
+                    self.window, self.progress)
+
+        if self.verify:
+            self.log("Verifying...")
+            for sector in changed:
+                start = sector * bl.FLASH_SECTOR_SIZE
+                end = min(start + bl.FLASH_SECTOR_SIZE, len(image))
+                for lo, hi in populated_ranges(layout, start, end):
+                    self.verify_range(image, lo, hi)
+
+        flash_state.save(self.mac, self.chip_id, image)
+        self.stats.finished = time.time()
+        return self.stats
+
+    def _check_unchanged(self, image, old, new, layout=None):
+        """Whether the sectors the image shares with the recorded one still
+        hold it on the device (only their populated ranges are compared)"""
+        if self.check_unchanged == CHECK_NONE:
+            return True
+        unchanged = [i for i in range(min(len(old), len(new))) if old[i] == new[i]]
+        if unchanged:
+            self.log("Checking %d unchanged sectors (%s)..." % (len(unchanged), self.check_unchanged))
+        for sector in unchanged:
+            start = sector * bl.FLASH_SECTOR_SIZE
+            end = min(start + bl.FLASH_SECTOR_SIZE, len(image))
+            for lo, hi in populated_ranges(layout, start, end):
+                for pos, length in self._check_reads(lo, hi):
+                    if self.bootloader.read_flash(pos, length) != image[pos:pos + length]:
+                        return False
+                    self.stats.checked += length
+        return True
+
+    def _check_reads(self, lo, hi):
+        """(address, length) of the reads that check image[lo:hi]"""
+        if self.check_unchanged == CHECK_FULL:
+            return [(pos, min(self.block_size, hi - pos)) for pos in range(lo, hi, self.block_size)]
+        step = max(SAMPLE_SIZE, (hi - lo) // SAMPLE_COUNT)
+        return [(pos, min(SAMPLE_SIZE, hi - pos)) for pos in range(lo, hi, step)]
+
+    def verify_range(self, image, start, end):
+        for pos in range(start, end, self.block_size):
+            expected = image[pos:min(pos + self.block_size, end)]
+            actual = self.bootloader.read_flash(pos, len(expected))
+            if actual != expected:
+                raise bl.BootloaderError("Verify failed at 0x%06X" % pos)
+            self.stats.verified += len(expected)
+
+    def write_eeprom(self, offset, data):
+        """Write (and verify) EEPROM contents, eg. a provisioning image"""
+        for pos in range(0, len(data), self.block_size):
+            self.bootloader.write_eeprom(offset + pos, data[pos:pos + self.block_size])
+        if self.verify:
+            for pos in range(0, len(data), self.block_size):
+                expected = data[pos:pos + self.block_size]
+                if self.bootloader.read_eeprom(offset + pos, len(expected)) != expected:
+                    raise bl.BootloaderError("EEPROM verify failed at 0x%03X" % (offset + pos))
+        self.stats.provisioned += len(data)
+
+    def provisioning_image(self, provisioning):
+        """(offset, data) of this device's image from a ProvisioningTable;
+        worked out before the flash is touched, so that a device the table
+        can't provision fails without being programmed"""
+        return provisioning.image(self.mac, bl.chip_eeprom_size(self.chip_id))
+
+    def reset(self):
+        self.bootloader.reset()
+
+
+def upload(port, path, log=None, state_dir=None, provisioning=None, **kwargs):
+    """Program the image at `path`
+
+    If `state_dir` is given only the sectors that changed since the last
+    upload to the same device are programmed. With a `provisioning` table,
+    the device's EEPROM provisioning image is written in the same session.
+    """
+    with open(path, "rb") as fp:
+        image = fp.read()
+    layout = load_layout(layout_path(path), image)
+    with FlashUploader(port, log=log, **kwargs) as uploader:
+        eeprom = uploader.provisioning_image(provisioning) if provisioning is not None else None
+        if state_dir:
+            stats = uploader.program_incremental(image, state_dir, layout)
+        else:
+            stats = uploader.program(image, layout=layout)
+        if eeprom is not None:
+            uploader.write_eeprom(*eeprom)
+        uploader.reset()
+    if log:
+        log("Wrote %s" % stats)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Program a JN516x over its serial bootloader")
+    parser.add_argument("--port", required=True)
+    parser.add_argument("--min-speed", type=int, default=bl.BOOTLOADER_BAUD)
+    parser.add_argument("--max-speed", type=int, default=bl.MAX_BAUD)
+    parser.add_argument("--block-size", type=int, default=bl.DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--window", type=int, default=2,
+                        help="Flash program requests in flight (1 disables pipelining)")
+    parser.add_argument("--no-verify", action="store_true")
+    parser.add_argument("--state-dir",
+                        help="Only program sectors changed since the last upload recorded here")
+    parser.add_argument("--provision", metavar="TABLE",
+                        help="Also write the device's EEPROM provisioning image from this table")
+    parser.add_argument("--mac", help="Only program the device with this MAC address")
+    parser.add_argument("--check-unchanged", choices=CHECK_MODES, default=CHECK_NONE,
+                        help="With --state-dir, also read back the unchanged sectors in full or sample them "
+                             "(default: trust the record)")
+    parser.add_argument("image")
+    args = parser.parse_args(argv)
+
+    speeds = [r for r in bl.BAUD_RATES if args.min_speed <= r <= args.max_speed]
+    try:
+        provisioning = ProvisioningTable.load(args.provision) if args.provision else None
+        upload(args.port, args.image, log=print, speeds=speeds, block_size=args.block_size,
+               window=args.window, verify=not args.no_verify, state_dir=args.state_dir,
+               provisioning=provisioning, expect_mac=parse_mac(args.mac) if args.mac else None,
+               check_unchanged=args.check_unchanged)
+    except (bl.BootloaderError, ProvisionError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
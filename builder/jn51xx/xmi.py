@@ -0,0 +1,90 @@
+"""
+Reader for the EMF/XMI documents written by the NXP config editors
+
+.oscfgdiag and .zpscfg files are XMI serialisations of EMF models. Objects
+are nested elements whose tag is the containing feature (eg. <Tasks>), and
+cross references are attributes holding space separated paths such as
+"//@Modules.0/@Tasks.2".
+"""
+
+import xml.etree.ElementTree as ET
+
+XMI_NS = "http://www.omg.org/XMI"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+
+class XmiError(Exception):
+    pass
+
+
+def local_name(tag):
+    return tag.split("}", 1)[1] if tag.startswith("{") else tag
+
+
+class XmiDocument(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def parse(cls, path):
+        try:
+            return cls(ET.parse(path).getroot())
+        except ET.ParseError as e:
+            raise XmiError("%s: %s" % (path, e))
+
+    def resolve(self, ref):
+        """Element a "//@Feature.index/@Feature.index" path points to"""
+        ref = ref.strip()
+        if not ref.startswith("//"):
+            raise XmiError("Unsupported reference '%s'" % ref)
+        node = self.root
+        for step in ref[2:].split("/"):
+            if not step:
+                continue
+            if not step.startswith("@"):
+                raise XmiError("Unsupported reference '%s'" % ref)
+            feature, _, index = step[1:].partition(".")
+            children = [c for c in node if local_name(c.tag) == feature]
+            try:
+                node = children[int(index or 0)]
+            except (ValueError, IndexError):
+                raise XmiError("Dangling reference '%s'" % ref)
+        return node
+
+    def refs(self, element, attr):
+        """Elements referenced by a (possibly multi-valued) attribute"""
+        value = element.get(attr)
+        if not value:
+            # References may also be serialised as child elements with href
+            return [self.resolve(c.get("href").split("#", 1)[-1])
+                    for c in element if local_name(c.tag) == attr and c.get("href")]
+        return [self.resolve(r) for r in value.split()]
+
+    def ref(self, element, attr):
+        found = self.refs(element, attr)
+        return found[0] if found else None
+
+
+def children(element, feature):
+    return [c for c in element if local_name(c.tag) == feature]
+
+
+def type_name(element):
+    """The xsi:type of an element, without its package prefix"""
+    value = element.get("{%s}type" % XSI_NS) or ""
+    return value.split(":", 1)[-1]
+
+
+def get_int(element, attr, default=0):
+    value = element.get(attr)
+    if value is None or value == "":
+        return default
+    return int(value, 0)
+
+
+def get_bool(element, attr, default=False):
+    value = element.get(attr)
+    if value is None:
+        return default
+    return value.lower() == "true"
@@ -1,7 +1,11 @@
+import atexit
+import json
+import os
+import shutil
 import sys
 from platform import system
 from os import makedirs
-from os.path import basename, isdir, join
+from os.path import basename, exists, isdir, join
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
                           Builder, Default, DefaultEnvironment)
@@ -11,6 +15,22 @@ env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
+# Host-side tooling (uploader, image tools, ...) lives in builder/jn51xx
+sys.path.insert(0, join(platform.get_dir(), "builder"))
+
+# Persistent state shared between projects (flash contents of devices, ...)
+env.Replace(JENNIC_CACHE_DIR=env.GetProjectOption(
+    "jennic_cache_dir", join("$PROJECT_CORE_DIR", ".cache", "jennic")))
+
+# Time each build step, see `jennic_build_trace`
+TRACE = None
+if str(os.environ.get("JENNIC_BUILD_TRACE") or
+       env.GetProjectOption("jennic_build_trace", "no")).lower() in ("1", "yes", "true"):
+    from jn51xx import trace
+    TRACE = trace.start(env.subst(join("$BUILD_DIR", "build-trace.json")))
+    TRACE.hook(env)
+    TRACE.begin("configure", "configure", "configure")
+
 JN51PROG_DIR = platform.get_package_dir("tool-nxp-jn51prog")
 
 env.Replace(
@@ -21,6 +41,7 @@ env.Replace(
     CXX="ba-elf-g++",
     GDB="ba-elf-gdb",
     OBJCOPY="ba-elf-objcopy",
+    OBJDUMP="ba-elf-objdump",
     RANLIB="ba-elf-ranlib",
     SIZETOOL="ba-elf-size",
     UPLOADER=join(JN51PROG_DIR, "JN51xxProgrammer.exe"),
@@ -54,7 +75,8 @@ env.Replace(
         '-Wcast-align',
         '-fdata-sections',
         '-ffunction-sections',
-        '-flto',
+        # Per-function stack usage (.su files) for `pio run -t stack`
+        '-fstack-usage',
 
         # Suppress warnings generated by the framework
         '-Wno-unused-variable',
@@ -68,7 +90,7 @@ env.Replace(
         '-fomit-frame-pointer',
         '-Os',
         '-fshort-enums',
-        '-flto',
+        '-Wl,-Map,${BUILD_DIR}/${PROGNAME}.map',
     ],
 
     SIZEPROGREGEXP=r"^(?:\.text|\.data|\.rodata|\.version|\.bir|\.flashheader)\s+(\d+).*",
@@ -79,25 +101,117 @@ env.Replace(
     PROGSUFFIX=".elf"
 )
 
+# Build profile:
+#   release  whole program LTO, the SDK libraries included
+#   dev      the SDK libraries are compiled without LTO (see frameworks/jennic.py), so
+#            links only re-optimise the application's own code
+# That is the only difference: both link with the same flags. LTO runs serially
+# (plain -flto) unless `jennic_lto_jobs` is set: -flto=N has GCC's lto-wrapper
+# run the partitions through `make`, so that's only used if one is found.
+# The JENNIC_BUILD_PROFILE environment variable overrides the option (used by `linkbench`).
+BUILD_PROFILE = os.environ.get("JENNIC_BUILD_PROFILE") or env.GetProjectOption("jennic_build_profile", "release")
+if BUILD_PROFILE not in ("dev", "release"):
+    sys.stderr.write("Error: Invalid jennic_build_profile '%s' (expected dev or release)\n" % BUILD_PROFILE)
+    env.Exit(1)
+LTO_FLAG = '-flto'
+LTO_JOBS = env.GetProjectOption("jennic_lto_jobs", None)
+if LTO_JOBS:
+    try:
+        LTO_JOBS = int(LTO_JOBS)
+    except ValueError:
+        sys.stderr.write("Error: Invalid jennic_lto_jobs '%s' (expected a number)\n" % LTO_JOBS)
+        env.Exit(1)
+    if shutil.which("make"):
+        LTO_FLAG = '-flto=%d' % LTO_JOBS
+    else:
+        print("Warning: Ignoring jennic_lto_jobs, parallel LTO needs `make`, which wasn't found")
+
+env.Replace(JENNIC_BUILD_PROFILE=BUILD_PROFILE)
+env.Append(
+    CCFLAGS=['-flto'],
+    LINKFLAGS=[LTO_FLAG]
+)
+
+# Compiler output cache: compiles go through jn51xx/objcache.py, which copies the
+# object back from `jennic_cache_dir` when the same source was compiled the same
+# way before (eg. on another branch)
+COMPILER_CACHE = str(env.GetProjectOption("jennic_compiler_cache", "yes")).lower() in ("1", "yes", "true")
+if COMPILER_CACHE:
+    from jn51xx import objcache
+
+    COMPILER_CACHE_DIR = env.subst(join("$JENNIC_CACHE_DIR", "cc"))
+    COMPILER_CACHE_SIZE = env.GetProjectOption("jennic_compiler_cache_size", objcache.DEFAULT_MAX_SIZE)
+    # This build's own outcomes, as other builds (eg. the variants of a build
+    # matrix) may be compiling through the cache at the same time
+    COMPILER_CACHE_BUILD_STATS = env.subst(join("$BUILD_DIR", "objcache.log"))
+    if exists(COMPILER_CACHE_BUILD_STATS):
+        os.remove(COMPILER_CACHE_BUILD_STATS)
+
+    env.PrependENVPath("PYTHONPATH", join(platform.get_dir(), "builder"))
+    # Paths in the build dir are left out of the key, so builds in other dirs
+    # share objects that compile the same
+    env.Replace(JENNIC_OBJCACHE=(
+        '"$PYTHONEXE" -m jn51xx.objcache --dir "%s" --toolchain-version "%s" '
+        '--base-dir "$BUILD_DIR" --origin "$BUILD_DIR" --build-stats "%s"') % (
+        COMPILER_CACHE_DIR, platform.get_package_version("toolchain-nxp-beyondstudio"),
+        COMPILER_CACHE_BUILD_STATS))
+    for com in ["CCCOM", "CXXCOM", "ASPPCOM"]:
+        if com in env:
+            env.Replace(**{com: "$JENNIC_OBJCACHE " + env[com]})
+
+    def ReportCompilerCache():
+        counts = objcache.read_stats(COMPILER_CACHE_BUILD_STATS)
+        if counts["hit"] or counts["miss"]:
+            print(objcache.format_stats(counts))
+        if counts["miss"]:
+            try:
+                objcache.prune(COMPILER_CACHE_DIR, COMPILER_CACHE_SIZE)
+            except objcache.ObjCacheError as e:
+                sys.stderr.write("Error: jennic_compiler_cache_size: %s\n" % e)
+
+    atexit.register(ReportCompilerCache)
+
 # Allow user to override via pre:script
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
+def ElfToImage(target, source, env):
+    from jn51xx import elf, image, trace
+
+    try:
+        with trace.span(basename(str(target[0])), "image"):
+            image.convert(source[0].get_abspath(), target[0].get_abspath(),
+                          hex_path=target[1].get_abspath(),
+                          layout_path=target[2].get_abspath(),
+                          gap_fill=int(str(env.GetProjectOption("jennic_image_gap_fill", "0xFF")), 0))
+    except (image.ImageError, elf.ElfError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+def ImageEmitter(target, source, env):
+    # The .hex and the layout manifest are written alongside the .bin
+    base = str(target[0])[:-len(".bin")]
+    return [target[0], base + ".hex", base + ".layout.json"], source
+
+def ExtractLogTokens(target, source, env):
+    from jn51xx import dbglog
+
+    try:
+        tokens = dbglog.extract(target[0].get_abspath())
+    except dbglog.DbgLogError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    dbglog.save(tokens, env.subst(join("$BUILD_DIR", "${PROGNAME}.tokens.json")))
+    print("Tokenized logging: %d format strings (%d bytes) kept out of flash" % dbglog.summary(tokens))
+
 def pdumgenf(target, source, env):
     return "Cannot generate PDUM"
 
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                #"-j .version -j .bir -j .flashheader -j .vsr_table -j .vsr_handlers  -j .rodata -j .text -j .data -j .bss -j .heap -j .stack",
-                #"-S",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(ElfToImage, "Building $TARGET"),
+            emitter=ImageEmitter,
             suffix=".bin"
         ),
         PdumGen=Builder(
@@ -124,6 +238,17 @@ else:
     target_elf = env.BuildProgram()
     target_firm = env.ElfToBin(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
 
+    if TRACE:
+        TRACE.end("configure")
+        TRACE.instrument(env, [s for s in target_elf[0].sources
+                               if s.has_builder() and str(s).endswith(".o")], "compile", "src")
+        TRACE.instrument(env, target_elf, "link")
+
+    # The format strings of tokenized DBG_vPrintf calls, for the host decoder
+    if env.get("JENNIC_DEBUG_TOKENIZE"):
+        env.AddPostAction(target_elf, env.VerboseAction(
+            ExtractLogTokens, "Extracting log tokens from $TARGET"))
+
 AlwaysBuild(env.Alias("nobuild", target_firm))
 target_buildprog = env.Alias("buildprog", target_firm, target_firm)
 
@@ -131,21 +256,431 @@ target_buildprog = env.Alias("buildprog", target_firm, target_firm)
 # Target: Print binary size
 #
 
+def AnalyzeFootprint(env, source):
+    from jn51xx import footprint
+
+    return footprint.analyze(
+        source[0].get_abspath(),
+        map_path=env.subst(join("$BUILD_DIR", "${PROGNAME}.map")),
+        max_flash=int(board.get("upload.maximum_size", 0)) or None,
+        max_ram=int(board.get("upload.maximum_ram_size", 0)) or None)
+
+def GetSizeHistory(env):
+    from jn51xx import sizehistory
+
+    return sizehistory.SizeHistory(
+        env.subst(env.GetProjectOption(
+            "jennic_size_history",
+            join("$PROJECT_WORKSPACE_DIR", "size-history", "${PIOENV}.jsonl"))),
+        limit=int(env.GetProjectOption("jennic_size_history_limit", sizehistory.DEFAULT_LIMIT)))
+
+def CompareFootprint(env, history, current):
+    from jn51xx import sizehistory
+
+    baseline = history.baseline(
+        env.GetProjectOption("jennic_size_baseline", "previous"), current)
+    if baseline is None:
+        return None, []
+    changes = sizehistory.diff(baseline, current)
+    errors = sizehistory.check_growth(
+        changes,
+        max_flash=env.GetProjectOption("jennic_size_max_growth_flash", None),
+        max_ram=env.GetProjectOption("jennic_size_max_growth_ram", None))
+    return (baseline, changes), errors
+
+def PrintFootprint(target, source, env):
+    from jn51xx import footprint, sizehistory
+
+    report = AnalyzeFootprint(env, source)
+    print(footprint.format_report(
+        report, int(env.GetProjectOption("jennic_size_top", 10))))
+
+    with open(env.subst(join("$BUILD_DIR", "${PROGNAME}.size.json")), "w") as fp:
+        json.dump(report, fp, indent=1)
+
+    # Record this build, and gate on growth against the baseline
+    commit, dirty = sizehistory.git_revision(env.subst("$PROJECT_DIR"))
+    current = sizehistory.make_record(
+        report, sizehistory.hash_elf(source[0].get_abspath()), commit, dirty)
+    history = GetSizeHistory(env)
+    comparison, errors = CompareFootprint(env, history, current)
+    if comparison:
+        baseline, changes = comparison
+        print("Size change since %s: flash %+d, RAM %+d bytes" % (
+            sizehistory.describe(baseline), changes["flash"][2], changes["ram"][2]))
+
+    errors = footprint.check_limits(report) + errors
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    if errors:
+        env.Exit(1)
+    # Only a build that passed becomes the next "previous" baseline, so a
+    # rebuild of one that grew too much fails again
+    history.append(current)
+
+def PrintSizeDiff(target, source, env):
+    from jn51xx import sizehistory
+
+    report = AnalyzeFootprint(env, source)
+    current = sizehistory.make_record(
+        report, sizehistory.hash_elf(source[0].get_abspath()),
+        *sizehistory.git_revision(env.subst("$PROJECT_DIR")))
+    comparison, errors = CompareFootprint(env, GetSizeHistory(env), current)
+    if comparison is None:
+        print("No baseline build to compare with (jennic_size_baseline = %s)" %
+              env.GetProjectOption("jennic_size_baseline", "previous"))
+        return
+    baseline, changes = comparison
+    print(sizehistory.format_diff(
+        changes, baseline, current, int(env.GetProjectOption("jennic_size_top", 10))))
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    if errors:
+        env.Exit(1)
+
 target_size = env.Alias(
     "size", target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
+    env.VerboseAction(TRACE.wrap(PrintFootprint, "size", "size") if TRACE else PrintFootprint,
+                      "Calculating size $SOURCE"))
 AlwaysBuild(target_size)
 
+#
+# Target: Compare size with a previous build
+#
+
+target_sizediff = env.Alias(
+    "sizediff", target_elf,
+    env.VerboseAction(PrintSizeDiff, "Comparing size of $SOURCE"))
+AlwaysBuild(target_sizediff)
+
+#
+# Target: Worst-case stack depth
+#
+
+def PrintStackUsage(target, source, env):
+    from jn51xx import osconfig, stackusage, xmi
+
+    try:
+        # The OS tasks and ISRs are only reached through the OS's tables
+        conf_os = env.GetProjectOption("conf_os", None)
+        os_config = None
+        if conf_os:
+            os_config = osconfig.OsConfig(env.subst(join("$PROJECT_SRC_DIR", conf_os)))
+        report = stackusage.analyze(
+            source[0].get_abspath(),
+            stackusage.find_su_files(env.subst("$BUILD_DIR")),
+            objdump=env.subst("$OBJDUMP"),
+            stack_size=env.get("JENNIC_STACK_SIZE"),
+            heap_size=env.get("JENNIC_MIN_HEAP_SIZE"),
+            margin=float(env.GetProjectOption("jennic_stack_margin", stackusage.DEFAULT_MARGIN)),
+            os_config=os_config)
+    except (stackusage.StackUsageError, osconfig.OsConfigError, xmi.XmiError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    print(stackusage.format_report(report))
+
+    with open(env.subst(join("$BUILD_DIR", "${PROGNAME}.stack.json")), "w") as fp:
+        json.dump(report, fp, indent=1)
+    errors = stackusage.check(report)
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    if errors:
+        env.Exit(1)
+
+target_stack = env.Alias(
+    "stack", target_elf,
+    env.VerboseAction(PrintStackUsage, "Analysing stack usage of $SOURCE"))
+AlwaysBuild(target_stack)
+
+#
+# Target: Link time and image size under each build profile
+#
+
+def LinkBenchmark(target, source, env):
+    from jn51xx import linkbench
+
+    results = []
+    for profile in linkbench.PROFILES:
+        print("Building with the %s profile..." % profile)
+        try:
+            results.append(linkbench.run_profile(
+                [env.subst("$PYTHONEXE"), "-m", "platformio", "run"],
+                env.subst("$PROJECT_DIR"), env.subst("$PIOENV"), profile,
+                env.subst(join("$BUILD_DIR", "linkbench", profile)),
+                env.subst("${PROGNAME}")))
+        except linkbench.LinkBenchError as e:
+            sys.stderr.write("Error: %s\n" % e)
+            env.Exit(1)
+    print(linkbench.format_results(results))
+    with open(env.subst(join("$BUILD_DIR", "linkbench.json")), "w") as fp:
+        json.dump(results, fp, indent=1)
+
+target_linkbench = env.Alias(
+    "linkbench", None,
+    env.VerboseAction(LinkBenchmark, "Benchmarking link under each build profile"))
+AlwaysBuild(target_linkbench)
+
+#
+# Target: Zigbee OTA upgrade image (and a delta against a previous release)
+#
+
+def BuildOta(target, source, env):
+    from jn51xx import elf, ota
+
+    def option(name, default=None):
+        value = env.GetProjectOption(name, default)
+        return env.subst(value) if isinstance(value, str) else value
+
+    version = option("jennic_ota_version")
+    if version is None:
+        sys.stderr.write("Error: Please specify `jennic_ota_version` (eg. 0x00010002)\n")
+        env.Exit(1)
+
+    # Neither encrypted nor delta files can be used by the SDK's own OTA client
+    key = option("jennic_ota_key")
+    iv = option("jennic_ota_iv")
+    base = option("jennic_ota_base")
+    experimental = str(option("jennic_ota_experimental", "no")).lower() in ("1", "yes", "true")
+    if (key or base) and not experimental:
+        sys.stderr.write("Error: `jennic_ota_key` and `jennic_ota_base` build files the SDK's OTA client "
+                         "can't use; set `jennic_ota_experimental = yes` to build them anyway\n")
+        env.Exit(1)
+
+    try:
+        bin_path = source[0].get_abspath()
+        with open(bin_path, "rb") as fp:
+            image = fp.read()
+
+        # Fill in the OTA header the application links in for itself, if any
+        embedded_offset = None
+        elf_file = elf.ElfFile.open(env.subst(join("$BUILD_DIR", "${PROGNAME}.elf")))
+        sec = elf_file.section(ota.EMBEDDED_HEADER_SECTION)
+        if sec is not None:
+            with open(env.subst(join("$BUILD_DIR", "${PROGNAME}.layout.json"))) as fp:
+                embedded_offset = elf_file.section_lma(sec) - json.load(fp)["base"]
+
+        delta_type = option("jennic_ota_delta_image_type")
+        full, delta = ota.make_ota_files(
+            image,
+            manufacturer=int(str(option("jennic_ota_manufacturer", "0x1037")), 0),
+            image_type=int(str(option("jennic_ota_image_type", "0")), 0),
+            file_version=int(str(version), 0),
+            header_string=option("jennic_ota_header_string", env.subst("${PROGNAME}")),
+            base=ota.read_image(base) if base else None,
+            key=ota.parse_key(key) if key else None,
+            iv=ota.parse_key(iv) if iv else None,
+            embedded_header_offset=embedded_offset,
+            delta_image_type=int(str(delta_type), 0) if delta_type else None)
+    except (ota.OtaError, elf.ElfError, IOError, ValueError, KeyError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+
+    ota_path = env.subst(join("$BUILD_DIR", "${PROGNAME}.ota"))
+    with open(ota_path, "wb") as fp:
+        fp.write(full)
+    print("OTA image: %s (%d bytes%s)" % (ota_path, len(full), ", encrypted, experimental" if key else ""))
+    if delta is not None:
+        delta_path = env.subst(join("$BUILD_DIR", "${PROGNAME}.delta.ota"))
+        with open(delta_path, "wb") as fp:
+            fp.write(delta)
+        print("OTA delta: %s (%d bytes, %.1f%% of full image, image type 0x%04x, experimental)" % (
+            delta_path, len(delta), 100.0 * len(delta) / len(full), ota.parse_ota(delta)[0]["image_type"]))
+
+target_ota = env.Alias(
+    "ota", target_firm,
+    env.VerboseAction(BuildOta, "Building OTA image from $SOURCE"))
+AlwaysBuild(target_ota)
+
+#
+# Target: Per-device EEPROM provisioning images
+#
+
+def BuildProvisioning(target, source, env):
+    from jn51xx import protocol, provision
+
+    table = env.GetProjectOption("jennic_provisioning", None)
+    if not table:
+        sys.stderr.write("Error: Please specify `jennic_provisioning` (a JSON device table)\n")
+        env.Exit(1)
+    outdir = env.subst(join("$BUILD_DIR", "provision"))
+    if not isdir(outdir):
+        makedirs(outdir)
+    # Where the block goes depends on the chip's EEPROM size
+    mcu = board.get("build.mcu", "").upper()
+    eeprom_size = protocol.EEPROM_SIZES.get(mcu, provision.DEFAULT_EEPROM_SIZE)
+    try:
+        provisioning = provision.ProvisioningTable.load(env.subst(table))
+        offset, size = provisioning.layout(eeprom_size)
+        for mac in sorted(provisioning.devices):
+            offset, data = provisioning.image(mac, eeprom_size)
+            with open(join(outdir, "%s.eeprom" % mac.hex()), "wb") as fp:
+                fp.write(data)
+    except (provision.ProvisionError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    print("Provisioning images for %d devices in %s (%s EEPROM offset 0x%03X, %d bytes)" % (
+        len(provisioning.devices), outdir, mcu or "JN516x", offset, size))
+
+target_provision = env.Alias(
+    "provision", None,
+    env.VerboseAction(BuildProvisioning, "Building EEPROM provisioning images"))
+AlwaysBuild(target_provision)
+
 #
 # Target: Upload by default .bin file
 #
 
+def GetUploadOptions(env):
+    from jn51xx import protocol
+
+    # UPLOAD_SPEED is the slowest acceptable rate, the link is switched to
+    # the fastest rate up to upload.maximum_speed that the adapter sustains.
+    min_speed = int(env.subst("$UPLOAD_SPEED") or protocol.BOOTLOADER_BAUD)
+    max_speed = int(board.get("upload.maximum_speed", protocol.MAX_BAUD))
+    speeds = [r for r in protocol.BAUD_RATES if min_speed <= r <= max_speed] or [min_speed]
+
+    # Only reprogram the flash sectors that changed since the last upload
+    state_dir = None
+    if str(env.GetProjectOption("jennic_incremental_upload", "no")).lower() in ("1", "yes", "true"):
+        state_dir = join(env.subst("$JENNIC_CACHE_DIR"), "flash")
+
+    # Per-device EEPROM provisioning, written in the same session as the flash
+    provisioning = None
+    table = env.GetProjectOption("jennic_provisioning", None)
+    if table:
+        from jn51xx import provision
+        provisioning = provision.ProvisioningTable.load(env.subst(table))
+
+    return dict(
+        speeds=speeds,
+        state_dir=state_dir,
+        provisioning=provisioning,
+        check_unchanged=env.GetProjectOption("jennic_incremental_check", "none"),
+        block_size=int(board.get("upload.block_size", protocol.DEFAULT_BLOCK_SIZE)),
+        window=int(board.get("upload.window", 2)),
+    )
+
+def GetPortCachePath(env):
+    return env.subst(join("$JENNIC_CACHE_DIR", "ports.json"))
+
+def AutodetectJennicPort(target, source, env):
+    from jn51xx import portdetect
+
+    if env.subst("$UPLOAD_PORT"):
+        return
+    mac = env.GetProjectOption("jennic_upload_mac", None)
+    try:
+        device = portdetect.detect(
+            env.GetProjectOption("jennic_upload_ports", None),
+            mcu=board.get("build.mcu", None),
+            mac=portdetect.parse_mac(mac) if mac else None,
+            cache_path=GetPortCachePath(env),
+            log=print)
+    except portdetect.PortDetectError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    # The uploader checks it's still the same device once connected
+    env.Replace(UPLOAD_PORT=device.port, JENNIC_UPLOAD_DETECTED_MAC=device.mac.hex())
+
+def UploadNative(target, source, env):
+    from jn51xx import portdetect, protocol, provision, uploader
+
+    def log(msg):
+        print(msg)
+
+    try:
+        mac = env.GetProjectOption("jennic_upload_mac", None) or env.get("JENNIC_UPLOAD_DETECTED_MAC")
+        uploader.upload(env.subst("$UPLOAD_PORT"), source[0].get_abspath(), log=log,
+                        expect_mac=portdetect.parse_mac(mac) if mac else None,
+                        **GetUploadOptions(env))
+    except (protocol.BootloaderError, provision.ProvisionError, portdetect.PortDetectError, IOError) as e:
+        # Probe the port again next time rather than trusting what was there
+        portdetect.forget(GetPortCachePath(env), env.subst("$UPLOAD_PORT"))
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+
+def UploadBatch(target, source, env):
+    from jn51xx import batch, protocol, provision
+
+    ports = env.GetProjectOption("jennic_upload_ports", "") or env.subst("$UPLOAD_PORT")
+    if not ports:
+        sys.stderr.write("Error: Please specify `jennic_upload_ports` for batch upload\n")
+        env.Exit(1)
+
+    def log(msg):
+        print(msg)
+
+    try:
+        result = batch.upload_batch(
+            ports, source[0].get_abspath(), log=log,
+            retries=int(env.GetProjectOption("jennic_upload_retries", 2)),
+            **GetUploadOptions(env))
+    except (protocol.BootloaderError, provision.ProvisionError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    if result.failed:
+        env.Exit(1)
+
+if env.subst("$UPLOAD_PROTOCOL") == "jn51xxprogrammer":
+    upload_action = env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
+else:
+    upload_action = env.VerboseAction(UploadNative, "Uploading $SOURCE")
+
 target_upload = env.Alias(
     "upload", target_firm,
-    [env.VerboseAction(env.AutodetectUploadPort, "Looking for upload port..."),
-     env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")])
+    [env.VerboseAction(AutodetectJennicPort, "Looking for upload port..."),
+     upload_action])
 env.AlwaysBuild(target_upload)
 
+#
+# Target: Upload .bin file to many devices at once (production line)
+#
+
+target_upload_batch = env.Alias(
+    "uploadbatch", target_firm,
+    env.VerboseAction(UploadBatch, "Uploading $SOURCE to multiple devices"))
+AlwaysBuild(target_upload_batch)
+
+#
+# Target: Programming throughput of the image against a simulated bootloader
+#
+
+def FlashBenchmark(target, source, env):
+    from jn51xx import flashbench, image, protocol, uploader
+
+    min_speed = int(board.get("upload.speed", protocol.BOOTLOADER_BAUD))
+    max_speed = int(board.get("upload.maximum_speed", protocol.MAX_BAUD))
+    block_size = int(board.get("upload.block_size", protocol.DEFAULT_BLOCK_SIZE))
+    path = source[0].get_abspath()
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read()
+        results = flashbench.run(
+            data, image.load_layout(uploader.layout_path(path), data),
+            speeds=[r for r in protocol.BAUD_RATES if min_speed <= r <= max_speed] or [min_speed],
+            block_sizes=sorted(set(flashbench.DEFAULT_BLOCK_SIZES + [block_size])),
+            window=int(board.get("upload.window", 2)), log=print)
+        baseline = env.GetProjectOption("jennic_flashbench_baseline", None)
+        regressions = flashbench.compare(
+            results, flashbench.load(env.subst(baseline)),
+            env.GetProjectOption("jennic_flashbench_max_regression",
+                                 flashbench.DEFAULT_MAX_REGRESSION)) if baseline else []
+    except (flashbench.FlashBenchError, protocol.BootloaderError, IOError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    print(flashbench.format_results(results))
+    flashbench.save(results, env.subst(join("$BUILD_DIR", "flashbench.json")), basename(path))
+    for r in regressions:
+        sys.stderr.write("Error: %s at %d baud, %d byte blocks, verify %s is %.1f%% slower than %s\n" % (
+            r["chip"], r["speed"], r["block_size"], r["verify"], -100 * r["change"], baseline))
+    if regressions:
+        env.Exit(1)
+
+target_flashbench = env.Alias(
+    "flashbench", target_firm,
+    env.VerboseAction(FlashBenchmark, "Benchmarking programming of $SOURCE"))
+AlwaysBuild(target_flashbench)
+
 #
 # Default targets
 #